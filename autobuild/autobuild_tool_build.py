@@ -148,94 +148,91 @@ only by 'autobuild build' to create package metadata.
             raise BuildError(''.join((package_errors,
                                       "\n    in configuration ", args.config_file,
                                       verbose)))
-        current_directory = os.getcwd()
         if args.clean_only:
             logger.info("building with --clean-only required")
-        try:
-            configure_first = not args.do_not_configure
-            build_configurations = common.select_configurations(
-                args, config, "building for")
-            if not build_configurations:
-                logger.warn(
-                    "no applicable build configurations found, autobuild cowardly refuses to build nothing!")
-                logger.warn(
-                    "did you remember to mark a build command as default? try passing 'default=true' to your 'autobuild edit build' command")
-            # packages were written into 'packages' subdir of build directory
-            # by default
-            install_dirs = common.select_directories(args, config, "metadata", "getting installed packages",
-                                                     lambda cnf:
-                                                     os.path.join(config.get_build_directory(cnf, platform), "packages"))
+        configure_first = not args.do_not_configure
+        build_configurations = common.select_configurations(
+            args, config, "building for")
+        if not build_configurations:
+            logger.warn(
+                "no applicable build configurations found, autobuild cowardly refuses to build nothing!")
+            logger.warn(
+                "did you remember to mark a build command as default? try passing 'default=true' to your 'autobuild edit build' command")
+        # packages were written into 'packages' subdir of build directory
+        # by default
+        install_dirs = common.select_directories(args, config, "metadata", "getting installed packages",
+                                                 lambda cnf:
+                                                 os.path.join(config.get_build_directory(cnf, platform), "packages"))
 
-            # get the absolute paths to the install dir and
-            # installed-packages.xml file
-            install_dir = os.path.realpath(install_dirs[0])
+        # get the absolute paths to the install dir and
+        # installed-packages.xml file
+        install_dir = os.path.realpath(install_dirs[0])
 
-            for build_configuration in build_configurations:
-                build_directory = config.make_build_directory(
-                    build_configuration, platform=platform, dry_run=args.dry_run)
-                logger.debug("building in %s" % build_directory)
-                if not args.dry_run:
-                    os.chdir(build_directory)
-                if configure_first:
-                    result = _configure_a_configuration(config, build_configuration,
-                                                        args.build_extra_arguments, args.dry_run)
-                    if result != 0:
-                        raise BuildError(
-                            "configuring default configuration returned %d" % result)
-                result = _build_a_configuration(config, build_configuration, platform_name=platform,
-                                                extra_arguments=args.build_extra_arguments, dry_run=args.dry_run)
-                # always make clean copy of the build metadata regardless of
-                # result
-                metadata_file_name = configfile.PACKAGE_METADATA_FILE
-                logger.debug("metadata file name: %s" % metadata_file_name)
-                if not args.dry_run and os.path.exists(metadata_file_name):
-                    os.unlink(metadata_file_name)
+        for build_configuration in build_configurations:
+            build_directory = config.make_build_directory(
+                build_configuration, platform=platform, dry_run=args.dry_run)
+            logger.debug("building in %s" % build_directory)
+            if configure_first:
+                result = _configure_a_configuration(config, build_configuration,
+                                                    args.build_extra_arguments, args.dry_run,
+                                                    cwd=build_directory)
                 if result != 0:
-                    raise BuildError("building configuration %s returned %d" %
-                                     (build_configuration, result))
+                    raise BuildError(
+                        "configuring default configuration returned %d" % result)
+            result = _build_a_configuration(config, build_configuration, platform_name=platform,
+                                            extra_arguments=args.build_extra_arguments, dry_run=args.dry_run,
+                                            cwd=build_directory)
+            # always make clean copy of the build metadata regardless of
+            # result
+            metadata_file_name = os.path.join(build_directory, configfile.PACKAGE_METADATA_FILE)
+            logger.debug("metadata file name: %s" % metadata_file_name)
+            if not args.dry_run and os.path.exists(metadata_file_name):
+                os.unlink(metadata_file_name)
+            if result != 0:
+                raise BuildError("building configuration %s returned %d" %
+                                 (build_configuration, result))
 
-                # Create the metadata record for inclusion in the package
-                metadata_file = configfile.MetadataDescription(
-                    path=metadata_file_name, create_quietly=True)
-                # COPY the package description from the configuration: we're
-                # going to convert it to metadata format.
-                metadata_file.package_description = \
-                    configfile.PackageDescription(config.package_description)
-                # A metadata package_description has a version attribute
-                # instead of a version_file attribute.
-                metadata_file.package_description.version = \
-                    metadata_file.package_description.read_version_file(
-                        build_directory)
-                del metadata_file.package_description["version_file"]
-                logger.info("built %s version %s" %
-                            (metadata_file.package_description.name,
-                             metadata_file.package_description.version))
-                # omit data on platform configurations
-                metadata_file.package_description.platforms = None
-                metadata_file.platform = platform
-                metadata_file.configuration = build_configuration.name
-                metadata_file.build_id = build_id
-                # get the record of any installed packages
-                logger.debug("installed files in " + args.installed_filename)
-                # load the list of already installed packages
-                installed_pathname = os.path.join(
-                    install_dir, args.installed_filename)
-                if os.path.exists(installed_pathname):
-                    metadata_file.add_dependencies(installed_pathname)
-                else:
-                    logger.debug("no installed files found (%s)" %
-                                 installed_pathname)
-                if args.clean_only and metadata_file.dirty:
-                    raise BuildError("Build depends on local or legacy installables\n"
-                                     + "  use 'autobuild install --list-dirty' to see problem packages\n"
-                                     + "  rerun without --clean-only to allow building anyway")
-                if not args.dry_run:
-                    metadata_file.save()
-        finally:
-            os.chdir(current_directory)
+            # Create the metadata record for inclusion in the package
+            metadata_file = configfile.MetadataDescription(
+                path=metadata_file_name, create_quietly=True)
+            # COPY the package description from the configuration: we're
+            # going to convert it to metadata format.
+            metadata_file.package_description = \
+                configfile.PackageDescription(config.package_description)
+            # A metadata package_description has a version attribute
+            # instead of a version_file attribute.
+            metadata_file.package_description.version = \
+                metadata_file.package_description.read_version_file(
+                    build_directory)
+            del metadata_file.package_description["version_file"]
+            logger.info("built %s version %s" %
+                        (metadata_file.package_description.name,
+                         metadata_file.package_description.version))
+            # omit data on platform configurations
+            metadata_file.package_description.platforms = None
+            metadata_file.platform = platform
+            metadata_file.configuration = build_configuration.name
+            metadata_file.build_id = build_id
+            # get the record of any installed packages
+            logger.debug("installed files in " + args.installed_filename)
+            # load the list of already installed packages
+            installed_pathname = os.path.join(
+                install_dir, args.installed_filename)
+            if os.path.exists(installed_pathname):
+                metadata_file.add_dependencies(installed_pathname)
+            else:
+                logger.debug("no installed files found (%s)" %
+                             installed_pathname)
+            if args.clean_only and metadata_file.dirty:
+                raise BuildError("Build depends on local or legacy installables\n"
+                                 + "  use 'autobuild install --list-dirty' to see problem packages\n"
+                                 + "  rerun without --clean-only to allow building anyway")
+            if not args.dry_run:
+                metadata_file.save()
 
 
-def _build_a_configuration(config, build_configuration, platform_name=common.get_current_platform(), extra_arguments=[], dry_run=False):
+def _build_a_configuration(config, build_configuration, platform_name=common.get_current_platform(), extra_arguments=[], dry_run=False,
+                           cwd=None):
     try:
         common_build_configuration = \
             config.get_build_configuration(
@@ -258,6 +255,6 @@ def _build_a_configuration(config, build_configuration, platform_name=common.get
     logger.info('executing build command %s',
                 build_executable.__str__(extra_arguments))
     if not dry_run:
-        return build_executable(extra_arguments, common.get_autobuild_environment())
+        return build_executable(extra_arguments, common.get_autobuild_environment(), cwd=cwd)
     else:
         return 0
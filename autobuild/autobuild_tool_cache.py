@@ -0,0 +1,106 @@
+#!/usr/bin/env python2
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+
+"""
+Maintains the local cache of downloaded package archives.
+
+'autobuild install' keeps the cache within $AUTOBUILD_CACHE_MAX_BYTES after
+each install; 'autobuild cache gc' does the same on demand. Both work from
+the cache index rather than scanning the whole cache directory, unless
+--rescan is given.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+import sys
+import logging
+
+from . import autobuild_base
+from . import common
+from . import install_cache
+
+logger = logging.getLogger('autobuild.cache')
+
+
+class CacheError(common.AutobuildError):
+    pass
+
+
+class AutobuildTool(autobuild_base.AutobuildBase):
+    def get_details(self):
+        return dict(name=self.name_from_file(__file__),
+                    description="Maintain the cache of downloaded package archives.")
+
+    def register(self, parser):
+        parser.description = "maintain the cache of package archives downloaded by the 'autobuild install' command."
+        parser.add_argument('command', choices=['gc'],
+                            help="cache command: gc removes the least recently used archives "
+                            "until the cache fits its size limit")
+        parser.add_argument('--max-bytes',
+                            type=int,
+                            default=None,
+                            dest='max_bytes',
+                            help="limit the cache to this many bytes (defaults to $AUTOBUILD_CACHE_MAX_BYTES)")
+        parser.add_argument('--rescan',
+                            action='store_true',
+                            default=False,
+                            dest='rescan',
+                            help="scan the whole cache directory for archives the cache index doesn't know about")
+
+    def run(self, args):
+        if args.command == 'gc':
+            max_bytes = args.max_bytes
+            if max_bytes is None:
+                max_bytes = common.get_install_cache_max_bytes()
+            collect_garbage(max_bytes, rescan=args.rescan, dry_run=args.dry_run)
+        else:
+            raise CacheError('unknown command %s' % args.command)
+
+
+def collect_garbage(max_bytes, rescan=False, dry_run=False, cache_index=None):
+    """
+    Evict the least recently used archives from the cache until it is no
+    larger than max_bytes. Returns the list of (pathname, size) evicted.
+    """
+    if max_bytes is None and not rescan:
+        raise CacheError("no cache size limit: set AUTOBUILD_CACHE_MAX_BYTES or use --max-bytes")
+    if cache_index is None:
+        cache_index = install_cache.CacheIndex()
+    if rescan:
+        cache_index.rescan()
+    evicted = []
+    if max_bytes is not None:
+        evicted = cache_index.evict(max_bytes, dry_run=dry_run)
+    if not dry_run:
+        cache_index.save()
+    remaining = cache_index.total_size()
+    for pathname, size in evicted:
+        print("%s %s (%d bytes)" % ("would remove" if dry_run else "removed", pathname, size))
+        if dry_run:
+            remaining -= size
+    print("cache %s: %d bytes" % (cache_index.cache_dir, remaining))
+    return evicted
+
+
+if __name__ == "__main__":
+    sys.exit(AutobuildTool().main(sys.argv[1:]))
@@ -84,23 +84,18 @@ class AutobuildTool(autobuild_base.AutobuildBase):
         if package_errors:
             raise ConfigurationError("%s\n    in configuration %s"
                                      % (package_errors, args.config_file))
-        current_directory = os.getcwd()
-        try:
-            build_configurations = common.select_configurations(
-                args, config, "configuring for")
-            for build_configuration in build_configurations:
-                build_directory = config.make_build_directory(
-                    build_configuration, platform=platform, dry_run=args.dry_run)
-                logger.debug("configuring in %s" % build_directory)
-                if not args.dry_run:
-                    os.chdir(build_directory)
-                result = _configure_a_configuration(config, build_configuration,
-                                                    args.additional_options, args.dry_run)
-                if result != 0:
-                    raise ConfigurationError(
-                        "default configuration returned %d" % result)
-        finally:
-            os.chdir(current_directory)
+        build_configurations = common.select_configurations(
+            args, config, "configuring for")
+        for build_configuration in build_configurations:
+            build_directory = config.make_build_directory(
+                build_configuration, platform=platform, dry_run=args.dry_run)
+            logger.debug("configuring in %s" % build_directory)
+            result = _configure_a_configuration(config, build_configuration,
+                                                args.additional_options, args.dry_run,
+                                                cwd=build_directory)
+            if result != 0:
+                raise ConfigurationError(
+                    "default configuration returned %d" % result)
 
 
 def configure(config, build_configuration_name, extra_arguments=[]):
@@ -120,7 +115,7 @@ def configure(config, build_configuration_name, extra_arguments=[]):
     return _configure_a_configuration(config, build_configuration, extra_arguments)
 
 
-def _configure_a_configuration(config, build_configuration, extra_arguments, dry_run=False):
+def _configure_a_configuration(config, build_configuration, extra_arguments, dry_run=False, cwd=None):
     try:
         common_build_configuration = \
             config.get_build_configuration(
@@ -142,6 +137,6 @@ def _configure_a_configuration(config, build_configuration, extra_arguments, dry
     logger.info('executing configure command %s',
                 configure_executable.__str__(extra_arguments))
     if not dry_run:
-        return configure_executable(extra_arguments, common.get_autobuild_environment())
+        return configure_executable(extra_arguments, common.get_autobuild_environment(), cwd=cwd)
     else:
         return 0
@@ -275,7 +275,7 @@ class Archive(InteractiveCommand):
 
     ARGUMENTS = ['format', 'hash_algorithm', 'platform']
 
-    ARG_DICT = {'format':         {'help': 'Archive format (e.g zip or tbz2)'},
+    ARG_DICT = {'format':         {'help': 'Archive format (e.g zip, tbz2, tgz, txz or tzst)'},
                 'hash_algorithm': {'help': 'The algorithm for computing the archive hash (e.g. md5)'},
                 'platform':       {'help': 'The name of the platform archive to be configured'}
                 }
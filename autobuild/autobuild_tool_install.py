@@ -42,15 +42,29 @@ import pprint
 import logging
 import tarfile
 import zipfile
+import socket
 import urllib2
+import httplib
+import json
 import codecs
+import hashlib
+import stat
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import zlib
+from cStringIO import StringIO
 import rarfile # <polarity>
 import certifi
+from multiprocessing.pool import ThreadPool
 
 from . import common
 from . import configfile
 from . import autobuild_base
 from . import hash_algorithms
+from . import decompressors
+from . import install_cache
 
 logger = logging.getLogger('autobuild.install')
 # Emitting --dry-run messages at warning() level means they're displayed in a
@@ -63,6 +77,15 @@ class InstallError(common.AutobuildError):
     pass
 
 
+# number of archives fetched concurrently unless --jobs says otherwise
+DEFAULT_DOWNLOAD_JOBS = 4
+
+try:
+    DEFAULT_EXTRACT_JOBS = multiprocessing.cpu_count()
+except NotImplementedError:
+    DEFAULT_EXTRACT_JOBS = 1
+
+
 __help = """\
 This autobuild command fetches and installs package archives.
 
@@ -101,6 +124,11 @@ def print_list(label, array):
     return True
 
 
+# the options handled by handle_query_args()
+QUERY_OPTIONS = ('list_installed', 'list_archives', 'list_licenses', 'copyrights', 'versions',
+                 'export_manifest', 'list_dirty', 'list_installed_urls', 'query_installed_file')
+
+
 def handle_query_args(options, config_file, installed_file):
     """
     Handle any arguments to query for package information.
@@ -181,10 +209,12 @@ def handle_query_args(options, config_file, installed_file):
         return True
 
     if options.export_manifest:
-        for package in installed_file.dependencies.itervalues():
-            item = pprint.pformat(package).rstrip()  # trim final newline
-            # permit parsing -- bad syntax otherwise
-            sys.stdout.writelines((item, ",\n"))
+        items = [pprint.pformat(package).rstrip()  # trim final newline
+                 for package in installed_file.dependencies.itervalues()]
+        if items:
+            # permit parsing as a single tuple: a newline between items
+            # would end the expression
+            print(", ".join(items) + ",")
         return True
 
     if options.list_dirty:
@@ -205,151 +235,735 @@ def handle_query_args(options, config_file, installed_file):
         return True
 
     if options.query_installed_file:
-        print_package_for(options.query_installed_file, installed_file)
+        if options.query_installed_file == '-':
+            # one path per line on stdin
+            for target_file in sys.stdin:
+                target_file = target_file.rstrip('\r\n')
+                if target_file:
+                    print_package_for(target_file, installed_file)
+        else:
+            print_package_for(options.query_installed_file, installed_file)
         return True
 
     return False
 
 
 def print_package_for(target_file, installed_file):
-    found_package = None
-    for package in installed_file.dependencies.itervalues():
-        if 'manifest' in package and target_file in package['manifest']:
-            found_package = package
-            break
-
+    found_package = InstalledFileIndex.of(installed_file).owner(target_file)
     if found_package:
         print("file '%s' installed by package '%s'"
-              % (target_file, package['package_description']['name']))
+              % (target_file, found_package))
     else:
         print("file '%s' not found in installed files" % target_file)
 
 
-def package_cache_path(package):
+class DownloadProgress(object):
     """
-    Return the filename of the package in the local cache.
-    The file may not actually exist.
+    Progress display for one or more concurrent downloads. Each download
+    reports the bytes it receives; the display combines them into a single
+    line so that parallel downloads don't garble each other's output.
     """
-    return os.path.join(common.get_install_cache_dir(), os.path.basename(package))
+    # if this is changed, also change 'MB' in progress message below
+    block_size = 1024 * 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.expected = {}
+        self.received = {}
+        self.shown = False
+
+    def start(self, key, size):
+        with self.lock:
+            self.expected[key] = size
+            self.received[key] = 0
+
+    def update(self, key, nbytes):
+        with self.lock:
+            self.received[key] += nbytes
+            if logger.getEffectiveLevel() <= logging.INFO:
+                self.show()
+
+    def show(self):
+        received = sum(self.received.itervalues())
+        recvd_blocks = (received + self.block_size - 1) / self.block_size
+        # use CR and trailing comma to rewrite the same line each time
+        if all(self.expected.itervalues()):
+            expected = sum(self.expected.itervalues())
+            expected_blocks = (expected + self.block_size - 1) / self.block_size
+            print("%d MB / %d MB (%d%%)\r" % (recvd_blocks, expected_blocks,
+                                              int(100 * received / expected)), end=' ')
+        else:
+            print("%d\r" % recvd_blocks, end=' ')
+        sys.stdout.flush()
+        self.shown = True
+
+    def finish(self):
+        with self.lock:
+            if self.shown:
+                print("")  # get a new line following progress message
+                sys.stdout.flush()
+                self.shown = False
 
 
-def get_package_file(package_name, package_url, hash_algorithm='md5', expected_hash=None):
+def get_package_file(package_name, package_url, hash_algorithm='md5', expected_hash=None,
+                     progress=None, cache_index=None, in_use=None):
     """
     Get the package file in the cache, downloading if needed.
     Validate the cache file using the hash (removing it if needed)
     Returns None if there was a problem downloading the file.
+
+    Pass a shared DownloadProgress as progress when several downloads are
+    running at once; its finish() is then the caller's responsibility.
+    Likewise, pass an install_cache.CacheIndex as cache_index to have the
+    caller save it: a cached file it records as verified is not hashed again.
+    Pass a list as in_use to have the cache file kept from eviction until
+    the caller releases the lock (see install_cache.CacheIndex.use_lock())
+    appended to it.
     """
+    own_progress = progress is None
+    if own_progress:
+        progress = DownloadProgress()
+    own_index = cache_index is None
+    if own_index:
+        cache_index = install_cache.CacheIndex()
+    try:
+        return _get_package_file(package_name, package_url, hash_algorithm, expected_hash,
+                                 progress, own_progress, cache_index, in_use)
+    finally:
+        if own_index:
+            cache_index.save()
+
+
+def _get_package_file(package_name, package_url, hash_algorithm, expected_hash,
+                      progress, own_progress, cache_index, in_use=None):
     cache_file = None
     download_retries = 3
+    # an attempt that extends the partial download doesn't use up a retry
+    partial_size = 0
     while cache_file is None and download_retries > 0:
-        cache_file = package_cache_path(package_url)
-        if os.path.exists(cache_file):
-            # some failures seem to leave empty cache files... delete and retry
-            if os.path.getsize(cache_file) == 0:
-                logger.warning("empty cache file removed")
-                os.remove(cache_file)
-                cache_file = None
-            elif hash_algorithm is not None \
-                    and not hash_algorithms.verify_hash(hash_algorithm, cache_file, expected_hash):
-                logger.warning("corrupt cached file removed: %s mismatch" % (
-                    hash_algorithm or "md5"))
-                os.remove(cache_file)
-                cache_file = None
+        # Another autobuild process sharing the cache may be fetching the
+        # same archive: wait for it, then use what it fetched.
+        with cache_index.entry_lock(package_url, hash_algorithm, expected_hash) as lock:
+            if lock.waited:
+                cache_index.refresh()
+            cache_file = _get_locked_package_file(package_name, package_url,
+                                                  hash_algorithm, expected_hash,
+                                                  progress, own_progress, cache_index)
+            if cache_file is not None and in_use is not None:
+                cache_file = _use_package_file(cache_file, cache_index, in_use)
+            if cache_file is None:
+                partial_file = cache_index.download_path(package_url, hash_algorithm,
+                                                         expected_hash) \
+                    + install_cache.PARTIAL_SUFFIX
+                if os.path.exists(partial_file) and os.path.getsize(partial_file) > partial_size:
+                    partial_size = os.path.getsize(partial_file)
+                else:
+                    download_retries -= 1
+        if cache_file is None and download_retries > 0:
+            logger.warning("Retrying download")
+
+    return cache_file
+
+
+def _use_package_file(cache_file, cache_index, in_use):
+    """
+    Take a shared lock on cache_file, appending it to in_use, and return
+    cache_file; or return None if it has meanwhile been evicted.
+    """
+    lock = cache_index.use_lock(cache_file)
+    lock.acquire()
+    # (only an archive fetched without a hash is locked under another name
+    # while it's fetched, giving another process the chance to evict it)
+    if not os.path.exists(cache_file):
+        lock.release()
+        return None
+    in_use.append(lock)
+    return cache_file
+
+
+def _get_locked_package_file(package_name, package_url, hash_algorithm, expected_hash,
+                             progress, own_progress, cache_index):
+    """
+    One attempt at getting the package file into the cache, holding its
+    cache entry lock. Returns the cache file, or None if that failed.
+    """
+    cache_file = cache_index.lookup(package_url, hash_algorithm, expected_hash)
+    if cache_file is None:
+        return _download_package_file(package_name, package_url,
+                                      hash_algorithm, expected_hash,
+                                      progress, own_progress, cache_index)
+    # some failures seem to leave empty cache files... delete and retry
+    if os.path.getsize(cache_file) == 0:
+        logger.warning("empty cache file removed")
+        os.remove(cache_file)
+        cache_index.forget(cache_file)
+        return None
+    if hash_algorithm is not None \
+            and not cache_index.is_verified(cache_file, hash_algorithm, expected_hash):
+        if not hash_algorithms.verify_hash(hash_algorithm, cache_file, expected_hash):
+            logger.warning("corrupt cached file removed: %s mismatch" % (
+                hash_algorithm or "md5"))
+            os.remove(cache_file)
+            cache_index.forget(cache_file)
+            return None
+        cache_index.record_verified(cache_file, hash_algorithm, expected_hash)
+    logger.info("package in cache: %s" % cache_file)
+    return cache_file
+
+
+def _download_package_file(package_name, package_url, hash_algorithm, expected_hash,
+                           progress, own_progress, cache_index):
+    """
+    Download package_url to a '.partial' file in the cache, resuming any
+    partial file a previous attempt left with an HTTP Range request, and
+    store it in the cache once it is complete and its hash matches.
+    Returns the cache file, or None if this attempt failed (in which case
+    any partial file worth resuming is kept).
+    """
+    cache_file = cache_index.download_path(package_url, hash_algorithm, expected_hash)
+    partial_file = cache_file + install_cache.PARTIAL_SUFFIX
+    resume_from = os.path.getsize(partial_file) if os.path.exists(partial_file) else 0
+
+    # download timeout so a download doesn't hang
+    download_timeout_seconds = 120
+
+    # Attempt to download the remote file
+    logger.warning("downloading %s" % package_name)
+    logger.info("  get %s\n     to %s" % (package_url, cache_file))
+    request = urllib2.Request(package_url)
+    if resume_from:
+        logger.info("  resuming after %d bytes" % resume_from)
+        request.add_header("Range", "bytes=%d-" % resume_from)
+    try:
+        package_response = urllib2.urlopen(
+            url=request, timeout=download_timeout_seconds, cafile=certifi.where())
+    except urllib2.HTTPError as err:
+        logger.warning("error: %s\n  downloading package %s" %
+                       (err, package_url))
+        if err.code == 416:
+            # the partial file doesn't fit what the server has: start over
+            os.remove(partial_file)
+        return None
+    except (urllib2.URLError, socket.error, httplib.HTTPException) as err:
+        logger.warning("error: %s\n  downloading package %s" %
+                       (err, package_url))
+        return None
+
+    # Only trust the partial file if the server is sending exactly the rest
+    # of it; otherwise (e.g. the server ignores Range) start over.
+    if resume_from:
+        content_range = package_response.headers.get("content-range", "")
+        if package_response.getcode() != 206 \
+                or not content_range.startswith("bytes %d-" % resume_from):
+            logger.info("  server did not resume, restarting download")
+            resume_from = 0
+
+    # hash the blocks as they are written rather than reading the whole file
+    # back afterwards; even without an expected hash, we need the digest to
+    # know where the archive belongs in the cache
+    if hash_algorithm is None and not expected_hash:
+        hasher = hash_algorithms.new_hasher("md5")
+    else:
+        hasher = hash_algorithms.new_hasher(hash_algorithm)
+    if hasher is not None and resume_from:
+        common.compute_hash(partial_file, hasher)
+
+    received = 0
+    complete = True
+    with file(partial_file, 'ab' if resume_from else 'wb') as cache:
+        max_block_size = DownloadProgress.block_size
+        package_size = int(
+            package_response.headers.get("content-length", 0))
+        logger.debug("response size %d" % package_size)
+        progress.start(package_url, package_size)
+        try:
+            block = package_response.read(max_block_size)
+            while block:
+                received += len(block)
+                progress.update(package_url, len(block))
+                cache.write(block)
+                if hasher is not None:
+                    hasher.update(block)
+                block = package_response.read(max_block_size)
+        except (socket.error, httplib.HTTPException) as err:
+            logger.warning("error: %s\n  downloading package %s" %
+                           (err, package_url))
+            complete = False
+    if own_progress:
+        progress.finish()
+    if package_size and received < package_size:
+        logger.warning("download of %s interrupted after %d of %d bytes" %
+                       (package_url, received, package_size))
+        complete = False
+    if not complete:
+        return None
+
+    # some failures seem to leave empty cache files... delete and retry
+    if os.path.getsize(partial_file) == 0:
+        logger.warning("download failed to write cache file")
+        os.remove(partial_file)
+        return None
+
+    # error out if MD5 doesn't match
+    if hash_algorithm is not None:
+        logger.info("verifying %s" % package_name)
+        if not hash_algorithms.verify_hash(hash_algorithm, partial_file, expected_hash,
+                                           hasher=hasher):
+            logger.warning("download error: %s mismatch for %s" %
+                           ((hash_algorithm or "md5"), cache_file))
+            os.remove(partial_file)
+            return None
+
+    if expected_hash:
+        return cache_index.store(partial_file, package_url, hash_algorithm, expected_hash)
+    elif hasher is not None:
+        return cache_index.store(partial_file, package_url,
+                                 hash_algorithm or "md5", hasher.hexdigest())
+    else:
+        # can't address it by content; at least keep it for this install
+        os.rename(partial_file, cache_file)
+        return cache_file
+
+
+def _fetch_key(archive):
+    return (archive.url, archive.hash_algorithm or 'md5', archive.hash)
+
+
+class PackagePipeline(object):
+    """
+    Fetch the archives of the named packages into the cache on up to jobs
+    threads and, as each arrives, extract it (if it's not yet installed)
+    into a staging directory in install_dir on up to extract_jobs processes,
+    so that neither downloads nor decompression are limited to one at a
+    time; meanwhile the install loop (_do_install()) installs the packages,
+    in order, as soon as each is ready. Packages that _install_binary()
+    would not fetch (unknown, misconfigured or locally installed packages)
+    are skipped here and left for _install_binary() to report, and
+    installed packages are left for _install_common(), which must compare
+    their metadata before deciding to extract them.
+
+    Look up fetched[_fetch_key(archive)] -- waiting for the fetch, if need
+    be -- for the cache file path; this re-raises, with its traceback, any
+    exception raised while fetching it, so that the install loop surfaces
+    the failure at the same point a serial install would. Check that
+    _fetch_key(archive) in fetched first: not every archive is fetched here.
+    Each fetched archive is kept from eviction, as get_package_file() does,
+    by the list of locks stored in the dict in_use under its _fetch_key().
+    Call staged(pname), in the order the packages are installed, for the
+    package's _StagedTarball (or None), then done(pname) once it's
+    installed, and close() when done with them all.
+
+    Given UnpackedTrees as unpacked, fetched archives are unpacked there
+    instead (see _UnpackedTree).
+    """
+
+    def __init__(self, packages, config_file, installed, platform, install_dir, dry_run,
+                 local_archives={}, jobs=1, extract_jobs=1, cache_index=None, unpacked=None,
+                 in_use=None):
+        self.install_dir = install_dir
+        self.cache_index = cache_index
+        self.unpacked = unpacked
+        self.in_use = {} if in_use is None else in_use
+        self.fetches = {}   # _fetch_key() -> AsyncResult of fetching it
+        self.staging = {}   # package name -> AsyncResult of staging it
+        self.staged_keys = {}   # package name -> _fetch_key() of its archive
+        self.stage_archives = {}   # _fetch_key() -> packages to stage from it
+        self.package_keys = {}  # package name -> _fetch_key() of its archive
+        self.users = {}     # _fetch_key() -> packages not yet done() with it
+        self.placed = {}    # name -> True if a directory (see staged())
+        self.progress = DownloadProgress()
+        self.fetch_pool = None
+        self.stage_pool = None
+
+        archives = []
+        local = []
+        for pname in packages:
+            stage = not dry_run and pname not in installed.dependencies
+            if pname in local_archives:
+                if stage:
+                    local.append((pname, local_archives[pname]))
+                continue
+            if pname not in config_file.installables:
+                continue
+            archive = _configured_archive(config_file.installables[pname], platform, installed)
+            if archive is None:
+                continue
+            key = _fetch_key(archive)
+            self.package_keys[pname] = key
+            self.users.setdefault(key, set()).add(pname)
+            if key not in self.stage_archives:
+                self.stage_archives[key] = []
+                archives.append((config_file.installables[pname].name, archive))
+            if stage:
+                self.stage_archives[key].append((pname, archive))
+                self.staged_keys[pname] = key
+
+        candidates = len(local) + len(self.staged_keys)
+        if extract_jobs > 1 and candidates > 1:
+            logger.info("extracting %d packages using %d jobs" %
+                        (candidates, min(extract_jobs, candidates)))
+            self.stage_pool = multiprocessing.Pool(min(extract_jobs, candidates))
+        for pname, archive_path in local:
+            self.__stage(pname, archive_path, None)
+        if archives:
+            jobs = max(1, min(jobs, len(archives)))
+            logger.info("fetching %d packages using %d jobs" % (len(archives), jobs))
+            self.fetch_pool = ThreadPool(jobs)
+            for package_name, archive in archives:
+                self.in_use.setdefault(_fetch_key(archive), [])
+                self.fetches[_fetch_key(archive)] = \
+                    self.fetch_pool.apply_async(self.__fetch, (package_name, archive))
+
+    def __fetch(self, package_name, archive):
+        # runs in a fetch_pool thread
+        key = _fetch_key(archive)
+        locks = self.in_use[key]
+        try:
+            result = get_package_file(package_name, archive.url,
+                                      hash_algorithm=(archive.hash_algorithm or 'md5'),
+                                      expected_hash=archive.hash,
+                                      progress=self.progress, cache_index=self.cache_index,
+                                      in_use=locks)
+        except Exception:
+            # for __getitem__() to re-raise in the install loop
+            result = sys.exc_info()
+        if isinstance(result, basestring):
+            for pname, archive in self.stage_archives[key]:
+                self.__stage(pname, result, archive)
+        return result
+
+    def __stage(self, pname, archive_path, archive):
+        if self.stage_pool is None:
+            return
+        tree_dir, hardlink = None, False
+        if archive is not None and self.unpacked is not None:
+            tree_dir, hardlink = self.unpacked.tree_dir(archive), self.unpacked.hardlink
+        self.staging[pname] = self.stage_pool.apply_async(
+            _stage_package_file, ((pname, archive_path, self.install_dir, tree_dir, hardlink),))
+
+    def __contains__(self, key):
+        return key in self.fetches
+
+    def __getitem__(self, key):
+        result = self.fetches[key].get()
+        if isinstance(result, tuple):
+            raise result[0], result[1], result[2]
+        return result
+
+    def staged(self, pname):
+        """
+        Return the _StagedTarball for pname, or None if it wasn't staged, once
+        it's ready. Its batch_conflicts list the members that would conflict
+        with those of a package staged earlier.
+        """
+        if pname in self.staged_keys:
+            # staging begins once the fetch is done
+            self.fetches[self.staged_keys[pname]].wait()
+        if pname not in self.staging:
+            return None
+        pname, staged = self.staging.pop(pname).get()
+        if staged is not None:
+            # Work out the conflicts with packages staged earlier from
+            # their combined member list, in the order they are placed.
+            staged.batch_conflicts = [name for name in staged.files
+                                      if self.placed.get(name) is False]
+            for name in staged.files:
+                self.placed.setdefault(name, name in staged.dir_modes)
+            # (discarded by close(), once it's installed)
+            self.staging[pname] = staged
+        return staged
+
+    def done(self, pname):
+        """
+        Note that pname has been installed (or skipped): once that's so of
+        every package using an archive, release the locks keeping it from
+        eviction.
+        """
+        key = self.package_keys.pop(pname, None)
+        if key is None:
+            return
+        users = self.users[key]
+        users.discard(pname)
+        if not users:
+            # (so that the fetch can't take a lock after they're released)
+            self.fetches[key].wait()
+            _release_all([self.in_use[key]])
+
+    def close(self):
+        """
+        Wait for outstanding work, then discard whatever is still staged.
+        """
+        try:
+            if self.fetch_pool is not None:
+                self.fetch_pool.close()
+                self.fetch_pool.join()
+            if self.stage_pool is not None:
+                self.stage_pool.close()
+                self.stage_pool.join()
+        finally:
+            self.progress.finish()
+            for staging in self.staging.itervalues():
+                staged = staging if isinstance(staging, _StagedTarball) else staging.get()[1]
+                if staged is not None:
+                    staged.discard()
+            self.staging.clear()
+
+
+def _stage_package_file(candidate):
+    # runs in a PackagePipeline worker process
+    pname, archive_path, install_dir, tree_dir, hardlink = candidate
+    try:
+        return pname, _stage_tarball(archive_path, install_dir,
+                                     metadata_file_name=configfile.PACKAGE_METADATA_FILE,
+                                     exclude=[configfile.PACKAGE_METADATA_FILE],
+                                     tree_dir=tree_dir, hardlink=hardlink)
+    except Exception as err:
+        logger.debug("could not stage %s: %s" % (archive_path, err))
+        return pname, None
+
+
+# the index of installed files is saved next to the installed-packages.xml
+# file, with this in place of its extension
+INSTALLED_INDEX_SUFFIX = "-files.json"
+INSTALLED_INDEX_VERSION = 2
+
+
+class InstalledFileIndex(object):
+    """
+    Which files in the install directory belong to which installed package,
+    built from the manifests in installed.dependencies so that conflicts
+    can be found, and --what-installed answered, with dict lookups rather
+    than filesystem calls or searches of every manifest.
+
+    The index follows changes to installed.dependencies: whenever it is
+    consulted, packages installed or uninstalled since are (re)indexed.
+    save() writes it next to the installed file, stamped with a digest of
+    that file's content, so that it can be reused until the installed file
+    changes. Use InstalledFileIndex.of(installed) to get the (one) index
+    for a Dependencies object.
+    """
+
+    @classmethod
+    def of(cls, installed):
+        # kept on the Dependencies object itself, so that it goes with it
+        if installed.file_index is None:
+            installed.file_index = cls(installed)
+        return installed.file_index
+
+    def __init__(self, installed):
+        self.installed = installed
+        self.path = os.path.splitext(installed.path)[0] + INSTALLED_INDEX_SUFFIX
+        # package name -> (its entry in installed.dependencies, its manifest)
+        self.indexed = {}
+        self.owners = {}   # file -> name of the package that installed it
+        self.dirs = {}     # directory -> number of owned files under it
+        self.__load()
+
+    def __load(self):
+        stamp = _file_digest(self.installed.path)
+        if stamp is None:
+            return
+        try:
+            with open(self.path, 'rb') as index_file:
+                saved = json.load(index_file)
+        except (IOError, ValueError):
+            return
+        if saved.get('version') != INSTALLED_INDEX_VERSION or saved.get('installed') != stamp:
+            logger.debug("rebuilding out of date %s" % self.path)
+            return
+        # The installed file hasn't changed since the index was saved, so
+        # (provided nobody has modified installed.dependencies yet) the
+        # saved owners describe its packages.
+        self.owners = saved['owners']
+        for name, package in self.installed.dependencies.iteritems():
+            self.indexed[name] = (package, None)
+        for filename in self.owners:
+            for parent in _parents(filename):
+                self.dirs[parent] = self.dirs.get(parent, 0) + 1
+
+    def save(self):
+        """
+        Save the index next to the installed file; call after saving that.
+        """
+        self.refresh()
+        stamp = _file_digest(self.installed.path)
+        if stamp is None:
+            return
+        data = json.dumps(dict(version=INSTALLED_INDEX_VERSION, installed=stamp,
+                               owners=self.owners))
+        try:
+            common.atomic_write(self.path, data)
+        except (IOError, OSError) as err:
+            # the index is only an optimization
+            logger.warning("cannot write %s: %s" % (self.path, err))
+
+    def refresh(self):
+        dependencies = self.installed.dependencies
+        for name, (package, manifest) in self.indexed.items():
+            if dependencies.get(name) is not package:
+                self.__remove(name, manifest)
+        for name, package in dependencies.iteritems():
+            if self.indexed.get(name, (None, None))[0] is not package:
+                self.__add(name, package)
+
+    def __add(self, name, package):
+        # keep our own copy of the manifest: uninstall() may consume the
+        # package's entry
+        manifest = [_normalized_member(filename) for filename in package.get('manifest') or []]
+        self.indexed[name] = (package, manifest)
+        for filename in manifest:
+            self.owners[filename] = name
+            for parent in _parents(filename):
+                self.dirs[parent] = self.dirs.get(parent, 0) + 1
+
+    def __remove(self, name, manifest):
+        del self.indexed[name]
+        if manifest is None:
+            # indexed by __load(): the owners are all we know
+            manifest = [filename for filename, owner in self.owners.iteritems()
+                        if owner == name]
+        for filename in manifest:
+            if self.owners.get(filename) == name:
+                del self.owners[filename]
+            for parent in _parents(filename):
+                self.dirs[parent] -= 1
+                if not self.dirs[parent]:
+                    del self.dirs[parent]
+
+    def owner(self, filename):
+        """
+        Return the name of the package that installed filename, or None.
+        """
+        self.refresh()
+        return self.owners.get(_normalized_member(filename))
+
+    def conflicts(self, install_dir, members):
+        """
+        Return those of the archive members that would overwrite a file (not
+        a directory) already in install_dir. Installed files are found in
+        the index; only the rest are looked for in the filesystem, listing
+        each of their directories once.
+        """
+        self.refresh()
+        conflicts = []
+        unowned = []
+        for member in members:
+            filename = _normalized_member(member)
+            if filename in self.dirs:
+                # a directory containing installed files
+                continue
+            if filename in self.owners:
+                # an installed file, unless the manifest is out of date (or
+                # it's an empty directory): make sure
+                if _is_file(install_dir, filename):
+                    conflicts.append(member)
             else:
-                logger.info("package in cache: %s" % cache_file)
-        else:
-            # download timeout so a download doesn't hang
-            download_timeout_seconds = 120
+                unowned.append(member)
+        conflicts.extend(_existing_files(install_dir, unowned))
+        # report them in archive order
+        conflicts = set(conflicts)
+        return [member for member in members if member in conflicts]
+
+
+def _file_digest(path):
+    # (size and mtime could miss a change made within the mtime resolution)
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def _normalized_member(member):
+    # zip archives name directories with a trailing slash
+    return member.rstrip('/')
+
+
+def _parents(filename):
+    parent = os.path.dirname(filename)
+    while parent:
+        yield parent
+        parent = os.path.dirname(parent)
+
+
+def _is_file(install_dir, filename):
+    path = os.path.join(install_dir, filename)
+    return os.path.exists(path) and not os.path.isdir(path)
+
 
-            # Attempt to download the remote file
-            logger.warning("downloading %s" % package_name)
-            logger.info("  get %s\n     to %s" % (package_url, cache_file))
+def _existing_files(install_dir, members):
+    """
+    Return those of members (not directories) that exist in install_dir,
+    listing each directory just once instead of checking every member.
+    Names are matched ignoring case, as a case-insensitive filesystem (such
+    as HFS+ or APFS, by default) would; _is_file() then confirms each match,
+    so that a case-sensitive one still tells "Foo" from "foo".
+    """
+    listings = {}
+    existing = []
+    for member in members:
+        parent, basename = os.path.split(_normalized_member(member))
+        if parent not in listings:
             try:
-                package_response = urllib2.urlopen(
-                    url=package_url, timeout=download_timeout_seconds, cafile=certifi.where())
-            except urllib2.URLError as err:
-                logger.warning("error: %s\n  downloading package %s" %
-                               (err, package_url))
-                package_response = None
-                cache_file = None
-
-            if package_response is not None:
-                with file(cache_file, 'wb') as cache:
-                    # if this is changed, also change 'MB' in progress message
-                    # below
-                    max_block_size = 1024 * 1024
-                    package_size = int(
-                        package_response.headers.get("content-length", 0))
-                    package_blocks = package_size / max_block_size if package_size else 0
-                    if package_blocks < (package_size * max_block_size):
-                        package_blocks += 1
-                    logger.debug("response size %d blocks %d" %
-                                 (package_size, package_blocks))
-                    blocks_recvd = 0
-                    block = package_response.read(max_block_size)
-                    while block:
-                        blocks_recvd += 1
-                        if logger.getEffectiveLevel() <= logging.INFO:
-                            # use CR and trailing comma to rewrite the same
-                            # line each time for progress
-                            if package_blocks:
-                                print("%d MB / %d MB (%d%%)\r" % (blocks_recvd, package_blocks,
-                                                                  int(100 * blocks_recvd / package_blocks)), end=' ')
-                                sys.stdout.flush()
-                            else:
-                                print("%d\r" % blocks_recvd, end=' ')
-                                sys.stdout.flush()
-                        cache.write(block)
-                        block = package_response.read(max_block_size)
-                if logger.getEffectiveLevel() <= logging.INFO:
-                    print("")  # get a new line following progress message
-                    sys.stdout.flush()
-                # some failures seem to leave empty cache files... delete and
-                # retry
-                if os.path.exists(cache_file) and os.path.getsize(cache_file) == 0:
-                    logger.warning("download failed to write cache file")
-                    os.remove(cache_file)
-                    cache_file = None
-
-        # error out if MD5 doesn't match
-        if cache_file is not None \
-                and hash_algorithm is not None:
-            logger.info("verifying %s" % package_name)
-            if not hash_algorithms.verify_hash(hash_algorithm, cache_file, expected_hash):
-                logger.warning("download error: %s mismatch for %s" %
-                               ((hash_algorithm or "md5"), cache_file))
-                os.remove(cache_file)
-                cache_file = None
-        if cache_file is None:
-            download_retries -= 1
-            if download_retries > 0:
-                logger.warning("Retrying download")
+                listings[parent] = set(entry.lower() for entry in
+                                       os.listdir(os.path.join(install_dir, parent)))
+            except OSError:
+                listings[parent] = set()
+        if basename.lower() in listings[parent] \
+                and _is_file(install_dir, _normalized_member(member)):
+            existing.append(member)
+    return existing
 
-    return cache_file
+
+def _check_conflicts(install_dir, members, file_index=None):
+    """
+    Raise AutobuildError if any of the archive members would overwrite a
+    file already in install_dir.
+    """
+    if file_index is not None:
+        conflicts = file_index.conflicts(install_dir, members)
+    else:
+        conflicts = _existing_files(install_dir, members)
+    if conflicts:
+        raise common.AutobuildError(
+            "conflicting files:\n  " + '\n  '.join(conflicts))
 
 
-def _install_package(archive_path, install_dir, exclude=[]):
+def _install_package(archive_path, install_dir, exclude=[], file_index=None):
     """
     Install the archive at the provided path into the given installation directory.  Returns the
     list of files that were installed.
+    Pass an InstalledFileIndex as file_index to speed up the check for
+    conflicts with files already installed.
     """
     if not os.path.exists(archive_path):
         logger.error("cannot extract non-existing package: %s" % archive_path)
         return False
     logger.warning("extracting from %s" % os.path.basename(archive_path))
     sys.stdout.flush()  # so that the above will appear during uncompressing very large archives
-    if tarfile.is_tarfile(archive_path):
+    if decompressors.is_tarball(archive_path):
         sys.stdout.flush() # so that the above will appear during uncompressing very large archives
-        return __extract_tar_file(archive_path, install_dir, exclude=exclude)
+        staged = _StagedTarball(archive_path, install_dir, exclude=exclude)
+        try:
+            return staged.install(file_index=file_index)
+        finally:
+            staged.discard()
     elif zipfile.is_zipfile(archive_path):
         sys.stdout.flush() # so that the above will appear during uncompressing very large archives
-        return __extract_zip_archive(archive_path, install_dir, exclude=exclude)
+        return __extract_zip_archive(archive_path, install_dir, exclude=exclude,
+                                     file_index=file_index)
     elif rarfile.is_rarfile(archive_path):
         sys.stdout.flush() # so that the above will appear during uncompressing very large archives
-        return __extract_rar_archive(archive_path, install_dir, exclude=exclude)
+        return __extract_rar_archive(archive_path, install_dir, exclude=exclude,
+                                     file_index=file_index)
     else:
-        logger.error(
-            "package %s is not archived in a supported format" % archive_path)
+        format = decompressors.compression_format(archive_path)
+        if format is not None:
+            logger.error("package %s is compressed with %s: install %s to extract it" %
+                         (archive_path, format, " or ".join(decompressors.programs(format))))
+        else:
+            logger.error(
+                "package %s is not archived in a supported format" % archive_path)
         return False
 
 
@@ -364,13 +978,16 @@ def extract_metadata_from_package(archive_path, metadata_file_name):
         logger.debug("extracting metadata from %s" %
                      os.path.basename(archive_path))
         sys.stdout.flush() # so that the above will appear during uncompressing very large archives
-        if tarfile.is_tarfile(archive_path):
-            tar = tarfile.open(archive_path, 'r')
-            try:
-                metadata_file = tar.extractfile(metadata_file_name)
-            except KeyError as err:
-                metadata_file = None
-                pass  # returning None will indicate that it was not there
+        if decompressors.is_tarball(archive_path):
+            # Read the tarball as a stream, stopping at the metadata: random
+            # access would decompress it once to find the member and again
+            # to read it.
+            with decompressors.open_tarball(archive_path) as tar:
+                for member in tar:
+                    if member.name == metadata_file_name:
+                        metadata_file = StringIO(tar.extractfile(member).read())
+                        break
+                # not finding it returns None to indicate that it was not there
         elif zipfile.is_zipfile(archive_path):
             try:
                 zip = zipfile.ZipFile(archive_path, 'r')
@@ -391,57 +1008,400 @@ def extract_metadata_from_package(archive_path, metadata_file_name):
     return metadata_file
 
 
-def __extract_tar_file(cachename, install_dir, exclude=[]):
-    # Attempt to extract the package from the install cache
-    tar = tarfile.open(cachename, 'r')
-    extract = [member for member in tar.getmembers()
-               if member.name not in exclude]
-    conflicts = [member.name for member in extract
-                 if os.path.exists(os.path.join(install_dir, member.name))
-                 and not os.path.isdir(os.path.join(install_dir, member.name))]
-    if conflicts:
-        raise common.AutobuildError(
-            "conflicting files:\n  " + '\n  '.join(conflicts))
-    tar.extractall(path=install_dir, members=extract)
-    return [member.name for member in extract]
-
-
-def __extract_zip_archive(cachename, install_dir, exclude=[]):
+def __extract_zip_archive(cachename, install_dir, exclude=[], file_index=None):
     zip_archive = zipfile.ZipFile(cachename, 'r')
     extract = [member for member in zip_archive.namelist()
                if member not in exclude]
-    conflicts = [member for member in extract
-                 if os.path.exists(os.path.join(install_dir, member))
-                 and not os.path.isdir(os.path.join(install_dir, member))]
-    if conflicts:
-        raise common.AutobuildError(
-            "conflicting files:\n  " + '\n  '.join(conflicts))
+    _check_conflicts(install_dir, extract, file_index)
     zip_archive.extractall(path=install_dir, members=extract)
     return extract
 
-def __extract_rar_archive(cachename, install_dir, exclude=[]):
+def __extract_rar_archive(cachename, install_dir, exclude=[], file_index=None):
     rf = rarfile.RarFile(cachename)
     for f in rf.infolist():
         #print(f.filename, f.file_size)
         if f.filename == 'sample.txt':
             print(rf.read(f))
     extract = [member for member in rf.namelist() if member not in exclude]
-    conflicts = [member for member in extract 
-                 if os.path.exists(os.path.join(install_dir, member))
-                 and not os.path.isdir(os.path.join(install_dir, member))]
+    _check_conflicts(install_dir, extract, file_index)
     logger.debug("READING ARCHIVE INFO WAS SUCCESSFUL")
     rf.extractall(install_dir,extract) # this dies on some strangely made pagckages. unknown why yet.
     logger.debug("EXTRACTING ARCHIVE INFO WAS SUCCESSFUL")
     return extract
 
-def do_install(packages, config_file, installed, platform, install_dir, dry_run, local_archives=[]):
+class _StagedTarball(object):
+    """
+    The contents of a tarball, extracted in a single streaming pass into a
+    staging directory inside install_dir, from which install() moves them
+    into place. The metadata_file_name member, if any, is also kept in
+    memory.
+
+    When upgrading a package, pass as current a dict mapping the files the
+    installed version installed to their (size, mtime): members that match
+    are left unchanged rather than staged (see match_installed()).
+
+    Attributes:
+        files - the names of the members staged, in archive order
+        metadata - the content of the metadata file, or None
+        batch_conflicts - members known to conflict with files installed by
+                          other packages (see PackagePipeline.staged())
+        unchanged - members already installed, to be left in place
+    """
+
+    def __init__(self, archive_path, install_dir, metadata_file_name=None, exclude=[],
+                 current={}):
+        self.install_dir = install_dir
+        self.files = []
+        self.metadata = None
+        self.dir_modes = {}
+        self.batch_conflicts = []
+        self.unchanged = set()
+        if not os.path.exists(install_dir):
+            logger.debug("creating " + install_dir)
+            os.makedirs(install_dir)
+        # inside install_dir so that moving files into place is just a rename
+        self.staging_dir = tempfile.mkdtemp(prefix=".autobuild-staging-", dir=install_dir)
+        try:
+            with decompressors.open_tarball(archive_path) as tar:
+                for member in tar:
+                    if member.name == metadata_file_name:
+                        self.metadata = tar.extractfile(member).read()
+                    if member.name in exclude:
+                        continue
+                    self.files.append(member.name)
+                    if member.isdir():
+                        # created by install(); staging only needs the files
+                        self.dir_modes[member.name] = member.mode
+                    elif member.isfile() and \
+                            current.get(member.name) == (member.size, member.mtime):
+                        self.unchanged.add(member.name)
+                    elif member.islnk() and member.linkname in self.unchanged:
+                        # its target was left in place rather than staged (and
+                        # the stream can't go back for it): link to that
+                        staged = os.path.join(self.staging_dir, member.name)
+                        install_cache._makedirs(os.path.dirname(staged))
+                        install_cache._link_or_copy(os.path.join(install_dir, member.linkname),
+                                                    staged)
+                    else:
+                        tar.extract(member, path=self.staging_dir)
+        except:
+            self.discard()
+            raise
+
+    @property
+    def metadata_file(self):
+        return StringIO(self.metadata) if self.metadata is not None else None
+
+    def match_installed(self, current):
+        """
+        Having already staged the files, note as unchanged those that match
+        the (size, mtime) given for them in current, as for __init__().
+        """
+        for name in self.files:
+            if name in current and name not in self.dir_modes:
+                try:
+                    info = os.lstat(os.path.join(self.staging_dir, name))
+                except OSError:
+                    continue
+                if stat.S_ISREG(info.st_mode) and \
+                        current[name] == (info.st_size, info.st_mtime):
+                    self.unchanged.add(name)
+
+    def install(self, file_index=None):
+        """
+        Move the staged files (other than those unchanged) into
+        install_dir, unless any conflicts with a file already there.
+        Returns the list of files installed.
+        """
+        if self.batch_conflicts:
+            raise common.AutobuildError(
+                "conflicting files:\n  " + '\n  '.join(self.batch_conflicts))
+        _check_conflicts(self.install_dir,
+                         [name for name in self.files if name not in self.unchanged], file_index)
+        for name in self.files:
+            if name in self.unchanged:
+                continue
+            target = os.path.join(self.install_dir, name)
+            if name in self.dir_modes:
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                    os.chmod(target, self.dir_modes[name])
+            else:
+                parent = os.path.dirname(target)
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                self._place(name, target)
+        return self.files
+
+    def _place(self, name, target):
+        os.rename(os.path.join(self.staging_dir, name), target)
+
+    def discard(self):
+        """
+        Remove the staging directory and anything still in it.
+        """
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+
+# inside an unpacked tree (see install_cache), the archive members are kept
+# in this directory, alongside this list of its contents
+UNPACKED_FILES = "files"
+UNPACKED_CONTENTS = "contents.json"
+
+
+class _UnpackedTree(_StagedTarball):
+    """
+    The contents of a tarball as unpacked into tree_dir in the install
+    cache (or elsewhere: see UnpackedTrees), which is done just once for
+    each archive (see _unpack_tarball()). install() clones the files into
+    install_dir, using reflinks where the filesystem allows, so that nothing
+    is decompressed, and otherwise copies or (only if hardlink) hard links.
+    A hard-linked file shares the read-only mode of the unpacked one, and
+    so must never be modified in place.
+    """
+
+    def __init__(self, archive_path, install_dir, tree_dir, metadata_file_name=None, exclude=[],
+                 hardlink=False, current={}):
+        self.install_dir = install_dir
+        self.hardlink = hardlink
+        self.batch_conflicts = []
+        self.unchanged = set()
+        self.staging_dir = os.path.join(tree_dir, UNPACKED_FILES)
+        contents = _unpack_tarball(archive_path, tree_dir)
+        self.files = [name for name in contents['files'] if name not in exclude]
+        self.dir_modes = dict((name, mode) for name, mode in contents['dir_modes'].iteritems()
+                              if name not in exclude)
+        self.modes = contents['modes']
+        self.metadata = None
+        if metadata_file_name in contents['modes']:
+            with open(os.path.join(self.staging_dir, metadata_file_name), 'rb') as metadata_file:
+                self.metadata = metadata_file.read()
+        self.match_installed(current)
+
+    def _place(self, name, target):
+        install_cache.clone_file(os.path.join(self.staging_dir, name), target,
+                                 mode=self.modes.get(name), hardlink=self.hardlink)
+
+    def discard(self):
+        # the tree belongs to the cache
+        pass
+
+
+class _StagedZip(object):
+    """
+    A zip archive to be installed into install_dir in place of an older
+    version. Nothing is staged: the central directory gives the size and
+    CRC-32 of each member, which is enough for match_installed() to tell
+    which files are already installed, and install() extracts the rest.
+    Has the attributes of a _StagedTarball that install() uses.
+    """
+
+    def __init__(self, archive_path, install_dir, exclude=[]):
+        self.install_dir = install_dir
+        self.zip = zipfile.ZipFile(archive_path, 'r')
+        self.files = [name for name in self.zip.namelist() if name not in exclude]
+        self.batch_conflicts = []
+        self.unchanged = set()
+
+    def match_installed(self, current):
+        """
+        Note as unchanged the members whose size matches that given for
+        them in current and whose CRC-32 matches that of the installed file.
+        """
+        files = set(self.files)
+        for info in self.zip.infolist():
+            name = info.filename
+            if name in files and name in current and current[name][0] == info.file_size:
+                if _file_crc32(os.path.join(self.install_dir, name)) == info.CRC:
+                    self.unchanged.add(name)
+
+    def install(self, file_index=None):
+        """
+        Extract the members (other than those unchanged) into install_dir,
+        unless any conflicts with a file already there. Returns the list of
+        files installed.
+        """
+        changed = [name for name in self.files if name not in self.unchanged]
+        _check_conflicts(self.install_dir, changed, file_index)
+        self.zip.extractall(path=self.install_dir, members=changed)
+        return self.files
+
+    def discard(self):
+        self.zip.close()
+
+
+def _file_crc32(pathname):
+    """
+    Return the CRC-32 of the file at pathname, as a zip archive records it.
+    """
+    crc = 0
+    with open(pathname, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            crc = zlib.crc32(block, crc)
+    return crc & 0xffffffff
+
+
+def _unpack_tarball(archive_path, tree_dir):
+    """
+    Extract the tarball at archive_path into tree_dir, unless that has been
+    done already, and return a dict describing its contents: the member
+    names (files) in archive order, and the modes of the directories
+    (dir_modes) and of the other members (modes). The extracted files are
+    made read-only, since installs may link to them.
+    """
+    contents_path = os.path.join(tree_dir, UNPACKED_CONTENTS)
+    parent = os.path.dirname(tree_dir)
+    install_cache._makedirs(parent)
+    lock = install_cache.FileLock(tree_dir + install_cache.LOCK_SUFFIX)
+    lock.acquire()
+    try:
+        if not os.path.exists(contents_path):
+            logger.warning("unpacking %s" % os.path.basename(archive_path))
+            if os.path.exists(tree_dir):
+                # left incomplete by an older process
+                shutil.rmtree(tree_dir)
+            work_dir = tempfile.mkdtemp(prefix=os.path.basename(tree_dir) + "-", dir=parent)
+            try:
+                files_dir = os.path.join(work_dir, UNPACKED_FILES)
+                contents = dict(files=[], dir_modes={}, modes={})
+                with decompressors.open_tarball(archive_path) as tar:
+                    for member in tar:
+                        contents['files'].append(member.name)
+                        if member.isdir():
+                            contents['dir_modes'][member.name] = member.mode
+                            continue
+                        contents['modes'][member.name] = member.mode
+                        tar.extract(member, path=files_dir)
+                        if not member.issym():
+                            os.chmod(os.path.join(files_dir, member.name), member.mode & ~0o222)
+                with open(os.path.join(work_dir, UNPACKED_CONTENTS), 'wb') as contents_file:
+                    json.dump(contents, contents_file)
+                os.rename(work_dir, tree_dir)
+            except:
+                shutil.rmtree(work_dir, ignore_errors=True)
+                raise
+        with open(contents_path, 'rb') as contents_file:
+            contents = json.load(contents_file)
+    finally:
+        lock.release(remove=True)
+    # (json makes unicode of the names that tarfile gives as str)
+    encode = lambda name: name.encode('utf-8')
+    return dict(files=[encode(name) for name in contents['files']],
+                dir_modes=dict((encode(name), mode) for name, mode in contents['dir_modes'].iteritems()),
+                modes=dict((encode(name), mode) for name, mode in contents['modes'].iteritems()))
+
+
+def _stage_tarball(archive_path, install_dir, metadata_file_name=None, exclude=[],
+                   tree_dir=None, hardlink=False, current={}):
+    """
+    Return a _StagedTarball for archive_path -- an _UnpackedTree if given
+    the tree_dir to unpack it to -- or None if it isn't a tarball (so that
+    the caller should fall back to _install_package()).
+    """
+    if not os.path.exists(archive_path) or not decompressors.is_tarball(archive_path):
+        return None
+    if tree_dir is not None:
+        return _UnpackedTree(archive_path, install_dir, tree_dir,
+                             metadata_file_name=metadata_file_name, exclude=exclude,
+                             hardlink=hardlink, current=current)
+    logger.warning("extracting from %s" % os.path.basename(archive_path))
+    sys.stdout.flush()  # so that the above will appear during uncompressing very large archives
+    return _StagedTarball(archive_path, install_dir,
+                          metadata_file_name=metadata_file_name, exclude=exclude,
+                          current=current)
+
+
+class UnpackedTrees(object):
+    """
+    Where archives are unpacked to be installed from (see _UnpackedTree):
+    the unpacked trees in the install cache, kept from one run to the
+    next, or those under root, a directory used for the duration of a run
+    that installs the same archives into several install dirs.
+
+    Attributes:
+        hardlink - whether files may be installed as hard links to the tree
+                   (rather than copied, where they can't be reflinked)
+    """
+
+    def __init__(self, cache_index=None, root=None, hardlink=False):
+        self.cache_index = cache_index
+        self.root = root
+        self.hardlink = hardlink
+
+    def tree_dir(self, archive):
+        """
+        Return where the configured archive should be unpacked, or None if
+        it can't be: only an archive with a known hash can be.
+        """
+        if not archive.hash:
+            return None
+        hash_algorithm = archive.hash_algorithm or 'md5'
+        if self.root is not None:
+            return os.path.join(self.root, hash_algorithm, archive.hash)
+        return self.cache_index.unpacked_path(hash_algorithm, archive.hash)
+
+
+def _remove_unpacked(root):
+    """
+    Remove the unpacked trees under root, read-only files and all.
+    """
+    def make_writable(function, path, excinfo):
+        # (Windows won't remove a read-only file)
+        try:
+            os.chmod(path, stat.S_IWRITE | stat.S_IREAD)
+            function(path)
+        except OSError:
+            pass
+    shutil.rmtree(root, onerror=make_writable)
+
+
+def do_install(packages, config_file, installed, platform, install_dir, dry_run, local_archives=[],
+               jobs=1, cache_index=None, extract_jobs=1, unpacked=None):
     """
     Install the specified list of packages. By default this will download the
     packages to the local cache, extract the contents of those
     archives to the install dir, and update the installed_file config.  
     For packages listed in the local_archives, the local archive will be
     installed in place of the configured one.
+    With more than one job of either kind, up to jobs archives are
+    downloaded concurrently, and up to extract_jobs new packages extracted
+    concurrently as their archives arrive (see PackagePipeline); the installs
+    themselves are still completed in order, each as soon as it's ready,
+    with the same result as installing one by one. Otherwise each package is
+    fetched and installed in turn.
+    Given UnpackedTrees as unpacked, archives are unpacked there, once, and
+    installed from there (see _UnpackedTree).
+    Each fetched archive is kept from eviction from the cache until its
+    package is installed -- or, if a PackagePipeline fetched it for several
+    packages, until all of them are.
     """
+    in_use = {}
+    pipeline = None
+    try:
+        if jobs > 1 or extract_jobs > 1:
+            pipeline = PackagePipeline(packages, config_file, installed, platform, install_dir,
+                                       dry_run, local_archives=local_archives, jobs=jobs,
+                                       extract_jobs=extract_jobs, cache_index=cache_index,
+                                       unpacked=unpacked, in_use=in_use)
+        return _do_install(packages, config_file, installed, platform, install_dir, dry_run,
+                           local_archives, pipeline, cache_index,
+                           InstalledFileIndex.of(installed), unpacked, in_use)
+    finally:
+        if pipeline is not None:
+            pipeline.close()
+        _release_all(in_use.itervalues())
+
+
+def _release_all(lock_lists):
+    for locks in lock_lists:
+        for lock in locks:
+            lock.release()
+        del locks[:]
+
+
+def _do_install(packages, config_file, installed, platform, install_dir, dry_run,
+                local_archives, pipeline, cache_index, file_index, unpacked=None,
+                in_use={}):
     # Decide whether to install a local package or download a tarball
     installed_pkgs = []
     for pname in packages:
@@ -452,21 +1412,29 @@ def do_install(packages, config_file, installed, platform, install_dir, dry_run,
             raise InstallError('unknown package: %s' % pname)
 
         logger.warning("checking %s" % pname)
+        staged = pipeline.staged(pname) if pipeline is not None else None
 
         # Existing tarball install, or new package install of either kind
         if pname in local_archives:
-            if _install_local(pname, platform, package, local_archives[pname], install_dir, installed, dry_run):
+            if _install_local(pname, platform, package, local_archives[pname], install_dir, installed, dry_run,
+                              staged=staged, file_index=file_index):
                 installed_pkgs.append(pname)
         else:
-            if _install_binary(pname, platform, package, config_file, install_dir, installed, dry_run):
+            if _install_binary(pname, platform, package, config_file, install_dir, installed, dry_run,
+                               fetched=pipeline or {}, cache_index=cache_index, staged=staged,
+                               file_index=file_index, unpacked=unpacked, in_use=in_use):
                 installed_pkgs.append(pname)
+            if pipeline is not None:
+                pipeline.done(pname)
     return installed_pkgs
 
 
-def _install_local(configured_name, platform, package, package_path, install_dir, installed, dry_run):
+def _install_local(configured_name, platform, package, package_path, install_dir, installed, dry_run,
+                   staged=None, file_index=None):
     logger.warning("installing %s from local archive" % package.name)
     metadata, files = _install_common(
-        configured_name, platform, package, package_path, install_dir, installed, dry_run)
+        configured_name, platform, package, package_path, install_dir, installed, dry_run,
+        staged=staged, file_index=file_index)
 
     if metadata:
         installed_package = package.copy()
@@ -492,7 +1460,40 @@ def _install_local(configured_name, platform, package, package_path, install_dir
         return False
 
 
-def _install_binary(configured_name, platform, package, config_file, install_dir, installed, dry_run):
+def _configured_archive(package, platform, installed):
+    """
+    Return the ArchiveDescription that _install_binary() would fetch for
+    package, or None if it would fetch nothing. Problems are not reported
+    here; _install_binary() does that.
+    """
+    req_plat = package.get_platform(platform)
+    if not req_plat or not req_plat.archive or not req_plat.archive.url:
+        return None
+    installed_pkg = installed.dependencies.get(package.name)
+    if installed_pkg and installed_pkg['install_type'] == 'local':
+        return None
+    if _archive_installed(req_plat.archive, installed_pkg):
+        return None
+    return req_plat.archive
+
+
+def _archive_installed(archive, installed_pkg):
+    """
+    Is the configured archive the one recorded as installed_pkg (an entry in
+    installed.dependencies, or None)? If so there is nothing to do, and no
+    need to fetch, hash or open the archive to find that out.
+    """
+    if not installed_pkg or installed_pkg.get('install_type') != 'package':
+        return False
+    if not archive.hash or not installed_pkg.get('archive'):
+        # without a configured hash, only the archive itself can say
+        return False
+    return archive == installed_pkg['archive']
+
+
+def _install_binary(configured_name, platform, package, config_file, install_dir, installed, dry_run,
+                    fetched={}, cache_index=None, staged=None, file_index=None,
+                    unpacked=None, in_use={}):
     # Check that we have a platform-specific or common url to use.
     req_plat = package.get_platform(platform)
     package_name = getattr(package, 'name', '(undefined)')
@@ -510,26 +1511,58 @@ def _install_binary(configured_name, platform, package, config_file, install_dir
     # Is this package already installed?
     installed_pkg = installed.dependencies.get(package.name)
 
-    # Rely on ArchiveDescription's equality-comparison method to discover
-    # whether the installed ArchiveDescription matches the requested one. This
-    # test also handles the case when inst_plat.archive is None (not yet
-    # installed).
     if installed_pkg and installed_pkg['install_type'] == 'local':
         logger.warning("""skipping %s package because it was installed locally from %s
   To allow new installation, run 
   autobuild uninstall %s""" % (package_name, installed_pkg['archive']['url'], package_name))
         return False
 
+    # Rely on ArchiveDescription's equality-comparison method to discover
+    # whether the installed ArchiveDescription matches the requested one,
+    # before touching the archive at all.
+    if _archive_installed(archive, installed_pkg):
+        logger.info("%s is already installed" % package_name)
+        return False
+
     # get the package file in the cache, downloading if needed, and verify the hash
-    # (raises InstallError on failure, so no check is needed)
-    cachefile = get_package_file(package_name, archive.url, hash_algorithm=(
-        archive.hash_algorithm or 'md5'), expected_hash=archive.hash)
+    # (unless a PackagePipeline already did that for us), keeping it
+    # from eviction until it's installed
+    key = _fetch_key(archive)
+    # (the locks on an archive a PackagePipeline fetched may also protect it
+    # for packages still to come: see PackagePipeline.done())
+    locks = in_use[key] if key in in_use else []
+    try:
+        return _install_cached_binary(configured_name, platform, package, install_dir, installed,
+                                      dry_run, archive, fetched, cache_index, staged, file_index,
+                                      unpacked, locks)
+    finally:
+        if key not in in_use:
+            _release_all([locks])
+
+
+def _install_cached_binary(configured_name, platform, package, install_dir, installed, dry_run,
+                           archive, fetched, cache_index, staged, file_index, unpacked, locks):
+    package_name = getattr(package, 'name', '(undefined)')
+    if _fetch_key(archive) in fetched:
+        cachefile = fetched[_fetch_key(archive)]
+    else:
+        cachefile = get_package_file(package_name, archive.url, hash_algorithm=(
+            archive.hash_algorithm or 'md5'), expected_hash=archive.hash,
+            cache_index=cache_index, in_use=locks)
     if cachefile is None:
         raise InstallError("Failed to download package '%s' from '%s'" % (
             package_name, archive.url))
 
+    tree_dir = unpacked.tree_dir(archive) if unpacked is not None else None
+    if staged is None and tree_dir is not None and not dry_run:
+        staged = _stage_tarball(cachefile, install_dir,
+                                metadata_file_name=configfile.PACKAGE_METADATA_FILE,
+                                exclude=[configfile.PACKAGE_METADATA_FILE], tree_dir=tree_dir,
+                                hardlink=unpacked.hardlink)
+
     metadata, files = _install_common(
-        configured_name, platform, package, cachefile, install_dir, installed, dry_run)
+        configured_name, platform, package, cachefile, install_dir, installed, dry_run,
+        staged=staged, file_index=file_index)
     if metadata:
         installed_package = package.copy()
         if platform not in package.platforms:
@@ -552,6 +1585,14 @@ def get_metadata_from_package(package_file, package=None):
     metadata_file_name = configfile.PACKAGE_METADATA_FILE
     metadata_file = extract_metadata_from_package(
         package_file, metadata_file_name)
+    return _metadata_from_file(metadata_file, package_file, package)
+
+
+def _metadata_from_file(metadata_file, package_file, package=None):
+    """
+    Return the MetadataDescription read from metadata_file, the metadata
+    extracted from package_file, or a made-up one if that had none.
+    """
     if not metadata_file:
         logger.warning("WARNING: Archive '%s' does not contain metadata; build will be marked as dirty"
                        % os.path.basename(package_file))
@@ -582,9 +1623,58 @@ def get_metadata_from_package(package_file, package=None):
     return metadata
 
 
-def need_new_install(package, metadata, installed):
+def _stage_upgrade(package_name, package_file, install_dir, installed, staged):
+    """
+    Uninstall the installed version of package_name to make way for the
+    one in package_file -- where possible, leaving in place the files it
+    shares with the new version -- and return the _StagedTarball (or, for
+    a zip archive, the _StagedZip) from which to install the new version,
+    or None to install it from package_file.
+    staged is the new version's _StagedTarball, if already extracted.
+    """
+    current = _installed_file_stats(installed.dependencies[package_name], install_dir)
+    if current is not None:
+        if staged is None:
+            staged = _stage_tarball(package_file, install_dir,
+                                    exclude=[configfile.PACKAGE_METADATA_FILE], current=current)
+            if staged is None and zipfile.is_zipfile(package_file):
+                staged = _StagedZip(package_file, install_dir,
+                                    exclude=[configfile.PACKAGE_METADATA_FILE])
+                staged.match_installed(current)
+        else:
+            staged.match_installed(current)
+    if current is None or staged is None:
+        uninstall(package_name, installed)
+        return staged
+    logger.info("%s: %d of %d files unchanged" % (package_name, len(staged.unchanged),
+                                                  len(staged.files)))
+    uninstall(package_name, installed, keep=staged.unchanged)
+    return staged
+
+
+def _installed_file_stats(installed_pkg, install_dir):
     """
-    Uninstall any installed different version
+    Return a dict mapping each regular file installed_pkg installed to its
+    (size, mtime), for comparison with the members of an archive; or None
+    if it was installed somewhere other than install_dir.
+    """
+    old_dir = os.path.join(common.get_current_build_dir(), installed_pkg.get('install_dir') or '')
+    if os.path.realpath(old_dir) != os.path.realpath(install_dir):
+        return None
+    stats = {}
+    for name in installed_pkg.get('manifest') or []:
+        try:
+            info = os.lstat(os.path.join(install_dir, name))
+        except OSError:
+            continue
+        if stat.S_ISREG(info.st_mode):
+            stats[name] = (info.st_size, info.st_mtime)
+    return stats
+
+
+def need_new_install(package, metadata, installed, uninstall_old=True):
+    """
+    Uninstall any installed different version (unless not uninstall_old)
     Returns a boolean value for whether or not a new install is needed
     """
     do_install = False
@@ -600,7 +1690,7 @@ def need_new_install(package, metadata, installed):
                                                                installed_pkg['build_id'],
                                                                metadata.build_id))
             do_install = True
-        if do_install:
+        if do_install and uninstall_old:
             uninstall(package.name, installed)
     else:
         # If the package has never yet been installed, we're good.
@@ -609,9 +1699,34 @@ def need_new_install(package, metadata, installed):
     return do_install
 
 
-def _install_common(configured_name, platform, package, package_file, install_dir, installed, dry_run):
+def _install_common(configured_name, platform, package, package_file, install_dir, installed, dry_run,
+                    staged=None, file_index=None):
+    if staged is None and not dry_run and package.name not in installed.dependencies:
+        # Nothing installed to compare with, so (barring errors) this will be
+        # installed: read a tarball just once, extracting the files while
+        # looking for the metadata.
+        staged = _stage_tarball(package_file, install_dir,
+                                metadata_file_name=configfile.PACKAGE_METADATA_FILE,
+                                exclude=[configfile.PACKAGE_METADATA_FILE])
+    try:
+        return _install_staged(configured_name, platform, package, package_file,
+                               install_dir, installed, dry_run, staged, file_index)
+    finally:
+        if staged is not None:
+            staged.discard()
+
 
-    metadata = get_metadata_from_package(package_file, package)
+def _install_staged(configured_name, platform, package, package_file, install_dir, installed,
+                    dry_run, staged, file_index):
+    """
+    The body of _install_common(), where staged is a _StagedTarball of
+    package_file if it has already been extracted, else None, and
+    file_index an InstalledFileIndex for installed, or None.
+    """
+    if staged is not None:
+        metadata = _metadata_from_file(staged.metadata_file, package_file, package)
+    else:
+        metadata = get_metadata_from_package(package_file, package)
 
     # Check for required package_description elements
     package_errors = configfile.check_package_attributes(
@@ -629,10 +1744,27 @@ def _install_common(configured_name, platform, package, package_file, install_di
     if dry_run:
         dry_run_msg("Dry run mode: not installing %s" % package.name)
         return None, None
-    # this checks for a different version and uninstalls it if needed
-    if not need_new_install(package, metadata, installed):
+    # this checks for a different version
+    if not need_new_install(package, metadata, installed, uninstall_old=False):
         logger.info("%s is already installed" % package.name)
         return None, None
+    if package.name not in installed.dependencies:
+        return _place_package(package, metadata, package_file, install_dir, staged, file_index)
+
+    # Upgrade, replacing only the files that have changed where possible.
+    upgrade = _stage_upgrade(package.name, package_file, install_dir, installed, staged)
+    try:
+        return _place_package(package, metadata, package_file, install_dir, upgrade, file_index)
+    finally:
+        if upgrade is not None and upgrade is not staged:
+            upgrade.discard()
+
+
+def _place_package(package, metadata, package_file, install_dir, staged, file_index):
+    """
+    The rest of _install_staged(), once any old version is out of the way:
+    install the files of package_file, from staged if not None.
+    """
     # Check for transitive dependency conflicts
 #    dependancy_conflicts = transitive_search(metadata, installed)
 #    if dependancy_conflicts:
@@ -659,8 +1791,11 @@ def _install_common(configured_name, platform, package, package_file, install_di
     logger.warning("installing %s" % package.name)
     # extract the files from the package
     try:
-        files = _install_package(package_file, install_dir, exclude=[
-                                 configfile.PACKAGE_METADATA_FILE])
+        if staged is not None:
+            files = staged.install(file_index=file_index)
+        else:
+            files = _install_package(package_file, install_dir, exclude=[
+                                     configfile.PACKAGE_METADATA_FILE], file_index=file_index)
     except common.AutobuildError as details:
         raise InstallError(
             "Package '%s' attempts to install files already installed.\n%s\n  use --what-installed <file> to find the package that installed a conflict" % (package.name, details))
@@ -790,16 +1925,23 @@ def _update_installed_package_files(metadata, package,
     installed_platform = package.get_platform(platform)
     installed_package.archive = installed_platform.archive
     installed_package.manifest = files
+    # (get the index before changing what it would load as current)
+    file_index = InstalledFileIndex.of(installed)
     installed.dependencies[metadata.package_description.name] = installed_package
+    file_index.refresh()
 
 
-def uninstall(package_name, installed_config):
+def uninstall(package_name, installed_config, keep=()):
     """
-    Uninstall specified package_name: remove related files and delete
+    Uninstall specified package_name: remove related files (except those
+    named in keep, which the version replacing it shares) and delete
     package_name from the installed_config ConfigurationDescription.
 
     Saving the modified installed_config is the caller's responsibility.
     """
+    # index the package's files before its entry is consumed below
+    file_index = InstalledFileIndex.of(installed_config)
+    file_index.refresh()
     try:
         # Retrieve this package's installed PackageDescription, and
         # remove it from installed_config at the same time.
@@ -813,8 +1955,10 @@ def uninstall(package_name, installed_config):
     logger.warning("uninstalling %s version %s" %
                    (package_name, package.package_description.version))
     clean_files(os.path.join(common.get_current_build_dir(),
-                             package.install_dir), package.manifest)
+                             package.install_dir),
+                [filename for filename in package.manifest if filename not in keep])
     installed_config.save()
+    file_index.save()
 
 
 def clean_files(install_dir, files):
@@ -866,7 +2010,69 @@ def clean_files(install_dir, files):
         directories = parents
 
 
-def install_packages(args, config_file, install_dir, platform, packages):
+# the install fingerprint is saved next to the installed-packages.xml file,
+# with this in place of its extension
+INSTALL_FINGERPRINT_SUFFIX = "-fingerprint"
+
+
+def install_fingerprint(config_file, installed_filename, install_dir, platform, packages):
+    """
+    Return a digest of everything that decides what installing packages
+    (None meaning all of them) from config_file into install_dir would do:
+    their configuration for platform and the installed_filename contents,
+    which are read but not parsed. Returns None if installed_filename
+    can't be read.
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps([common.AUTOBUILD_VERSION_STRING, install_dir, platform,
+                              sorted(packages) if packages else None]))
+    for name in sorted(config_file.installables):
+        if packages and name not in packages:
+            continue
+        req_plat = config_file.installables[name].get_platform(platform)
+        digest.update(json.dumps([name, req_plat], sort_keys=True, default=str))
+    try:
+        with open(installed_filename, 'rb') as installed_file:
+            digest.update(installed_file.read())
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
+def _fingerprint_path(installed_filename):
+    return os.path.splitext(installed_filename)[0] + INSTALL_FINGERPRINT_SUFFIX
+
+
+def _read_fingerprint(installed_filename):
+    try:
+        with open(_fingerprint_path(installed_filename), 'rb') as fingerprint_file:
+            return fingerprint_file.read().strip()
+    except IOError:
+        return None
+
+
+def _write_fingerprint(installed_filename, fingerprint):
+    try:
+        common.atomic_write(_fingerprint_path(installed_filename), fingerprint + "\n")
+    except (IOError, OSError) as err:
+        # the fingerprint is only an optimization
+        logger.warning("cannot write %s: %s" % (_fingerprint_path(installed_filename), err))
+
+
+def _remove_fingerprint(installed_filename):
+    try:
+        os.remove(_fingerprint_path(installed_filename))
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def install_packages(args, config_file, install_dir, platform, packages,
+                     cache_index=None, unpacked=None):
+    """
+    Install packages into install_dir as args direct, sharing the
+    cache_index and any UnpackedTrees given with other calls in this run.
+    """
     if not args.check_license:
         logger.warning(
             "The --skip-license-check option is deprecated; it now has no effect")
@@ -876,6 +2082,21 @@ def install_packages(args, config_file, install_dir, platform, packages):
     # enough to leave it alone. Therefore we can do this unconditionally.
     installed_filename = os.path.join(install_dir, args.installed_filename)
 
+    # If neither the configuration nor the installed packages have changed
+    # since the last install of the same packages here, there is nothing to
+    # do: don't even load the installed packages.
+    requested = list(packages) if packages else None
+    fingerprinted = not (args.dry_run or args.local_archives or
+                         any(getattr(args, option, None) for option in QUERY_OPTIONS))
+    if fingerprinted:
+        fingerprint = install_fingerprint(config_file, installed_filename, install_dir,
+                                          platform, requested)
+        if fingerprint is not None and fingerprint == _read_fingerprint(installed_filename):
+            logger.info("packages in %s are up to date" % install_dir)
+            return 0
+        # until this install succeeds, there's no telling what's installed
+        _remove_fingerprint(installed_filename)
+
     # load the list of already installed packages
     logger.debug("loading " + installed_filename)
     installed = configfile.Dependencies(installed_filename)
@@ -908,8 +2129,20 @@ def install_packages(args, config_file, install_dir, platform, packages):
                                % (local_metadata.package_description.name, archive_path))
 
     # do the actual install of any new/updated packages
-    packages = do_install(packages, config_file, installed, platform, install_dir,
-                          args.dry_run, local_archives=local_archives)
+    if cache_index is None:
+        cache_index = install_cache.CacheIndex(paranoid=args.paranoid)
+    if unpacked is None and args.unpacked_cache:
+        unpacked = UnpackedTrees(cache_index, hardlink=args.hardlink_unpacked)
+    try:
+        packages = do_install(packages, config_file, installed, platform, install_dir,
+                              args.dry_run, local_archives=local_archives, jobs=args.jobs,
+                              cache_index=cache_index, extract_jobs=args.extract_jobs,
+                              unpacked=unpacked)
+    finally:
+        max_bytes = common.get_install_cache_max_bytes()
+        if max_bytes is not None and not args.dry_run:
+            cache_index.evict(max_bytes)
+        cache_index.save()
 
     if not args.dry_run:
         # update the installed-packages.xml file
@@ -921,6 +2154,12 @@ def install_packages(args, config_file, install_dir, platform, packages):
             if err.errno != errno.EEXIST:
                 raise AutobuildError(str(err))
         installed.save()
+        InstalledFileIndex.of(installed).save()
+        if fingerprinted:
+            fingerprint = install_fingerprint(config_file, installed_filename, install_dir,
+                                              platform, requested)
+            if fingerprint is not None:
+                _write_fingerprint(installed_filename, fingerprint)
     return 0
 
 
@@ -977,7 +2216,9 @@ class AutobuildTool(autobuild_base.AutobuildBase):
             '--what-installed',
             default=None,
             dest='query_installed_file',
-            help="Identify the package that installed .")
+            help="Identify the package that installed FILE; with '-', read files "
+            "to look up from stdin, one per line.",
+            metavar='FILE')
         parser.add_argument(
             '--skip-license-check',
             action='store_false',
@@ -1025,6 +2266,38 @@ class AutobuildTool(autobuild_base.AutobuildBase):
                             dest='local_archives',
                             default=[],
                             help="Install this locally built archive in place of the configured installable.")
+        parser.add_argument('--jobs', '-j',
+                            type=int,
+                            default=None,
+                            dest='jobs',
+                            help="number of package archives to download concurrently\n"
+                            "  (defaults to $AUTOBUILD_DOWNLOAD_JOBS or %d)" % DEFAULT_DOWNLOAD_JOBS)
+        parser.add_argument('--extract-jobs',
+                            type=int,
+                            default=None,
+                            dest='extract_jobs',
+                            help="number of new packages to extract concurrently\n"
+                            "  (defaults to $AUTOBUILD_EXTRACT_JOBS or the number of CPUs)")
+        parser.add_argument('--paranoid',
+                            action='store_true',
+                            default=False,
+                            dest='paranoid',
+                            help="verify the hash of every cached archive, even those already verified")
+        parser.add_argument('--unpacked-cache',
+                            action='store_true',
+                            default=bool(os.environ.get('AUTOBUILD_UNPACKED_CACHE')),
+                            dest='unpacked_cache',
+                            help="unpack each archive just once, into the install cache, and install\n"
+                            "  by cloning the unpacked files (as reflinks where the filesystem allows)\n"
+                            "  (defaults to on if $AUTOBUILD_UNPACKED_CACHE is set)")
+        parser.add_argument('--hardlink-unpacked',
+                            action='store_true',
+                            default=bool(os.environ.get('AUTOBUILD_HARDLINK_UNPACKED')),
+                            dest='hardlink_unpacked',
+                            help="with --unpacked-cache, install files that can't be reflinked as\n"
+                            "  hard links to the unpacked cache rather than copies: they are then\n"
+                            "  read-only, and changing one in place changes every later install\n"
+                            "  (defaults to on if $AUTOBUILD_HARDLINK_UNPACKED is set)")
         parser.add_argument('--all', '-a',
                             dest='all',
                             default=False,
@@ -1042,6 +2315,11 @@ class AutobuildTool(autobuild_base.AutobuildBase):
         utf8_writer = codecs.getwriter('utf8')
         sys.stdout = utf8_writer(sys.stdout)
 
+        args.jobs = common.resolve_jobs(args.jobs, '--jobs', 'AUTOBUILD_DOWNLOAD_JOBS',
+                                        DEFAULT_DOWNLOAD_JOBS)
+        args.extract_jobs = common.resolve_jobs(args.extract_jobs, '--extract-jobs',
+                                                'AUTOBUILD_EXTRACT_JOBS', DEFAULT_EXTRACT_JOBS)
+
         platform = common.establish_platform(args.platform, args.addrsize)
         logger.debug("installing platform " + platform)
 
@@ -1051,24 +2329,48 @@ class AutobuildTool(autobuild_base.AutobuildBase):
 
         # establish a build directory so that the install directory is relative
         # to it
+        install_dirs = []
         for build_configuration in common.select_configurations(args, config, "installing for"):
             build_directory = config.get_build_directory(
                 build_configuration, platform_name=platform)
 
             # write packages into 'packages' subdir of build directory
-            install_dirs = \
+            # (select_directories() returns those of every selected
+            # configuration, so each is only collected once)
+            for install_dir in \
                 common.select_directories(args, config,
                                           "install", "installing packages for",
                                           lambda cnf:
                                           os.path.join(config.make_build_directory(cnf, platform=platform, dry_run=args.dry_run),
-                                                       "packages"))
-
-            # get the absolute paths to the install dir and
-            # installed-packages.xml file
-            for install_dir in install_dirs:
+                                                       "packages")):
+                # get the absolute paths to the install dir and
+                # installed-packages.xml file
                 install_dir = os.path.realpath(install_dir)
-                install_packages(args, config, install_dir,
-                                 platform, args.package)
+                if install_dir not in install_dirs:
+                    install_dirs.append(install_dir)
+
+        # Installing into several directories shares one cache index, so that
+        # each archive is verified once, and unpacks each archive just once,
+        # to be copied into each directory.
+        cache_index = install_cache.CacheIndex(paranoid=args.paranoid)
+        unpacked = None
+        shared_root = None
+        if args.unpacked_cache:
+            unpacked = UnpackedTrees(cache_index, hardlink=args.hardlink_unpacked)
+        elif len(install_dirs) > 1 and not args.dry_run:
+            parent = os.path.dirname(install_dirs[0])
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            shared_root = tempfile.mkdtemp(prefix=".autobuild-unpacked-", dir=parent)
+            # (hard links would join the install dirs' copies of each file)
+            unpacked = UnpackedTrees(root=shared_root)
+        try:
+            for install_dir in install_dirs:
+                install_packages(args, config, install_dir, platform, args.package,
+                                 cache_index=cache_index, unpacked=unpacked)
+        finally:
+            if shared_root is not None:
+                _remove_unpacked(shared_root)
 
 
 if __name__ == '__main__':
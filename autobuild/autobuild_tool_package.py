@@ -27,7 +27,9 @@ Creates archives of build output.
 The package sub-command works by locating all of the files in the
 build output directory that match the manifest specified in the
 configuration file. The manifest can include platform-specific and
-platform-common files which may use glob-style wildcards.
+platform-common files which may use glob-style wildcards, '**' for any
+number of directories and a leading '!' to exclude files (see
+manifest_matcher).
 
 The package command optionally enforces the restriction that a license
 string and a valid license_file for the package has been specified. The operation
@@ -45,17 +47,28 @@ following metadata in the autobuild.xml file:
 
 from __future__ import print_function
 from __future__ import absolute_import
-import hashlib
 import os
+import json
+import errno
+import hashlib
+import stat
+import time
+import zlib
+import shutil
 import tarfile
 import getpass
-import glob
+import tempfile
 import subprocess
 import re
-from zipfile import ZipFile, ZIP_DEFLATED
+import threading
+from multiprocessing.pool import ThreadPool
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT, LargeZipFile
 
 from . import common
 import logging
+from . import compressors
+from . import hash_algorithms
+from . import manifest_matcher
 from . import configfile
 from . import autobuild_base
 from .common import AutobuildError
@@ -100,7 +113,8 @@ class AutobuildTool(autobuild_base.AutobuildBase):
         parser.add_argument('--archive-format',
                             default=None,
                             dest='archive_format',
-                            help='the format of the archive (tbz2 or zip)')
+                            help='the format of the archive (%s)' %
+                            ', '.join(sorted(TARBALL_FORMATS.keys() + ['zip'])))
         parser.add_argument('--build-dir',
                             default=None,
                             dest='select_dir',  # see common.select_directories()
@@ -110,6 +124,12 @@ class AutobuildTool(autobuild_base.AutobuildBase):
                             default=False,
                             dest='all',
                             help="package all configurations")
+        parser.add_argument('--jobs', '-j',
+                            type=int,
+                            default=None,
+                            dest='jobs',
+                            help="number of configurations to package concurrently\n"
+                            "  (defaults to $AUTOBUILD_PACKAGE_JOBS or 1)")
         parser.add_argument('--clean-only',
                             action="store_true",
                             default=True if 'AUTOBUILD_CLEAN_ONLY' in os.environ and boolopt.match(
@@ -131,8 +151,34 @@ class AutobuildTool(autobuild_base.AutobuildBase):
                             default=None,
                             dest='results_file',
                             help="file name in which to write results as shell variable assignments")
+        parser.add_argument('--compression-jobs',
+                            type=int,
+                            default=None,
+                            dest='compression_jobs',
+                            help="compress archives using this many processes or threads "
+                            "(default $AUTOBUILD_COMPRESSION_JOBS, else 1)")
+        parser.add_argument('--compression-level',
+                            type=int,
+                            # (argparse converts a string default with type)
+                            default=os.environ.get('AUTOBUILD_COMPRESSION_LEVEL'),
+                            dest='compression_level',
+                            help="compress tarballs at this level (default "
+                            "$AUTOBUILD_COMPRESSION_LEVEL, else the format's own default): "
+                            "1-9 for tbz2 and tgz, 0-9 for txz, 1-19 for tzst")
+        parser.add_argument('--digest',
+                            action='append',
+                            default=[],
+                            dest='digests',
+                            metavar='HASH_ALGORITHM',
+                            choices=sorted(algorithm for algorithm in hash_algorithms.REGISTERED_HASHERS
+                                           if algorithm != 'md5'),
+                            help="besides md5, report the archive's hash by this algorithm "
+                            "(as autobuild_package_<algorithm> in the results file); may be repeated")
 
     def run(self, args):
+        args.jobs = common.resolve_jobs(args.jobs, '--jobs', 'AUTOBUILD_PACKAGE_JOBS', 1)
+        args.compression_jobs = common.resolve_jobs(args.compression_jobs, '--compression-jobs',
+                                                    'AUTOBUILD_COMPRESSION_JOBS', 1)
         logger.debug("loading " + args.autobuild_filename)
         platform = common.establish_platform(args.platform, args.addrsize)
         if args.clean_only:
@@ -151,16 +197,46 @@ class AutobuildTool(autobuild_base.AutobuildBase):
 
         if not build_dirs:
             build_dirs = [config.get_build_directory(None, platform)]
-        for build_dir in build_dirs:
+
+        def package_build_dir(build_dir):
+            # Each configuration rewrites the results file, so that it ends up
+            # describing the last one: leave it to the last one, whatever
+            # order the configurations finish in.
+            results_file = args.results_file if build_dir == build_dirs[-1] else None
             package(config, build_dir, platform, archive_filename=args.archive_filename,
-                    archive_format=args.archive_format, clean_only=args.clean_only, results_file=args.results_file, dry_run=args.dry_run)
+                    archive_format=args.archive_format, clean_only=args.clean_only, results_file=results_file, dry_run=args.dry_run,
+                    compression_level=args.compression_level, compression_jobs=args.compression_jobs,
+                    digests=args.digests)
+
+        jobs = min(args.jobs, len(build_dirs))
+        if jobs <= 1:
+            for build_dir in build_dirs:
+                package_build_dir(build_dir)
+            return
+        logger.info("packaging %d configurations using %d jobs" % (len(build_dirs), jobs))
+        pool = ThreadPool(jobs)
+        try:
+            pool.map(package_build_dir, build_dirs)
+        finally:
+            pool.close()
+            pool.join()
 
 
 class PackageError(AutobuildError):
     pass
 
 
-def package(config, build_directory, platform_name, archive_filename=None, archive_format=None, clean_only=False, results_file=None, dry_run=False):
+# tarball archive format -> (archive file name suffix, compressors format)
+TARBALL_FORMATS = {
+    'tbz2': ('.tar.bz2', 'bz2'),
+    'tgz': ('.tar.gz', 'gz'),
+    'txz': ('.tar.xz', 'xz'),
+    'tzst': ('.tar.zst', 'zst'),
+}
+
+
+def package(config, build_directory, platform_name, archive_filename=None, archive_format=None, clean_only=False, results_file=None, dry_run=False,
+            compression_level=None, compression_jobs=1, digests=()):
     """
     Create an archive for the given platform.
     Returns True if the archive is not dirty, False if it is
@@ -219,7 +295,7 @@ def package(config, build_directory, platform_name, archive_filename=None, archi
             files.add(package_description.license_file)
     if 'source_directory' in metadata_file.package_description:
         del metadata_file.package_description['source_directory']
-    metadata_file.manifest = files
+    metadata_file.manifest = sorted(files)
     if metadata_file.build_id:
         build_id = metadata_file.build_id
     else:
@@ -270,19 +346,59 @@ def package(config, build_directory, platform_name, archive_filename=None, archi
     else:
         archive_description = platform_description.archive
         format = _determine_archive_format(archive_format, archive_description)
-        if format == 'tbz2':
-            _create_tarfile(tarfilename + '.tar.bz2',
-                            build_directory, files, results)
+        if format in TARBALL_FORMATS:
+            suffix, compression = TARBALL_FORMATS[format]
+            archive_path = tarfilename + suffix
         elif format == 'zip':
-            _create_zip_archive(tarfilename + '.zip',
-                                build_directory, files, results)
+            archive_path = tarfilename + '.zip'
         else:
             raise PackageError("archive format %s is not supported" % format)
+        # If the archive was last written from just these files, in the
+        # same way, it would be written again byte for byte: reuse it.
+        fingerprint = package_fingerprint(build_directory, files, format, compression_level,
+                                          compression_jobs)
+        # configurations packaged concurrently may share an archive name
+        with _archive_lock(archive_path):
+            archive_digests = _reusable_archive(archive_path, fingerprint, digests)
+            if archive_digests is not None:
+                logger.info("%s is up to date" % archive_path)
+            else:
+                _remove_package_fingerprint(archive_path)
+                if format == 'zip':
+                    archive_digests = _create_zip_archive(archive_path, build_directory, files,
+                                                          digests=digests,
+                                                          compression_jobs=compression_jobs)
+                else:
+                    archive_digests = _create_tarfile(archive_path, build_directory, files,
+                                                      compression=compression,
+                                                      compression_level=compression_level,
+                                                      compression_jobs=compression_jobs,
+                                                      digests=digests)
+                _write_package_fingerprint(archive_path, fingerprint, archive_digests)
+        # printing unconditionally on stdout for backward compatibility
+        # the Linden Lab build scripts no longer rely on this
+        # (they use the --results-file option instead)
+        print("wrote  %s" % archive_path)
+        if results:
+            results.write('autobuild_package_filename="%s"\n' % archive_path)
+        _print_hashes(archive_digests, results)
     if not dry_run and results:
         results.close()
     return not metadata_file.dirty
 
 
+_archive_locks = {}
+_archive_locks_lock = threading.Lock()
+
+
+def _archive_lock(archive_path):
+    """
+    Return the lock that serializes writing archive_path.
+    """
+    with _archive_locks_lock:
+        return _archive_locks.setdefault(os.path.normcase(archive_path), threading.Lock())
+
+
 def _determine_archive_format(archive_format_argument, archive_description):
     if archive_format_argument is not None:
         return archive_format_argument
@@ -307,121 +423,402 @@ def _generate_archive_name(package_description, build_id, platform_name, suffix=
 
 
 def _get_file_list(platform_description, build_directory):
-    files = set()
-    missing = []
-    if platform_description.manifest:
-        current_directory = os.getcwd()
-        os.chdir(build_directory)
-        try:
-            for pattern in platform_description.manifest:
-                found = glob.glob(pattern)
-                if not found:
-                    missing.append(pattern)
-                for found_file in found:
-                    files.add(found_file)
-        finally:
-            os.chdir(current_directory)
+    if not platform_description.manifest:
+        return [set(), []]
+    files, missing = manifest_matcher.match_manifest(platform_description.manifest,
+                                                     build_directory)
     return [files, missing]
 
 
-def _create_tarfile(tarfilename, build_directory, filelist, results):
+PACKAGE_FINGERPRINT_SUFFIX = "-fingerprint"
+
+
+def package_fingerprint(build_directory, files, format, compression_level, compression_jobs):
+    """
+    Return a digest of everything that decides the content of an archive
+    of files from build_directory in format: how it's compressed, and the
+    path, type, permissions, size and modification time of everything that
+    goes into it (but not the content of the files, which would mean
+    reading them all).
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps([common.AUTOBUILD_VERSION_STRING, format, compression_level,
+                              compression_jobs]))
+    for path in _archive_members(build_directory, files):
+        st = os.lstat(os.path.join(build_directory, path))
+        link = os.readlink(os.path.join(build_directory, path)) \
+            if stat.S_ISLNK(st.st_mode) else None
+        digest.update(json.dumps([path, st.st_mode, st.st_size, repr(st.st_mtime), link]))
+    return digest.hexdigest()
+
+
+def _archive_members(build_directory, files):
+    """
+    Generate the path, relative to build_directory, of everything packaged
+    from files (relative paths of files or directories, packaged with all
+    their contents) in the order it goes into the archive: sorted, so that
+    the same files always make the same archive.
+    """
+    for path in sorted(files):
+        yield path
+        full_path = os.path.join(build_directory, path)
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            for member in _archive_members(build_directory,
+                                           [os.path.join(path, name)
+                                            for name in os.listdir(full_path)]):
+                yield member
+
+
+def _package_fingerprint_path(archive_path):
+    return archive_path + PACKAGE_FINGERPRINT_SUFFIX
+
+
+def _reusable_archive(archive_path, fingerprint, digests):
+    """
+    If archive_path was written with this fingerprint and is still there,
+    return its digests (md5 followed by digests), as _create_tarfile() does;
+    otherwise return None.
+    """
+    try:
+        with open(_package_fingerprint_path(archive_path), 'rb') as fingerprint_file:
+            previous = json.load(fingerprint_file)
+        if previous['fingerprint'] != fingerprint or \
+           os.path.getsize(archive_path) != previous['size']:
+            return None
+        known = dict(previous['digests'])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+    # (any digest not asked for last time has to be computed after all)
+    return [(algorithm, known.get(algorithm) or
+             hash_algorithms.compute_hash(algorithm, archive_path))
+            for algorithm in ['md5'] + list(digests)]
+
+
+def _write_package_fingerprint(archive_path, fingerprint, digests):
+    try:
+        common.atomic_write(_package_fingerprint_path(archive_path),
+                            json.dumps(dict(fingerprint=fingerprint,
+                                            size=os.path.getsize(archive_path),
+                                            digests=digests)) + "\n")
+    except (IOError, OSError) as err:
+        # the fingerprint is only an optimization
+        logger.warning("cannot write %s: %s" % (_package_fingerprint_path(archive_path), err))
+
+
+def _remove_package_fingerprint(archive_path):
+    try:
+        os.remove(_package_fingerprint_path(archive_path))
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def _normalize_tarinfo(tarinfo):
+    # who built the package is no part of it
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+    return tarinfo
+
+
+def _create_tarfile(tarfilename, build_directory, filelist, compression='bz2',
+                    compression_level=None, compression_jobs=1, digests=()):
+    """
+    Write the tarball tarfilename and return its digests, a list of
+    (hash_algorithm, hexdigest) pairs for md5 followed by digests.
+    """
     if not os.path.exists(os.path.dirname(tarfilename)):
         os.makedirs(os.path.dirname(tarfilename))
-    current_directory = os.getcwd()
-    os.chdir(build_directory)
+    build_directory = os.path.abspath(build_directory)
+    archive = open(tarfilename, 'wb')
+    # hash the archive as it's written, rather than reading it back
+    output = hash_algorithms.HashingWriter(archive, ['md5'] + list(digests))
     try:
-        tfile = tarfile.open(tarfilename, 'w:bz2')
-        for file in filelist:
+        compressor = compressors.open_compressed(output, compression, level=compression_level,
+                                                 jobs=compression_jobs)
+    except:
+        archive.close()
+        raise
+    try:
+        tfile = tarfile.open(fileobj=compressor, mode='w|')
+        for file in sorted(filelist):
             try:
                 # Make sure permissions are set on Windows.
                 if common.get_current_platform().startswith(common.PLATFORM_WINDOWS):
                     command = ["CACLS", file, "/T",
                                "/G", getpass.getuser() + ":F"]
                     CACLS = subprocess.Popen(
-                        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                    output = CACLS.communicate("Y")[0]
+                        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                        cwd=build_directory)
+                    cacls_output = CACLS.communicate("Y")[0]
                     rc = CACLS.wait()
                     if rc != 0:
                         print("error: rc %s from %s:" %
                               (rc, ' '.join(command)))
-                    print(output)
-                tfile.add(file)
+                    print(cacls_output)
+                for member in _archive_members(build_directory, [file]):
+                    tfile.add(os.path.join(build_directory, member), arcname=member,
+                              recursive=False, filter=_normalize_tarinfo)
                 logger.info('added ' + file)
             except (tarfile.TarError, IOError) as err:
                 # IOError in case the specified filename can't be opened
                 raise PackageError("unable to add %s to %s: %s" %
                                    (file, tarfilename, err))
         tfile.close()
+        compressor.close()
+    except:
+        compressor.abort()
+        raise
     finally:
-        os.chdir(current_directory)
-    # printing unconditionally on stdout for backward compatibility
-    # the Linden Lab build scripts no longer rely on this
-    # (they use the --results-file option instead)
-    print("wrote  %s" % tarfilename)
-    if results:
-        results.write('autobuild_package_filename="%s"\n' % tarfilename)
-    _print_hash(tarfilename, results)
+        archive.close()
+    return output.hexdigests()
 
 
-def _create_zip_archive(archive_filename, build_directory, file_list, results):
+def _create_zip_archive(archive_filename, build_directory, file_list, digests=(), compression_jobs=1):
+    """
+    Write the zip archive archive_filename and return its digests, as
+    _create_tarfile() does. Up to compression_jobs threads compress its
+    members (see _prepare_zip_member()), which are then written in order.
+    """
     if not os.path.exists(os.path.dirname(archive_filename)):
         os.makedirs(os.path.dirname(archive_filename))
-    current_directory = os.getcwd()
-    os.chdir(build_directory)
+    members = list(_zip_members(build_directory, file_list))
+    jobs = max(1, min(compression_jobs, len(members)))
+    pool = ThreadPool(jobs) if jobs > 1 else None
     try:
-        archive = ZipFile(archive_filename, 'w', ZIP_DEFLATED)
-        added_files = set()
-        for file in file_list:
-            _add_file_to_zip_archive(
-                archive, file, archive_filename, added_files)
-        archive.close()
+        with open(archive_filename, 'wb') as archive_file:
+            # hash the archive as it's written, rather than reading it back;
+            # see _PreparedZipFile for how that's possible
+            output = hash_algorithms.HashingWriter(archive_file, ['md5'] + list(digests))
+            archive = _PreparedZipFile(output, 'w', ZIP_DEFLATED)
+            for file, prepared, error in _prepared_zip_members(pool, jobs, build_directory,
+                                                               members):
+                try:
+                    if error is not None:
+                        raise error
+                    archive.write_prepared(prepared)
+                except Exception as err:
+                    raise PackageError("%s: unable to add %s to %s: %s" %
+                                       (err.__class__.__name__, file, archive_filename, err))
+                logger.info('added ' + file)
+            archive.close()
     finally:
-        os.chdir(current_directory)
-    # printing unconditionally on stdout for backward compatibility
-    # the Linden Lab build scripts no longer rely on this
-    # (they use the --results-file option instead)
-    print("wrote  %s" % archive_filename)
-    if results:
-        results.write('autobuild_package_filename="%s"\n' % archive_filename)
-    _print_hash(archive_filename, results)
-
-
-def _add_file_to_zip_archive(zip_file, unnormalized_file, archive_filename, added_files):
-    # Normalize the path that actually gets added to zipfile.
-    file = os.path.normpath(unnormalized_file)
-    # But normalize case only for testing added_files.
-    lowerfile = os.path.normcase(file)
-    if lowerfile in added_files:
-        logger.info('skipped duplicate ' + file)
-        return
-    added_files.add(lowerfile)
-    if os.path.isdir(file):
-        for f in os.listdir(file):
-            _add_file_to_zip_archive(zip_file, os.path.join(
-                file, f), archive_filename, added_files)
-    else:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return output.hexdigests()
+
+
+def _zip_members(build_directory, file_list):
+    """
+    Generate, in order, the normalized build_directory-relative names of
+    the files to put in a zip archive of file_list, each just once (what a
+    directory holds goes in in its place).
+    """
+    added_files = set()
+    pending = sorted(file_list, reverse=True)
+    while pending:
+        # Normalize the path that actually gets added to zipfile.
+        file = os.path.normpath(pending.pop())
+        # But normalize case only for testing added_files.
+        lowerfile = os.path.normcase(file)
+        if lowerfile in added_files:
+            logger.info('skipped duplicate ' + file)
+            continue
+        added_files.add(lowerfile)
+        path = os.path.join(build_directory, file)
+        if os.path.isdir(path):
+            pending.extend(os.path.join(file, f)
+                           for f in sorted(os.listdir(path), reverse=True))
+        else:
+            yield file
+
+
+def _prepared_zip_members(pool, jobs, build_directory, members):
+    """
+    Generate (file, _PreparedZipMember, None) for each of members in turn,
+    preparing up to 2 * jobs of them ahead in pool (if it's not None). If
+    a member can't be prepared, generate (file, None, exception) instead,
+    to be reported when its turn comes, as a serial walk would.
+    """
+    def prepare(file):
         try:
-            zip_file.write(file)
+            return _prepare_zip_member(os.path.join(build_directory, file), file), None
         except Exception as err:
-            raise PackageError("%s: unable to add %s to %s: %s" %
-                               (err.__class__.__name__, file, archive_filename, err))
-        logger.info('added ' + file)
-
-
-def _print_hash(filename, results):
-    fp = open(filename, 'rb')
-    m = hashlib.md5()
-    while True:
-        d = fp.read(65536)
-        if not d:
-            break
-        m.update(d)
-    # printing unconditionally on stdout for backward compatibility
-    # the Linden Lab build scripts no longer rely on this
-    # (they use the --results-file option instead)
-    print("md5    %s" % m.hexdigest())
-    if results:
-        results.write('autobuild_package_md5="%s"\n' % m.hexdigest())
+            return None, err
+
+    if pool is None:
+        pending = ((file, prepare(file)) for file in members)
+    else:
+        pending = _bounded_imap(pool, prepare, members, 2 * jobs)
+    for file, (prepared, error) in pending:
+        yield file, prepared, error
+
+
+def _bounded_imap(pool, function, items, limit):
+    """
+    Like pool.imap(), generating (item, function(item)), except that no
+    more than limit results are held at once.
+    """
+    queued = []
+    for item in items:
+        queued.append((item, pool.apply_async(function, (item,))))
+        if len(queued) >= limit:
+            item, result = queued.pop(0)
+            yield item, result.get()
+    for item, result in queued:
+        yield item, result.get()
+
+
+# compressed zip members up to this size are held in memory
+ZIP_SPOOL_SIZE = 16 * 1024 * 1024
+
+# files of these types are already compressed: deflating them again
+# costs time and saves nothing
+PRECOMPRESSED_EXTENSIONS = frozenset("""
+    .7z .bz2 .cab .docx .flac .gif .gz .jar .jpeg .jpg .lz .lzma .m4a .mkv .mov
+    .mp3 .mp4 .ogg .opus .png .pptx .rar .tbz2 .tgz .txz .tzst .webm .webp .whl
+    .xlsx .xz .zip .zst
+""".split())
+
+# how much of any other file to try compressing ...
+ZIP_SAMPLE_SIZE = 64 * 1024
+# ... and the fraction of it that deflating must save for the file to be
+# worth deflating
+ZIP_MIN_SAVING = 0.05
+
+
+class _PreparedZipMember(object):
+    """
+    A ZipInfo with everything filled in but header_offset, and the data
+    to write after its header: a temporary file of compressed data, or
+    (if it's stored) the file itself.
+    """
+    def __init__(self, zinfo, path, compressed=None):
+        self.zinfo = zinfo
+        self.path = path
+        self.compressed = compressed
+
+    def open(self):
+        if self.compressed is None:
+            return open(self.path, 'rb')
+        self.compressed.seek(0)
+        return self.compressed
+
+
+def _zip_compress_type(path):
+    """
+    Return ZIP_STORED for a file that deflating wouldn't shrink, judging
+    by its extension or, failing that, by how well a sample of it
+    compresses; otherwise ZIP_DEFLATED.
+    """
+    if os.path.splitext(path)[1].lower() in PRECOMPRESSED_EXTENSIONS:
+        return ZIP_STORED
+    with open(path, 'rb') as source:
+        sample = source.read(ZIP_SAMPLE_SIZE)
+    # anything too small to gain from deflating gains nothing here either
+    if len(zlib.compress(sample, 1)) > len(sample) * (1 - ZIP_MIN_SAVING):
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+def _prepare_zip_member(path, file):
+    """
+    Do all the work of adding path to a zip archive as file that needn't
+    wait for its turn to be written: choose how to store it, checksum it
+    and (if it's worth it) compress it. zlib releases the GIL, so this can
+    run on several threads at once.
+    """
+    st = os.stat(path)
+    arcname = os.path.normpath(os.path.splitdrive(file)[1]).lstrip(os.sep + (os.altsep or ''))
+    zinfo = ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+    zinfo.compress_type = _zip_compress_type(path)
+    crc = 0
+    size = 0
+    if zinfo.compress_type == ZIP_STORED:
+        with open(path, 'rb') as source:
+            while True:
+                block = source.read(common.HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+        zinfo.file_size = zinfo.compress_size = size
+        zinfo.CRC = crc & 0xffffffff
+        return _PreparedZipMember(zinfo, path)
+    compressed = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE)
+    try:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        with open(path, 'rb') as source:
+            while True:
+                block = source.read(common.HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                compressed.write(compressor.compress(block))
+        compressed.write(compressor.flush())
+        zinfo.file_size = size
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.compress_size = compressed.tell()
+    except:
+        compressed.close()
+        raise
+    return _PreparedZipMember(zinfo, path, compressed)
+
+
+class _PreparedZipFile(ZipFile):
+    """
+    A ZipFile that can write a prepared member (see _prepare_zip_member())
+    without seeking back to fill in the member's header once its data is
+    written, so that the header and data can be written in order, and
+    hashed as they are. This relies on ZipFile internals, which are kept
+    to this class.
+    """
+
+    def write_prepared(self, prepared):
+        """
+        Like write(), for the member prepared. The data copied must match
+        the size (and, for a file stored as is, the CRC-32) prepared.
+        """
+        zinfo = prepared.zinfo
+        zip64 = zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT
+        if zip64 and not self._allowZip64:
+            raise LargeZipFile("Filesize would require ZIP64 extensions")
+        crc = 0
+        copied = 0
+        with prepared.open() as data:
+            zinfo.header_offset = self.fp.tell()
+            self._writecheck(zinfo)
+            self._didModify = True
+            self.fp.write(zinfo.FileHeader(zip64))
+            while True:
+                block = data.read(common.HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                if prepared.compressed is None:
+                    # read from the file again: check it's what was prepared
+                    crc = zlib.crc32(block, crc)
+                copied += len(block)
+                self.fp.write(block)
+        if copied != zinfo.compress_size or \
+                (prepared.compressed is None and crc & 0xffffffff != zinfo.CRC):
+            raise PackageError("%s changed while it was being packaged" % prepared.path)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+
+def _print_hashes(digests, results):
+    """
+    Report digests, a list of (hash_algorithm, hexdigest) pairs.
+    """
+    for algorithm, digest in digests:
+        # printing unconditionally on stdout for backward compatibility
+        # the Linden Lab build scripts no longer rely on this
+        # (they use the --results-file option instead)
+        print("%-6s %s" % (algorithm, digest))
+        if results:
+            results.write('autobuild_package_%s="%s"\n' % (algorithm, digest))
 
     # Not using logging, since this output should be produced unconditionally on stdout
     # Downstream build tools utilize this output
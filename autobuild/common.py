@@ -225,6 +225,71 @@ def get_install_cache_dir():
     return cache
 
 
+def get_install_cache_max_bytes():
+    """
+    Return the size to which the install cache should be limited, from
+    $AUTOBUILD_CACHE_MAX_BYTES, or None if it may grow without limit.
+    """
+    max_bytes = os.getenv('AUTOBUILD_CACHE_MAX_BYTES')
+    if not max_bytes:
+        return None
+    try:
+        max_bytes = int(max_bytes)
+    except ValueError:
+        raise AutobuildError("AUTOBUILD_CACHE_MAX_BYTES must be a number of bytes, not '%s'"
+                             % max_bytes)
+    return max_bytes if max_bytes > 0 else None
+
+
+def resolve_jobs(jobs, option, variable, default):
+    """
+    Return the number of jobs to use: jobs, as given by option on the
+    command line, unless that's None; else as given by the environment
+    variable; else default. Raise AutobuildError unless it's at least 1.
+    (Options read the environment here rather than in their parser, so
+    that a bad value is reported as such.)
+    """
+    if jobs is None:
+        jobs = os.environ.get(variable)
+        if jobs is None:
+            return default
+        option = "$" + variable
+    try:
+        count = int(jobs)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise AutobuildError("%s must be a positive number of jobs, not '%s'" % (option, jobs))
+    return count
+
+
+def atomic_write(path, data):
+    """
+    Replace the content of the file at path with data so that a concurrent
+    reader sees either the old content or the new, never a partial file.
+    """
+    dirname = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=dirname or os.curdir,
+                                     prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # Windows won't rename over an existing file
+            if not os.path.exists(path):
+                raise
+            os.remove(path)
+            os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
 def get_temp_dir(basename):
     """
     Return a temporary directory on the user's machine, uniquified
@@ -308,28 +373,47 @@ def find_executable(executables, exts=None):
     return None
 
 
-def compute_md5(path):
+# how much of a file compute_hash() reads at a time
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def compute_hash(path, hasher):
     """
-    Returns the MD5 sum for the given file.
+    Feed the content of the given file to hasher (an object with the
+    hashlib update() and hexdigest() methods) and return its hexdigest().
+    The file is read a block at a time, so memory use does not depend on
+    the size of the file.
     """
-    try:
-        from hashlib import md5      # Python 2.6
-    except ImportError:
-        from md5 import new as md5   # Python 2.5 and earlier
-
     try:
         stream = open(path, 'rb')
     except IOError as err:
-        raise AutobuildError("Can't compute MD5 for %s: %s" % (path, err))
+        raise AutobuildError("Can't compute %s for %s: %s" %
+                             (getattr(hasher, 'name', 'hash').upper(), path, err))
 
     try:
-        hasher = md5(stream.read())
+        while True:
+            block = stream.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
     finally:
         stream.close()
 
     return hasher.hexdigest()
 
 
+def compute_md5(path):
+    """
+    Returns the MD5 sum for the given file.
+    """
+    try:
+        from hashlib import md5      # Python 2.6
+    except ImportError:
+        from md5 import new as md5   # Python 2.5 and earlier
+
+    return compute_hash(path, md5())
+
+
 def split_tarname(pathname):
     """
     Given a tarfile pathname of the form:
@@ -0,0 +1,359 @@
+#!/usr/bin/env python2
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+"""
+Compress archives, where possible across several processes.
+
+open_compressed() gives a file object that compresses what is written to it
+in one of the COMPRESSION_LEVELS formats into another file object, which
+need only have write(): the compressed data is written in order, never
+sought back over, so it can be hashed on the way (see
+hash_algorithms.HashingWriter). Python 2 itself only compresses bz2 and gz;
+xz and zst are piped through the xz and zstd programs, which must be on the
+PATH.
+
+ParallelBZ2File splits what is written to it into chunks, compresses each
+chunk to one bz2 block in a pool of processes, and joins the blocks, in
+order, into a single bz2 stream, as lbzip2 does. The result is an ordinary
+.bz2 file, which Python 2's own bz2 module, and so every autobuild release,
+reads like any other.
+"""
+
+from __future__ import absolute_import
+import bz2
+import gzip
+import binascii
+import shutil
+import tempfile
+import threading
+import subprocess
+import collections
+import multiprocessing
+
+from . import common
+
+# compression format -> (lowest level, highest level, default level)
+COMPRESSION_LEVELS = {
+    'bz2': (1, 9, 9),
+    'gz': (1, 9, 9),
+    'xz': (0, 9, 6),
+    # (beyond 19 zstd wants --ultra, and a great deal of memory to read)
+    'zst': (1, 19, 3),
+}
+
+# magic numbers beginning each bz2 block, and the end of a bz2 stream
+_BZ2_BLOCK_MAGIC = 0x314159265359
+_BZ2_END_MAGIC = 0x177245385090
+
+
+def bz2_chunk_size(level):
+    """
+    Return how much ParallelBZ2File compresses at a time at level: as much
+    as surely fits one bz2 block. A block holds 100k * level - 19 bytes
+    after bzip2's initial run-length encoding, which can make its input up
+    to 5/4 as long.
+    """
+    return (100 * 1000 * level - 19) * 4 // 5
+
+
+def open_compressed(file, format, level=None, jobs=1):
+    """
+    Return a file object compressing what is written to it into file in the
+    compression format (a key of COMPRESSION_LEVELS) at level (default the
+    format's default), using up to jobs processes or threads where the
+    compressor can. The file object returned must be either close()d, which
+    finishes the compressed data, or abort()ed; neither closes file.
+    """
+    lowest, highest, default = COMPRESSION_LEVELS[format]
+    if level is None:
+        level = default
+    elif not lowest <= level <= highest:
+        raise common.AutobuildError("%s compression level must be from %s to %s, not %s" %
+                                    (format, lowest, highest, level))
+    if format == 'bz2':
+        if jobs > 1:
+            return ParallelBZ2File(file, jobs, level=level)
+        return _BZ2Compressor(file, level)
+    if format == 'gz':
+        pigz = common.find_executable('pigz') if jobs > 1 else None
+        if pigz is None:
+            return _GzipCompressor(file, level)
+        return _PipedCompressor(file, [pigz, '-c', '-p', str(jobs), '-%d' % level])
+    program = {'xz': 'xz', 'zst': 'zstd'}[format]
+    executable = common.find_executable(program)
+    if executable is None:
+        raise common.AutobuildError("compressing to %s needs %s on the PATH" % (format, program))
+    options = ['-T%d' % jobs, '-%d' % level]
+    if format == 'zst':
+        options.insert(0, '-q')
+    return _PipedCompressor(file, [executable, '-c'] + options)
+
+
+class _BZ2Compressor(object):
+    """
+    Compress to one bz2 stream in this process.
+    """
+
+    def __init__(self, file, level):
+        self.file = file
+        self.compressor = bz2.BZ2Compressor(level)
+
+    def write(self, data):
+        self.file.write(self.compressor.compress(data))
+
+    def close(self):
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+
+    def abort(self):
+        self.compressor = None
+
+
+class _GzipCompressor(object):
+    """
+    Compress to gzip in this process.
+    """
+
+    def __init__(self, file, level):
+        # (GzipFile doesn't close a fileobj it's given; and with no time in
+        # the header, the same input gives the same output)
+        self.gzip = gzip.GzipFile(fileobj=file, mode='wb', compresslevel=level, mtime=0)
+
+    def write(self, data):
+        self.gzip.write(data)
+
+    def close(self):
+        self.gzip.close()
+
+    def abort(self):
+        pass
+
+
+class _PipedCompressor(object):
+    """
+    Compress to file by piping what is written through command, which
+    compresses its stdin to its stdout.
+    """
+
+    def __init__(self, file, command):
+        self.command = command
+        self.file = file
+        self.finished = False
+        # (a file rather than a pipe, so that it can't fill up while we write)
+        self.errors = tempfile.TemporaryFile()
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=self.errors)
+        except:
+            self.errors.close()
+            raise
+        # copy the compressor's output to file as it comes
+        self.copy_error = None
+        self.copier = threading.Thread(target=self.__copy, name="copy %s" % command[0])
+        self.copier.daemon = True
+        self.copier.start()
+
+    def __copy(self):
+        try:
+            shutil.copyfileobj(self.process.stdout, self.file, common.HASH_BLOCK_SIZE)
+        except Exception as err:
+            self.copy_error = err
+            # (so that the compressor can't block writing to us)
+            self.process.kill()
+
+    def write(self, data):
+        try:
+            self.process.stdin.write(data)
+        except IOError:
+            # the compressor has died: say why, if it said why
+            self.close()
+            raise
+
+    def close(self):
+        if self.finished:
+            return
+        self.finished = True
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.copier.join()
+        self.process.wait()
+        self.process.stdout.close()
+        self.errors.seek(0)
+        errors = self.errors.read()
+        self.errors.close()
+        if self.copy_error is not None:
+            raise self.copy_error
+        if self.process.returncode != 0:
+            raise common.AutobuildError("%s failed (%s): %s" % (' '.join(self.command),
+                                                                self.process.returncode,
+                                                                errors.strip()))
+
+    def abort(self):
+        """
+        Abandon the compressed data, leaving it incomplete.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        if self.process.poll() is None:
+            self.process.kill()
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.copier.join()
+        self.process.wait()
+        self.process.stdout.close()
+        self.errors.close()
+
+
+def _compress_block(chunk, level):
+    """
+    Compress chunk to a single bz2 block at level, returning the block as
+    a number of so many bits, that number of bits, and the block's CRC.
+    (Runs in a ParallelBZ2File worker process.)
+    """
+    stream = bz2.compress(chunk, level)
+    # A stream is a 32 bit header, its blocks, the 48 bit end magic and the
+    # 32 bit CRC of the stream, and up to 7 bits of padding to a whole byte.
+    total = len(stream) * 8
+    value = long(binascii.hexlify(stream), 16)
+    for padding in range(8):
+        if (value >> (padding + 32)) & 0xffffffffffff == _BZ2_END_MAGIC and \
+           value & ((1 << padding) - 1) == 0:
+            break
+    else:
+        raise common.AutobuildError("bz2 stream has no end")
+    stream_crc = (value >> padding) & 0xffffffff
+    bit_count = total - padding - 80 - 32
+    block = (value >> (padding + 80)) & ((1 << bit_count) - 1)
+    # the CRC of a stream of one block is the CRC of that block
+    if block >> (bit_count - 48) != _BZ2_BLOCK_MAGIC or \
+       (block >> (bit_count - 80)) & 0xffffffff != stream_crc:
+        raise common.AutobuildError("%d bytes did not compress to one bz2 block" % len(chunk))
+    return block, bit_count, stream_crc
+
+
+class ParallelBZ2File(object):
+    """
+    A write-only file object compressing to bz2 in file using up to jobs
+    processes. close() it (or use it in a with statement) to finish the
+    compressed data.
+
+    Each process compresses a chunk of the data to a bz2 block; the blocks
+    are then joined, bit by bit, into a single bz2 stream, just as bzip2
+    itself would write (though not byte for byte), which any bz2 reader can
+    read.
+    """
+
+    def __init__(self, file, jobs, chunk_size=None, level=9):
+        self.chunk_size = chunk_size or bz2_chunk_size(level)
+        self.level = level
+        self.jobs = jobs
+        self.buffer = []
+        self.buffered = 0
+        # chunks being compressed, oldest first; at most 2 * jobs, so that
+        # memory use doesn't depend on the size of the file
+        self.pending = collections.deque()
+        self.file = file
+        self.pool = multiprocessing.Pool(jobs)
+        self.finished = False
+        # the combined CRC of the blocks so far, and the bits that have yet
+        # to make up a whole byte
+        self.crc = 0
+        self.bits = 0
+        self.bit_count = 0
+        self.file.write('BZh%d' % level)
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            data = ''.join(self.buffer)
+            for start in xrange(0, len(data) - self.chunk_size + 1, self.chunk_size):
+                self.__compress(data[start:start + self.chunk_size])
+            rest = data[start + self.chunk_size:]
+            self.buffer = [rest]
+            self.buffered = len(rest)
+
+    def __compress(self, chunk):
+        while len(self.pending) >= 2 * self.jobs:
+            self.__write_block(*self.pending.popleft().get())
+        self.pending.append(self.pool.apply_async(_compress_block, (chunk, self.level)))
+
+    def __write_block(self, block, bit_count, crc):
+        self.crc = (((self.crc << 1) | (self.crc >> 31)) & 0xffffffff) ^ crc
+        self.__write_bits(block, bit_count)
+
+    def __write_bits(self, bits, bit_count):
+        bits |= self.bits << bit_count
+        bit_count += self.bit_count
+        spare = bit_count % 8
+        byte_count = bit_count // 8
+        if byte_count:
+            self.file.write(binascii.unhexlify('%0*x' % (byte_count * 2, bits >> spare)))
+        self.bits = bits & ((1 << spare) - 1)
+        self.bit_count = spare
+
+    def close(self):
+        if self.finished:
+            return
+        self.finished = True
+        try:
+            if self.buffered:
+                self.__compress(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+            while self.pending:
+                self.__write_block(*self.pending.popleft().get())
+            self.__write_bits(_BZ2_END_MAGIC, 48)
+            self.__write_bits(self.crc, 32)
+            if self.bit_count:
+                self.__write_bits(0, 8 - self.bit_count)
+            self.pool.close()
+        except:
+            self.pool.terminate()
+            raise
+        finally:
+            self.pool.join()
+
+    def abort(self):
+        """
+        Abandon the compressed data, leaving it incomplete.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.abort()
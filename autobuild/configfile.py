@@ -326,6 +326,9 @@ class Dependencies(common.Serialized):
     Attributes:
         dependencies - a map of MetadataDescriptions, indexed by package name
     """
+    # the autobuild_tool_install.InstalledFileIndex of these dependencies,
+    # once made (as a class variable, this isn't serialized)
+    file_index = None
 
     def __init__(self, path):
         self.version = AUTOBUILD_INSTALLED_VERSION
@@ -478,11 +481,18 @@ class MetadataDescription(common.Serialized):
 
     def save(self):
         """
-        Save the metadata.
+        Save the metadata, leaving the file alone (and so its modification
+        time, which autobuild package fingerprints) if it's unchanged.
         """
         if self.path:
-            file(self.path, 'wb').write(
-                llsd.format_pretty_xml(_compact_to_dict(self)))
+            metadata_xml = llsd.format_pretty_xml(_compact_to_dict(self))
+            try:
+                with open(self.path, 'rb') as metadata_file:
+                    if metadata_file.read() == metadata_xml:
+                        return
+            except IOError:
+                pass
+            file(self.path, 'wb').write(metadata_xml)
 
 
 package_selected_platform = None
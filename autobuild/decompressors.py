@@ -0,0 +1,246 @@
+#!/usr/bin/env python2
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+"""
+Read (possibly compressed) tarballs as a stream.
+
+Python's own bz2 and zlib decompressors use a single core. Where a
+multi-threaded external decompressor for an archive's format is on the
+PATH, open_tarball() runs it and reads its output through a pipe instead;
+otherwise tarfile decompresses the archive itself. Set
+$AUTOBUILD_DECOMPRESS=builtin to always use tarfile. (bz2 files are read
+through a bz2 decompressor of our own, which unlike tarfile's reads all of
+the streams in the multi-stream files written by pbzip2 and lbzip2.)
+
+Decompressors for further formats are registered with
+register_decompressor(); a format with no decompressor that tarfile
+supports can still be read if one of its external programs is found.
+"""
+
+from __future__ import absolute_import
+import os
+import bz2
+import errno
+import tarfile
+import signal
+import logging
+import subprocess
+import tempfile
+
+from . import common
+
+logger = logging.getLogger('autobuild.decompressors')
+
+# format name -> (leading magic bytes, external commands in order of
+# preference, True if tarfile can decompress it)
+REGISTERED_FORMATS = {}
+# format name -> the command found on the PATH (or None); see _command()
+_found = {}
+
+
+def register_decompressor(format, magic, commands, builtin):
+    """
+    Register how to decompress format: files that start with magic can be
+    piped through the first of commands (each a list: program followed by
+    the arguments that make it write the decompressed file named after
+    them to stdout) found on the PATH, else, if builtin, decompressed by
+    tarfile.
+    """
+    REGISTERED_FORMATS[format] = (magic, commands, builtin)
+    _found.pop(format, None)
+
+
+register_decompressor('bz2', 'BZh', [['lbzip2', '-d', '-c'], ['pbzip2', '-d', '-c']], True)
+register_decompressor('gz', '\x1f\x8b', [['pigz', '-d', '-c']], True)
+register_decompressor('xz', '\xfd7zXZ\x00', [['xz', '-d', '-c', '-T0']], False)
+register_decompressor('zst', '\x28\xb5\x2f\xfd', [['zstd', '-d', '-c', '-q']], False)
+
+# how many bytes of a file compression_format() needs
+MAGIC_SIZE = 6
+
+
+def compression_format(archive_path):
+    """
+    Return the name of the registered format archive_path is compressed in,
+    or None if it isn't (or is in an unknown format).
+    """
+    with open(archive_path, 'rb') as archive:
+        start = archive.read(MAGIC_SIZE)
+    for format, (magic, commands, builtin) in REGISTERED_FORMATS.iteritems():
+        if start.startswith(magic):
+            return format
+    return None
+
+
+def is_tarball(archive_path):
+    """
+    Like tarfile.is_tarfile(), but also recognizing the tarballs that can
+    only be read with an external decompressor.
+    """
+    if tarfile.is_tarfile(archive_path):
+        return True
+    format = compression_format(archive_path)
+    return format is not None and not REGISTERED_FORMATS[format][2] and \
+        _command(format) is not None
+
+
+def open_tarball(archive_path):
+    """
+    Open the tarball at archive_path for streaming reads. Use in a with
+    statement, which gives the tarfile.TarFile, as with tarfile.open(path,
+    'r|*'); an external decompressor that fails raises AutobuildError.
+    """
+    format = compression_format(archive_path)
+    command = _command(format) if format is not None else None
+    if command is None:
+        if format == 'bz2':
+            return _MultiStreamBZ2Tarball(archive_path)
+        return tarfile.open(archive_path, 'r|*')
+    return _PipedTarball(archive_path, command)
+
+
+def programs(format):
+    """
+    Return the names of the external programs that decompress format.
+    """
+    return [command[0] for command in REGISTERED_FORMATS[format][1]]
+
+
+def _command(format):
+    if os.environ.get('AUTOBUILD_DECOMPRESS') == 'builtin':
+        return None
+    try:
+        return _found[format]
+    except KeyError:
+        pass
+    command = None
+    for candidate in REGISTERED_FORMATS[format][1]:
+        program = common.find_executable(candidate[0])
+        if program is not None:
+            command = [program] + candidate[1:]
+            break
+    logger.debug("decompressing %s with %s" % (format, command[0] if command else "tarfile"))
+    _found[format] = command
+    return command
+
+
+class _PipedTarball(object):
+    """
+    A tarball read from the output of an external decompressor.
+    """
+
+    def __init__(self, archive_path, command):
+        self.command = command + [archive_path]
+        # (a file rather than a pipe, so that it can't fill up while we read)
+        self.errors = tempfile.TemporaryFile()
+        try:
+            self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE,
+                                            stderr=self.errors)
+        except:
+            self.errors.close()
+            raise
+        try:
+            self.tar = tarfile.open(fileobj=self.process.stdout, mode='r|')
+        except:
+            # report the decompressor's own failure, if that's what this was
+            self.__finish(check=True)
+            raise
+
+    def __enter__(self):
+        return self.tar
+
+    def __exit__(self, type, value, traceback):
+        self.tar.close()
+        # If the decompressor is still running, the reader stopped before the
+        # end of the stream, and what becomes of the rest doesn't matter.
+        self.__finish(check=type is None and self.process.poll() is not None)
+
+    def __finish(self, check):
+        if not check and self.process.poll() is None:
+            try:
+                self.process.kill()
+            except OSError as err:
+                if err.errno != errno.ESRCH:
+                    raise
+        self.process.stdout.close()
+        self.process.wait()
+        self.errors.seek(0)
+        errors = self.errors.read()
+        self.errors.close()
+        # (killed by SIGPIPE only if the reader gave up on the stream)
+        if check and self.process.returncode not in (0, -getattr(signal, 'SIGPIPE', 0)):
+            raise common.AutobuildError("%s failed (%s): %s" % (' '.join(self.command),
+                                                                self.process.returncode,
+                                                                errors.strip()))
+
+
+class _MultiStreamBZ2Tarball(object):
+    """
+    A bz2 tarball, possibly made up of several concatenated bz2 streams,
+    decompressed in this process.
+    """
+    # how much compressed data to read at a time
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, archive_path):
+        # (tarfile takes its name from this)
+        self.name = archive_path
+        self.file = open(archive_path, 'rb')
+        self.decompressor = bz2.BZ2Decompressor()
+        self.data = ''
+        self.offset = 0
+        try:
+            self.tar = tarfile.open(fileobj=self, mode='r|')
+        except:
+            self.file.close()
+            raise
+
+    def read(self, size):
+        # give tarfile what there is, so that it never waits for a
+        # whole block it doesn't need
+        while self.offset == len(self.data):
+            compressed = self.file.read(self.BLOCK_SIZE)
+            if not compressed:
+                return ''
+            self.data = ''
+            self.offset = 0
+            while compressed.strip('\0'):
+                try:
+                    self.data += self.decompressor.decompress(compressed)
+                except EOFError:
+                    # the last stream ended just where this data starts
+                    self.decompressor = bz2.BZ2Decompressor()
+                    continue
+                # anything after the end of one stream starts the next
+                compressed = self.decompressor.unused_data
+                if compressed:
+                    self.decompressor = bz2.BZ2Decompressor()
+        data = self.data[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def __enter__(self):
+        return self.tar
+
+    def __exit__(self, type, value, traceback):
+        self.tar.close()
+        self.file.close()
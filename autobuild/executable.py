@@ -71,13 +71,18 @@ class Executable(common.Serialized):
         self.parent = parent
         self.filters = filters
 
-    def __call__(self, options=[], environment=os.environ):
+    def __call__(self, options=[], environment=os.environ, cwd=None):
+        """
+        Run the command (in the directory cwd, if given) and return its
+        exit status.
+        """
         filters = self.get_filters()
         if filters:
             filters_re = [re.compile(filter, re.MULTILINE)
                           for filter in filters]
             process = subprocess.Popen(' '.join(self._get_all_arguments(options)),
-                                       shell=True, env=environment, stdout=subprocess.PIPE)
+                                       shell=True, env=environment, stdout=subprocess.PIPE,
+                                       cwd=cwd)
             for line in process.stdout:
                 if any(regex.search(line) for regex in filters_re):
                     continue
@@ -86,7 +91,8 @@ class Executable(common.Serialized):
                 print(line, end=' ')  # Trailing , prevents an extra newline
             return process.wait()
         else:
-            return subprocess.call(' '.join(self._get_all_arguments(options)), shell=True, env=environment)
+            return subprocess.call(' '.join(self._get_all_arguments(options)), shell=True, env=environment,
+                                   cwd=cwd)
 
     def __str__(self, options=[]):
         try:
@@ -30,13 +30,24 @@ $/LicenseInfo$
 
 from __future__ import print_function
 from __future__ import absolute_import
+import hashlib
 from . import common
 from .common import AutobuildError
 
+try:
+    import pyblake2
+except ImportError:
+    # blake2b is only supported where pyblake2 is installed
+    pyblake2 = None
+
 # Valid configfile.ArchiveDescription.hash_algorithm values are registered
 # here by means of the @hash_algorithm decorator.
 REGISTERED_ALGORITHMS = {}
 
+# Algorithms that can also be computed incrementally (e.g. while a file is
+# being downloaded) register a hashlib-style constructor here as well.
+REGISTERED_HASHERS = {}
+
 
 class hash_algorithm(object):
     """
@@ -46,25 +57,59 @@ class hash_algorithm(object):
     @hash_algorithm("md5")
     def _verify_md5(self, pathname, hash):
         ...
+
+    Pass a hashlib-style constructor as hasher if the algorithm can be
+    computed incrementally; see new_hasher().
     """
     # called when we instantiate @hash_algorithm("md5")
 
-    def __init__(self, key):
+    def __init__(self, key, hasher=None):
         self.key = key
+        self.hasher = hasher
 
     # called when this decorator is applied to an implementation function
     def __call__(self, func):
         global REGISTERED_ALGORITHMS
         # Register the decorated function with the specified key.
         REGISTERED_ALGORITHMS[self.key] = func
+        if self.hasher is not None:
+            REGISTERED_HASHERS[self.key] = self.hasher
         # Unlike many decorators, we don't want to wrap the passed function in
         # any way; just return the same function.
         return func
 
 
-def verify_hash(hash_algorithm, pathname, hash):
+def new_hasher(hash_algorithm):
+    """
+    Return a new hasher object (with update() and hexdigest() methods) for
+    hash_algorithm, or None if that algorithm can only be verified by
+    reading the whole file.
+    """
+    try:
+        return REGISTERED_HASHERS[hash_algorithm or "md5"]()
+    except KeyError:
+        return None
+
+
+def compute_hash(hash_algorithm, pathname):
+    """
+    Return the hash_algorithm hash of the file at pathname, reading it a
+    block at a time.
+    """
+    hasher = new_hasher(hash_algorithm)
+    if hasher is None:
+        raise AutobuildError("Unsupported hash type %s for %s" %
+                             (hash_algorithm, pathname))
+    return common.compute_hash(pathname, hasher)
+
+
+def verify_hash(hash_algorithm, pathname, hash, hasher=None):
     """
     Primary entry point for this module
+
+    If the caller has already fed the entire content of pathname to a
+    hasher obtained from new_hasher(), passing it as hasher compares its
+    digest instead of reading the file again.
     """
     if not hash:
         # If there's no specified hash value, what can we do? We could
@@ -86,11 +131,65 @@ def verify_hash(hash_algorithm, pathname, hash):
         raise AutobuildError("Unsupported hash type %s for %s" %
                              (hash_algorithm, pathname))
 
+    if hasher is not None:
+        return hasher.hexdigest() == hash
+
     # Apparently we do have a function to support this hash_algorithm. Call
     # it.
     return function(pathname, hash)
 
 
-@hash_algorithm("md5")
+class HashingWriter(object):
+    """
+    A write-only file object that writes to file and also feeds what is
+    written to a hasher for each of hash_algorithms, so that a file can be
+    hashed while it is written rather than read back afterwards. It counts
+    what has been written for tell(), but can't seek.
+    """
+
+    def __init__(self, file, hash_algorithms):
+        self.file = file
+        # (GzipFile and ZipFile use the name, if there is one)
+        self.name = getattr(file, 'name', None)
+        self.hashers = []
+        for algorithm in hash_algorithms:
+            hasher = new_hasher(algorithm)
+            if hasher is None:
+                raise AutobuildError("Unsupported hash type %s" % algorithm)
+            self.hashers.append((algorithm, hasher))
+        self.position = 0
+
+    def write(self, data):
+        for algorithm, hasher in self.hashers:
+            hasher.update(data)
+        self.file.write(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        self.file.flush()
+
+    def hexdigests(self):
+        """
+        Return a list of (hash_algorithm, hexdigest) pairs for what has been
+        written, in the order of hash_algorithms.
+        """
+        return [(algorithm, hasher.hexdigest()) for algorithm, hasher in self.hashers]
+
+
+@hash_algorithm("md5", hashlib.md5)
 def _verify_md5(pathname, hash):
     return common.compute_md5(pathname) == hash
+
+
+@hash_algorithm("sha256", hashlib.sha256)
+def _verify_sha256(pathname, hash):
+    return compute_hash("sha256", pathname) == hash
+
+
+if pyblake2 is not None:
+    @hash_algorithm("blake2b", pyblake2.blake2b)
+    def _verify_blake2b(pathname, hash):
+        return compute_hash("blake2b", pathname) == hash
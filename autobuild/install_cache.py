@@ -0,0 +1,727 @@
+#!/usr/bin/env python2
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+
+"""
+Bookkeeping for the local cache of downloaded package archives.
+
+The archives live in common.get_install_cache_dir(), addressed by their
+content:
+
+    <cache>/<hash_algorithm>/<hash[:2]>/<hash>/<archive filename>
+
+so that different archives with the same filename never collide, and the
+same archive downloaded from several mirrors is stored once. (The archive
+filename is kept because metadata for legacy packages is derived from it.)
+Archives found in the flat layout used by earlier versions of autobuild,
+<cache>/<archive filename>, are moved into place when first needed.
+
+Next to the archives we keep an index recording
+- which cached files have already been verified against their expected
+  hash, and the size, mtime and inode each had at the time, so that an
+  unchanged file need not be hashed again on every install;
+- the hash of the archive last downloaded from each url, so that an
+  archive configured without a hash can still be found in the cache;
+- the size of each cached archive and when it was last used, so that the
+  cache can be kept within $AUTOBUILD_CACHE_MAX_BYTES by evicting the least
+  recently used archives without having to scan the cache directory.
+
+Several autobuild processes may share the cache. Each archive is fetched
+and verified while holding a lock file next to it, so that one process
+downloads it while the others wait and then reuse it, and nothing is ever
+removed while another process is writing it. An install then holds a
+shared lock on each archive it fetched (see CacheIndex.use_lock()) until
+it has extracted it, so that the archive isn't evicted in between. Downloads are written to a
+'.partial' file and renamed into place only once complete and verified.
+Saving the index merges this process's changes with whatever other
+processes have saved meanwhile.
+
+Optionally (autobuild install --unpacked-cache), each archive is also
+extracted once into a read-only tree under <cache>/unpacked/<algorithm>/
+<hash[:2]>/<hash>, from which installs clone the files (see clone_file())
+rather than decompressing the archive again. A tree is removed along with
+its archive, but is not counted towards the cache size.
+"""
+
+from __future__ import absolute_import
+import os
+import sys
+import json
+import time
+import errno
+import shutil
+import hashlib
+import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+from . import common
+from . import hash_algorithms
+
+logger = logging.getLogger('autobuild.install_cache')
+
+CACHE_INDEX_FILE = "autobuild-cache-index.json"
+CACHE_INDEX_VERSION = 1
+
+# suffix for a download in progress, which may be resumed by a later attempt
+PARTIAL_SUFFIX = ".partial"
+# suffix for the lock file guarding a cache entry (or the index)
+LOCK_SUFFIX = ".lock"
+# suffix for the lock file shared by the users of a cached archive
+USE_LOCK_SUFFIX = ".use" + LOCK_SUFFIX
+# where downloads of archives whose hash isn't known in advance are made
+INCOMING_DIR = "incoming"
+# where archives are unpacked, when installing from unpacked trees
+UNPACKED_DIR = "unpacked"
+
+
+class CacheIndex(object):
+    """
+    The index file in the install cache directory.
+
+    Attributes:
+        cache_dir - the install cache directory
+        path - the index file itself
+        paranoid - if True, never trust a previous verification
+        verified - map from cache file (relative to cache_dir) to a dict
+                   with size, mtime, inode, hash_algorithm and hash
+        urls - map from url to a dict with the hash_algorithm and hash of
+               the archive last downloaded from there
+        used - map from cache file (relative to cache_dir) to a dict with
+               its size, the time it was last_used, and its dev and inode
+               (since mirror names hard linked to one file share its space)
+
+    The index is read when the object is created and again by refresh(),
+    and written by save(). Its methods may be called from several threads
+    at once.
+    """
+    MAPS = ('verified', 'urls', 'used')
+
+    def __init__(self, cache_dir=None, paranoid=False):
+        self.cache_dir = cache_dir or common.get_install_cache_dir()
+        self.path = os.path.join(self.cache_dir, CACHE_INDEX_FILE)
+        self.paranoid = paranoid
+        self.verified = {}
+        self.urls = {}
+        self.used = {}
+        self.lock = threading.Lock()
+        # keys in each map that we have changed (or removed) since loading
+        self.changed = dict((name, set()) for name in self.MAPS)
+        self.refresh()
+
+    @property
+    def dirty(self):
+        return any(self.changed.itervalues())
+
+    def __load(self):
+        try:
+            with open(self.path, 'rb') as index_file:
+                saved = json.load(index_file)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                logger.warning("cannot read cache index %s: %s" % (self.path, err))
+            return {}
+        except ValueError as err:
+            logger.warning("ignoring unreadable cache index %s: %s" % (self.path, err))
+            return {}
+        if saved.get('version') != CACHE_INDEX_VERSION:
+            logger.info("ignoring cache index version %s" % saved.get('version'))
+            return {}
+        return saved
+
+    def __merge(self, saved):
+        # take whatever other processes have saved, except where we have
+        # changes of our own
+        for name in self.MAPS:
+            merged = saved.get(name, {})
+            ours = getattr(self, name)
+            for key in self.changed[name]:
+                if key in ours:
+                    merged[key] = ours[key]
+                else:
+                    merged.pop(key, None)
+            setattr(self, name, merged)
+
+    def refresh(self):
+        """
+        Pick up changes saved to the index by other processes.
+        """
+        saved = self.__load()
+        with self.lock:
+            self.__merge(saved)
+
+    def save(self):
+        """
+        Merge our changes into the index in the cache directory.
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                with FileLock(self.path + LOCK_SUFFIX):
+                    self.__merge(self.__load())
+                    data = json.dumps(dict(version=CACHE_INDEX_VERSION,
+                                           verified=self.verified,
+                                           urls=self.urls,
+                                           used=self.used))
+                    common.atomic_write(self.path, data)
+            except (IOError, OSError) as err:
+                # the index is only an optimization; losing it costs time
+                logger.warning("cannot write cache index %s: %s" % (self.path, err))
+            for keys in self.changed.itervalues():
+                keys.clear()
+
+    def _set(self, name, key, value):
+        # call with self.lock held
+        getattr(self, name)[key] = value
+        self.changed[name].add(key)
+
+    def _drop(self, name, key):
+        # call with self.lock held
+        if getattr(self, name).pop(key, None) is not None:
+            self.changed[name].add(key)
+
+    def entry_lock(self, url, hash_algorithm, hash):
+        """
+        Return a FileLock to hold while fetching the archive from url with
+        the given hash (if known) into the cache.
+        """
+        return FileLock(self.download_path(url, hash_algorithm, hash) + LOCK_SUFFIX)
+
+    @staticmethod
+    def use_lock(pathname):
+        """
+        Return a shared FileLock to hold while using the cached archive
+        pathname, so that evict() leaves it alone.
+        """
+        return FileLock(pathname + USE_LOCK_SUFFIX, shared=True)
+
+    def _key(self, pathname):
+        return os.path.relpath(pathname, self.cache_dir)
+
+    @staticmethod
+    def _stat(pathname):
+        stat = os.stat(pathname)
+        return dict(size=stat.st_size, mtime=stat.st_mtime, inode=stat.st_ino)
+
+    def is_verified(self, pathname, hash_algorithm, hash):
+        """
+        Return True if pathname was previously verified to have the given
+        hash and has apparently not changed since.
+        """
+        if self.paranoid or not hash:
+            return False
+        with self.lock:
+            record = self.verified.get(self._key(pathname))
+        if not record \
+                or record.get('hash_algorithm') != (hash_algorithm or "md5") \
+                or record.get('hash') != hash:
+            return False
+        try:
+            current = self._stat(pathname)
+        except OSError:
+            return False
+        return all(record.get(field) == value for field, value in current.iteritems())
+
+    def record_verified(self, pathname, hash_algorithm, hash):
+        """
+        Remember that pathname, as it is now, has been verified to have the
+        given hash.
+        """
+        if not hash:
+            # nothing was really verified
+            return
+        record = self._stat(pathname)
+        record.update(hash_algorithm=(hash_algorithm or "md5"), hash=hash)
+        with self.lock:
+            self._set('verified', self._key(pathname), record)
+
+    def forget(self, pathname):
+        """
+        Drop any record for pathname, e.g. because it has been removed.
+        """
+        key = self._key(pathname)
+        with self.lock:
+            self._drop('verified', key)
+            self._drop('used', key)
+
+    def touch(self, pathname):
+        """
+        Remember that the cached archive pathname was used just now.
+        """
+        try:
+            stat = os.stat(pathname)
+        except OSError:
+            return
+        with self.lock:
+            self._set('used', self._key(pathname), dict(size=stat.st_size, last_used=time.time(),
+                                                        dev=stat.st_dev, inode=stat.st_ino))
+
+    def total_size(self):
+        """
+        Return the total size of the archives in the index, counting each
+        file (however many names are linked to it) once.
+        """
+        with self.lock:
+            return sum(records[0]['size'] for records in _by_file(self.used).itervalues())
+
+    def evict(self, max_bytes, dry_run=False):
+        """
+        Remove the least recently used archives until those remaining total
+        no more than max_bytes. Only the index is consulted, so archives it
+        doesn't know about (see rescan()) are neither counted nor removed.
+        Archives another process is fetching or using are skipped.
+        Returns a list of the (pathname, size) pairs removed, where size is
+        the space freed: none until the last name linked to a file goes.
+        """
+        self.refresh()
+        with self.lock:
+            oldest_first = sorted(self.used.iteritems(),
+                                  key=lambda item: item[1]['last_used'])
+            # file -> the records of the names still linked to it
+            files = _by_file(self.used)
+        total = sum(records[0]['size'] for records in files.itervalues())
+        evicted = []
+
+        def unlink(record):
+            # the space freed by removing the name of record
+            names = files[_file_key(record)]
+            names.remove(record)
+            return 0 if names else record['size']
+
+        for key, record in oldest_first:
+            if total <= max_bytes:
+                break
+            pathname = os.path.join(self.cache_dir, key)
+            if not os.path.exists(pathname):
+                # evicted meanwhile, and recorded again by some process that
+                # had used it before then
+                self.forget(pathname)
+                total -= unlink(record)
+                continue
+            if not dry_run:
+                lock = FileLock(pathname + LOCK_SUFFIX)
+                if not lock.acquire(blocking=False):
+                    logger.info("not evicting %s: in use" % key)
+                    continue
+                try:
+                    use_lock = FileLock(pathname + USE_LOCK_SUFFIX)
+                    if not use_lock.acquire(blocking=False):
+                        logger.info("not evicting %s: in use" % key)
+                        continue
+                    try:
+                        logger.info("evicting %s from install cache" % key)
+                        self._remove(pathname)
+                    finally:
+                        use_lock.release(remove=True)
+                finally:
+                    lock.release(remove=True)
+                self._remove_empty_dirs(pathname)
+            freed = unlink(record)
+            total -= freed
+            evicted.append((pathname, freed))
+        return evicted
+
+    def rescan(self):
+        """
+        Bring the index up to date with the cache directory: add archives it
+        doesn't know about (e.g. left by older versions of autobuild), using
+        their access time as a best guess at when they were last used, and
+        drop the records of archives that no longer exist.
+        """
+        found = set()
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            if dirpath == self.cache_dir:
+                # downloads in progress and unpacked trees are not archives
+                dirnames[:] = [d for d in dirnames if d not in (INCOMING_DIR, UNPACKED_DIR)]
+            for filename in filenames:
+                pathname = os.path.join(dirpath, filename)
+                if filename.endswith(PARTIAL_SUFFIX) or filename.endswith(LOCK_SUFFIX) \
+                        or filename.startswith(CACHE_INDEX_FILE):
+                    continue
+                key = self._key(pathname)
+                found.add(key)
+                with self.lock:
+                    if key not in self.used:
+                        stat = os.stat(pathname)
+                        self._set('used', key, dict(size=stat.st_size,
+                                                    last_used=max(stat.st_atime, stat.st_mtime),
+                                                    dev=stat.st_dev, inode=stat.st_ino))
+        with self.lock:
+            for key in set(self.used) - found:
+                self._drop('used', key)
+                self._drop('verified', key)
+
+    def _remove(self, pathname):
+        try:
+            os.remove(pathname)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                logger.warning("cannot remove %s: %s" % (pathname, err))
+                return
+        self.forget(pathname)
+        with self.lock:
+            for url, record in self.urls.items():
+                if self.content_path(url, record['hash_algorithm'], record['hash']) == pathname:
+                    self._drop('urls', url)
+        parts = self._key(pathname).split(os.sep)
+        if len(parts) == 4:
+            # <algorithm>/<hash[:2]>/<hash>/<archive>: drop its unpacked tree too
+            tree = self.unpacked_path(parts[0], parts[2])
+            if os.path.isdir(tree):
+                lock = FileLock(tree + LOCK_SUFFIX)
+                if lock.acquire(blocking=False):
+                    try:
+                        shutil.rmtree(tree, ignore_errors=True)
+                    finally:
+                        lock.release(remove=True)
+
+    def _remove_empty_dirs(self, pathname):
+        # tidy away the now empty <hash> and <hash[:2]> directories
+        directory = os.path.dirname(pathname)
+        for level in range(2):
+            if directory == self.cache_dir:
+                break
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def content_path(self, url, hash_algorithm, hash):
+        """
+        Return where the archive from url with the given hash belongs.
+        """
+        return os.path.join(self.cache_dir, hash_algorithm or "md5", hash[:2], hash,
+                            os.path.basename(url))
+
+    def unpacked_path(self, hash_algorithm, hash):
+        """
+        Return where the tree unpacked from the archive with the given hash
+        belongs.
+        """
+        return os.path.join(self.cache_dir, UNPACKED_DIR, hash_algorithm or "md5", hash[:2], hash)
+
+    def download_path(self, url, hash_algorithm, hash):
+        """
+        Return the path to which the archive from url should be downloaded
+        (followed by store()), creating its directory if need be.
+        """
+        if hash:
+            path = self.content_path(url, hash_algorithm, hash)
+        else:
+            path = os.path.join(self.cache_dir, INCOMING_DIR, hashlib.md5(url).hexdigest(),
+                                os.path.basename(url))
+        _makedirs(os.path.dirname(path))
+        return path
+
+    def lookup(self, url, hash_algorithm, hash):
+        """
+        Return the path of the cached archive from url with the given hash --
+        or, if hash is None, of whatever archive was last downloaded from
+        url -- or None if there is no such archive in the cache.
+
+        The archive is not verified here.
+        """
+        hash_algorithm = hash_algorithm or "md5"
+        if not hash:
+            with self.lock:
+                known = self.urls.get(url)
+            if known:
+                hash_algorithm, hash = known['hash_algorithm'], known['hash']
+        if hash:
+            path = self.content_path(url, hash_algorithm, hash)
+            if os.path.exists(path) or self._link_mirror(path):
+                self.touch(path)
+                return path
+        path = self._adopt_legacy(url, hash_algorithm, hash)
+        if path is not None:
+            self.touch(path)
+        return path
+
+    def store(self, download, url, hash_algorithm, hash):
+        """
+        Move the completed and verified download of url, which has the
+        given hash, to its place in the cache and record it there.
+        Returns the new path.
+        """
+        path = self.content_path(url, hash_algorithm, hash)
+        if download != path:
+            _makedirs(os.path.dirname(path))
+            try:
+                os.rename(download, path)
+            except OSError:
+                # Windows won't rename over an existing file
+                if not os.path.exists(path):
+                    raise
+                os.remove(path)
+                os.rename(download, path)
+        self.record_verified(path, hash_algorithm, hash)
+        self.record_url(url, hash_algorithm, hash)
+        self.touch(path)
+        return path
+
+    def record_url(self, url, hash_algorithm, hash):
+        with self.lock:
+            record = dict(hash_algorithm=(hash_algorithm or "md5"), hash=hash)
+            if self.urls.get(url) != record:
+                self._set('urls', url, record)
+
+    def _link_mirror(self, path):
+        """
+        If the same archive is already cached under another filename (e.g.
+        as downloaded from a different mirror), link (or copy) it to path.
+        """
+        directory = os.path.dirname(path)
+        try:
+            others = [name for name in os.listdir(directory)
+                      if not name.endswith(PARTIAL_SUFFIX) and not name.endswith(LOCK_SUFFIX)]
+        except OSError:
+            return False
+        if not others:
+            return False
+        _link_or_copy(os.path.join(directory, others[0]), path)
+        logger.debug("reusing cached %s as %s" % (others[0], path))
+        return True
+
+    def _adopt_legacy(self, url, hash_algorithm, hash):
+        """
+        Move an archive cached in the old flat layout into its content
+        addressed place, provided it's the one we want.
+        """
+        legacy = os.path.join(self.cache_dir, os.path.basename(url))
+        if not os.path.isfile(legacy):
+            return None
+        if hash:
+            if not hash_algorithms.verify_hash(hash_algorithm, legacy, hash):
+                # some other archive with the same filename: leave it alone
+                return None
+        else:
+            hash = hash_algorithms.compute_hash(hash_algorithm, legacy)
+        logger.info("moving %s into content addressed cache" % legacy)
+        return self.store(legacy, url, hash_algorithm, hash)
+
+
+def _file_key(record):
+    # records saved by older versions lack the inode: count those separately
+    if 'inode' in record:
+        return (record.get('dev'), record['inode'])
+    return id(record)
+
+
+def _by_file(used):
+    """
+    Group the records in used by the file (dev, inode) their names link to.
+    """
+    files = {}
+    for record in used.itervalues():
+        files.setdefault(_file_key(record), []).append(record)
+    return files
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+def _link_or_copy(source, dest):
+    try:
+        os.link(source, dest)
+    except (AttributeError, OSError):
+        # no os.link() on Windows (Python 2), or a filesystem without links
+        shutil.copy2(source, dest)
+
+
+def clone_file(source, dest, mode=None, hardlink=False):
+    """
+    Make dest a copy of the cached, read-only file source, as cheaply as the
+    filesystem allows: a reflink (a copy-on-write clone), else a real copy
+    -- or, only if hardlink, a hard link, which shares the read-only mode
+    (and any later change) of source. A reflink or copy is given mode, if
+    specified. A symbolic link is copied as a link.
+    """
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), dest)
+        return
+    if _reflink(source, dest):
+        shutil.copystat(source, dest)
+    else:
+        if hardlink:
+            try:
+                os.link(source, dest)
+                return
+            except (AttributeError, OSError):
+                # no os.link() on Windows (Python 2), or not on this filesystem
+                pass
+        shutil.copy2(source, dest)
+    if mode is not None:
+        os.chmod(dest, mode)
+
+
+# ioctl to clone a file on Linux, from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# whether reflinks work from one device to another: (source st_dev, dest
+# st_dev) -> True or False, once tried
+_reflinks = {}
+
+
+def _reflink(source, dest):
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    with open(source, 'rb') as source_file:
+        with open(dest, 'wb') as dest_file:
+            devices = (os.fstat(source_file.fileno()).st_dev,
+                       os.fstat(dest_file.fileno()).st_dev)
+            if _reflinks.get(devices) is not False:
+                try:
+                    fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+                    _reflinks[devices] = True
+                except IOError as err:
+                    logger.debug("reflinks unavailable from %s to %s: %s" %
+                                 (source, dest, err))
+                    _reflinks[devices] = False
+    if not _reflinks[devices]:
+        os.remove(dest)
+        return False
+    return True
+
+
+class FileLock(object):
+    """
+    An exclusive lock, shared between processes, on the lock file at path;
+    or, if shared, a lock that excludes only exclusive holders. Use as a
+    context manager, or call acquire() and release().
+
+    Windows has no shared locks: there a shared lock is taken exclusively if
+    it's free, and otherwise not taken at all (acquire() still returns
+    True), so that its holders don't wait for each other.
+
+    Attributes:
+        waited - True if acquiring the lock had to wait for another holder
+    """
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.fd = None
+        self.waited = False
+
+    def acquire(self, blocking=True):
+        """
+        Acquire the lock, waiting for it if blocking, and return True;
+        or return False if not blocking and it's held elsewhere.
+        """
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if not _lock_fd(fd, blocking=False, shared=self.shared):
+                    if self.shared and fcntl is None:
+                        # see above: some other holder keeps it for us all
+                        os.close(fd)
+                        return True
+                    if not blocking:
+                        os.close(fd)
+                        return False
+                    logger.info("waiting for %s" % self.path)
+                    self.waited = True
+                    _lock_fd(fd, blocking=True, shared=self.shared)
+                # A holder may have removed the lock file before releasing it
+                # (see release()), in which case we hold a lock nobody else
+                # will see: start again with the file now at path.
+                if fcntl is not None and os.fstat(fd).st_ino != _inode(self.path):
+                    os.close(fd)
+                    continue
+            except:
+                os.close(fd)
+                raise
+            self.fd = fd
+            return True
+
+    def release(self, remove=False):
+        """
+        Release the lock, first removing the lock file if remove is True
+        (e.g. because what it guarded is gone).
+        """
+        if self.fd is None:
+            # a shared lock on Windows that another holder has
+            return
+        if remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                # e.g. on Windows, where another process has it open
+                pass
+        _unlock_fd(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+
+def _inode(path):
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
+
+
+def _lock_fd(fd, blocking, shared=False):
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) |
+                        (0 if blocking else fcntl.LOCK_NB))
+        except IOError as err:
+            if blocking or err.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        return True
+    while True:
+        try:
+            # LK_NBLCK fails at once if the lock is held; LK_LOCK retries
+            # for about 10 seconds before failing
+            msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            return True
+        except IOError:
+            if not blocking:
+                return False
+
+
+def _unlock_fd(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python2
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+"""
+Match a package's manifest patterns against its build tree in one walk.
+
+A manifest is a list of glob patterns relative to the build directory, as
+understood by the glob module, plus:
+
+* A '**' path segment matches any number (including none) of directories,
+  so 'lib/**/*.a' matches both lib/x.a and lib/debug/x.a, and 'lib/**'
+  matches lib itself.
+* A pattern starting with '!' excludes what it matches, wherever it comes
+  in the manifest: ['include', '!include/**/*.in'].
+
+A matched directory is packaged whole, so nothing inside it is listed
+separately -- unless an exclusion pattern matches something inside it, in
+which case the files it contains are listed one by one instead (dropping
+any empty directories).
+
+Rather than globbing each pattern in turn, which walks the tree once per
+pattern, all the patterns are compiled into one matcher that follows every
+pattern at once through a single walk of the tree, descending only into
+directories that some pattern could still match inside. (Patterns the
+walk can't follow, such as absolute paths or paths through '..', are
+globbed as before.)
+"""
+
+from __future__ import absolute_import
+import os
+import re
+import glob
+import fnmatch
+
+from . import common
+
+try:
+    # much faster than listdir() and stat(), where it's installed
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+# does this platform's file system ignore case?
+_IGNORE_CASE = os.path.normcase('A') == 'a'
+
+RECURSIVE = '**'
+EXCLUDE = '!'
+
+# how ManifestMatcher.__walk() treats what it finds in a directory:
+# list what matches a pattern
+_SEARCH = 'search'
+# list every file, the directory itself having matched
+_LIST = 'list'
+# list nothing, the directory being packaged whole, but note the patterns
+# matched (as globbing them would have)
+_COVERED = 'covered'
+
+
+def match_manifest(manifest, build_directory):
+    """
+    Match the manifest patterns against build_directory, returning
+    (files, missing): the set of paths, relative to build_directory, to be
+    packaged, and the list of (inclusion) patterns that matched nothing.
+    """
+    return ManifestMatcher(manifest).match(build_directory)
+
+
+class ManifestMatcher(object):
+    def __init__(self, manifest):
+        # (pattern, segments, exclude) for each pattern the walk follows;
+        # see _compile() for the segments
+        self.patterns = []
+        # patterns to be globbed instead
+        self.globbed = []
+        self.order = dict((pattern, index) for index, pattern in enumerate(manifest))
+        for pattern in manifest:
+            exclude = pattern.startswith(EXCLUDE)
+            path = pattern[len(EXCLUDE):] if exclude else pattern
+            segments = path.replace(os.sep, '/').replace(os.altsep or '/', '/').split('/')
+            if os.path.isabs(path) or os.path.splitdrive(path)[0] or \
+               any(segment in ('', '.', '..') for segment in segments):
+                if exclude:
+                    # (only paths under the build directory can be excluded)
+                    raise common.AutobuildError("manifest can't exclude %s: "
+                                                "it isn't a path within the build directory" % path)
+                self.globbed.append(pattern)
+                continue
+            self.patterns.append((pattern, [_compile(segment) for segment in segments], exclude))
+
+    def match(self, build_directory):
+        """
+        Return (files, missing); see match_manifest().
+        """
+        self.files = set()
+        self.matched = set()
+        start = self.__closure(set((index, 0) for index in xrange(len(self.patterns))))
+        self.__walk(build_directory, '', start, _SEARCH)
+        missing = [pattern for index, (pattern, segments, exclude) in enumerate(self.patterns)
+                   if not exclude and index not in self.matched]
+        for pattern in self.globbed:
+            found = glob.glob(os.path.join(build_directory, pattern))
+            if not found:
+                missing.append(pattern)
+            for path in found:
+                self.files.add(path if os.path.isabs(pattern)
+                               else os.path.relpath(path, build_directory))
+        # report them in manifest order, as globbing each in turn did
+        missing.sort(key=self.order.get)
+        return self.files, missing
+
+    def __walk(self, directory, relative, states, mode):
+        """
+        Match the entries of directory (relative to the build directory
+        as relative) as the walk stands in states, a set of (pattern index,
+        segment index) pairs: the next segment each pattern has to match.
+        mode is _SEARCH, _LIST or _COVERED.
+        """
+        # sort the states by the kind of segment to be matched next
+        literal = {}
+        wild = []
+        recursive = []
+        for state in states:
+            segment = self.patterns[state[0]][1][state[1]]
+            if segment is RECURSIVE:
+                recursive.append(state)
+            elif segment[2] is not None:
+                literal.setdefault(_key(segment[2]), (segment[2], []))[1].append(state)
+            else:
+                wild.append((state, segment[0], segment[1]))
+        if wild or recursive or mode is _LIST:
+            entries = _entries(directory)
+        else:
+            # only particular names can match: look for just those, as glob
+            # does, rather than listing what might be a big directory
+            entries = dict((name, _Entry(directory, name)) for name, found in literal.itervalues()
+                           if os.path.lexists(os.path.join(directory, name)))
+        # name -> the states it advances, for each name that matches anything
+        hits = {}
+        if literal:
+            if _IGNORE_CASE:
+                present = [name for name in entries if _key(name) in literal]
+            else:
+                present = set(literal).intersection(entries)
+            for name in present:
+                hits[name] = set((index, position + 1)
+                                 for index, position in literal[_key(name)][1])
+        names = entries
+        if len(wild) > 1:
+            # one pass over the names with all the patterns at once leaves
+            # just those that match something to be matched pattern by pattern
+            names = filter(_combine(regex for state, regex, matches_hidden in wild).match, names)
+        for (index, position), regex, matches_hidden in wild:
+            for name in filter(regex.match, names):
+                if matches_hidden or not name.startswith('.'):
+                    hits.setdefault(name, set()).add((index, position + 1))
+        if recursive:
+            for name, entry in entries.iteritems():
+                # '**' goes on matching directories, not hidden ones -- nor
+                # symbolic links, which might loop
+                if not name.startswith('.') and entry.is_dir() and not entry.is_link():
+                    hits.setdefault(name, set()).update(recursive)
+        for name in (entries if mode is _LIST else hits):
+            advanced = self.__closure(hits.get(name, ()))
+            path = os.path.join(relative, name)
+            matched = excluded = False
+            for index, position in advanced:
+                pattern, segments, exclude = self.patterns[index]
+                if position == len(segments):
+                    if exclude:
+                        excluded = True
+                    else:
+                        self.matched.add(index)
+                        matched = True
+            if excluded:
+                continue
+            listed = mode is not _COVERED and (matched or mode is _LIST)
+            # what can still be matched (or excluded) inside, if it's a
+            # directory?
+            live = set(state for state in advanced
+                       if state[1] < len(self.patterns[state[0]][1]))
+            if not (live or mode is _LIST) or not entries[name].is_dir():
+                # (without a stat() if it makes no difference)
+                if listed:
+                    self.files.add(path)
+                continue
+            inner = mode
+            if listed:
+                if any(self.patterns[index][2] for index, position in live):
+                    # something inside may be excluded: list it file by file
+                    inner = _LIST
+                else:
+                    self.files.add(path)
+                    # look inside only for patterns yet to be matched
+                    live = set(state for state in live if state[0] not in self.matched)
+                    inner = _COVERED
+            if live or inner is _LIST:
+                self.__walk(os.path.join(directory, name), path, live, inner)
+
+    def __closure(self, states):
+        # a '**' can also match no directories at all
+        closure = set(states)
+        for index, position in states:
+            segments = self.patterns[index][1]
+            while position < len(segments) and segments[position] is RECURSIVE:
+                position += 1
+                closure.add((index, position))
+        return closure
+
+
+if _IGNORE_CASE:
+    def _key(name):
+        return name.lower()
+else:
+    def _key(name):
+        return name
+
+
+def _compile(segment):
+    """
+    Return RECURSIVE for a '**' segment, else (regex matching the names it
+    matches, whether it matches hidden names, the segment if it's a
+    literal name or None).
+    """
+    if segment == RECURSIVE:
+        return RECURSIVE
+    return (re.compile(fnmatch.translate(segment), re.IGNORECASE if _IGNORE_CASE else 0),
+            segment.startswith('.'),
+            None if glob.has_magic(segment) else segment)
+
+
+def _combine(regexes):
+    """
+    Return a regex matching whatever any of regexes (from _compile()) does.
+    """
+    # (each fnmatch.translate() regex ends with the same flags)
+    return re.compile('|'.join('(?:%s)' % regex.pattern for regex in regexes),
+                      re.IGNORECASE if _IGNORE_CASE else 0)
+
+
+def _entries(directory):
+    """
+    Return a dict of the entries of directory, by name, as objects with
+    is_dir() and is_link() methods, following symbolic links as glob does
+    -- and, as glob does, taking a directory that can't be read as empty.
+    """
+    try:
+        if scandir is not None:
+            return dict((entry.name, _ScandirEntry(entry)) for entry in scandir(directory))
+        return _Directory(directory, os.listdir(directory))
+    except OSError:
+        return {}
+
+
+class _Directory(dict):
+    """
+    The entries of a directory, each made only once it's looked up.
+    """
+
+    def __init__(self, directory, names):
+        dict.__init__(self, ((name, None) for name in names))
+        self.directory = directory
+
+    def __getitem__(self, name):
+        entry = dict.__getitem__(self, name)
+        if entry is None:
+            entry = _Entry(self.directory, name)
+            self[name] = entry
+        return entry
+
+    def iteritems(self):
+        for name in self:
+            yield name, self[name]
+
+
+class _Entry(object):
+    """
+    A directory entry, which is only stat()ed if its type is asked for.
+    """
+    __slots__ = ('path', 'dir', 'link')
+
+    def __init__(self, directory, name):
+        self.path = os.path.join(directory, name)
+        self.dir = self.link = None
+
+    def is_dir(self):
+        if self.dir is None:
+            self.dir = os.path.isdir(self.path)
+        return self.dir
+
+    def is_link(self):
+        if self.link is None:
+            self.link = os.path.islink(self.path)
+        return self.link
+
+
+class _ScandirEntry(object):
+    __slots__ = ('entry',)
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    def is_dir(self):
+        return self.entry.is_dir()
+
+    def is_link(self):
+        return self.entry.is_symlink()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+
+"""
+Compare the archive formats autobuild package can write.
+
+Usage:
+
+    python -m autobuild.tests.benchmark_archive_formats [--jobs N] ARCHIVE...
+
+Each ARCHIVE (a package in any format autobuild can install, preferably a
+real one) is unpacked, then repackaged in every archive format, reporting
+for each the archive's size, how long packaging took and how long
+installing it again took. Formats whose compressor isn't on the PATH are
+reported as skipped.
+
+This is not a test (nose doesn't collect it): run it by hand.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+from autobuild import common
+from autobuild import autobuild_tool_install
+from autobuild import autobuild_tool_package as package
+
+
+def pack(format, tree, archive_base, jobs, level):
+    """
+    Package the contents of tree in format, returning the archive's path.
+    """
+    contents = os.listdir(tree)
+    if format == 'zip':
+        archive = archive_base + '.zip'
+        package._create_zip_archive(archive, tree, contents, compression_jobs=jobs)
+    else:
+        suffix, compression = package.TARBALL_FORMATS[format]
+        archive = archive_base + suffix
+        package._create_tarfile(archive, tree, contents, compression=compression,
+                                compression_level=level, compression_jobs=jobs)
+    return archive
+
+
+def benchmark(archive, work_dir, jobs, level):
+    tree = os.path.join(work_dir, "tree")
+    if not autobuild_tool_install._install_package(archive, tree):
+        raise common.AutobuildError("can't unpack %s" % archive)
+    print("%s: %.1f MB unpacked" % (os.path.basename(archive), _tree_size(tree) / 1e6))
+    print("  %-6s %10s %10s %10s" % ("format", "MB", "pack s", "install s"))
+    for format in sorted(package.TARBALL_FORMATS.keys() + ['zip']):
+        archive_base = os.path.join(work_dir, "packed")
+        start = time.time()
+        try:
+            packed = pack(format, tree, archive_base, jobs, level)
+        except common.AutobuildError as err:
+            print("  %-6s skipped: %s" % (format, err))
+            continue
+        packed_time = time.time() - start
+        installed = os.path.join(work_dir, "installed")
+        start = time.time()
+        autobuild_tool_install._install_package(packed, installed)
+        installed_time = time.time() - start
+        print("  %-6s %10.2f %10.2f %10.2f" % (format, os.path.getsize(packed) / 1e6,
+                                              packed_time, installed_time))
+        os.remove(packed)
+        shutil.rmtree(installed)
+    shutil.rmtree(tree)
+
+
+def _tree_size(tree):
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, dirnames, filenames in os.walk(tree)
+               for filename in filenames)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="compare autobuild's archive formats")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="compress using this many processes or threads")
+    parser.add_argument('--level', type=int, default=None,
+                        help="compress at this level (default each format's own default)")
+    parser.add_argument('archives', nargs='+', metavar='ARCHIVE')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+    for archive in args.archives:
+        work_dir = tempfile.mkdtemp()
+        try:
+            benchmark(os.path.abspath(archive), work_dir, args.jobs, args.level)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+
+"""
+Compare matching a manifest in one walk with globbing each pattern.
+
+Usage:
+
+    python -m autobuild.tests.benchmark_manifest [--dirs N] [--files N] [--patterns N]
+
+Builds a synthetic build tree of about dirs * files files, then times
+matching a manifest of that many patterns against it both the way
+autobuild package used to (a glob.glob() per pattern) and with
+manifest_matcher.
+
+This is not a test (nose doesn't collect it): run it by hand.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+
+from autobuild import manifest_matcher
+
+SUFFIXES = ['.h', '.cpp', '.lib', '.txt']
+
+
+def make_tree(build_dir, dirs, files):
+    for d in xrange(dirs):
+        # half the files in each directory, half in a subdirectory
+        for subdir in ('', 'sub'):
+            directory = os.path.join(build_dir, "dir%04d" % d, subdir)
+            os.makedirs(directory)
+            for f in xrange(files // 2):
+                open(os.path.join(directory, "file%05d%s" % (f, SUFFIXES[f % len(SUFFIXES)])),
+                     'w').close()
+
+
+def make_manifest(dirs, patterns):
+    manifest = []
+    for p in xrange(patterns):
+        d = (p * 7) % dirs
+        if p % 10 == 9:
+            # a wildcard directory, which glob has to list every directory for
+            manifest.append("dir*%d/sub/file%05d.h" % (d % 10, p))
+        else:
+            manifest.append(["dir%04d/*.h", "dir%04d/sub/*.lib", "dir%04d/sub/file0000?.*",
+                             "dir%04d/file0*1.txt"][p % 4] % d)
+    return manifest
+
+
+def glob_each(manifest, build_dir):
+    # what autobuild package used to do
+    files = set()
+    missing = []
+    current_directory = os.getcwd()
+    os.chdir(build_dir)
+    try:
+        for pattern in manifest:
+            found = glob.glob(pattern)
+            if not found:
+                missing.append(pattern)
+            files.update(found)
+    finally:
+        os.chdir(current_directory)
+    return files, missing
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="compare ways of matching a manifest")
+    parser.add_argument('--dirs', type=int, default=20)
+    parser.add_argument('--files', type=int, default=5000, help="files per directory")
+    parser.add_argument('--patterns', type=int, default=200)
+    args = parser.parse_args(argv)
+    build_dir = tempfile.mkdtemp()
+    try:
+        make_tree(build_dir, args.dirs, args.files)
+        manifest = make_manifest(args.dirs, args.patterns)
+        print("%s files, %s patterns" % (args.dirs * (args.files // 2) * 2, len(manifest)))
+        results = []
+        for name, match in ("glob each pattern", glob_each), \
+                           ("manifest_matcher", manifest_matcher.match_manifest):
+            start = time.time()
+            files, missing = match(manifest, build_dir)
+            print("  %-20s %8.2f s  %s matched, %s missing" %
+                  (name, time.time() - start, len(files), len(missing)))
+            results.append((files, missing))
+        if results[0] != results[1]:
+            print("  (the results differ)")
+    finally:
+        shutil.rmtree(build_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,227 @@
+#!/usr/bin/env python2
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+#
+# Unit testing of cache subcommand.
+#
+
+from __future__ import absolute_import
+import os
+import sys
+import time
+import errno
+import tempfile
+import logging
+import threading
+
+from autobuild import install_cache
+import autobuild.autobuild_tool_cache as cache
+from .basetest import BaseTest, CaptureStdout, ExpectError, clean_dir
+from .patch import patch
+from nose.plugins.skip import SkipTest
+
+logger = logging.getLogger("test_cache")
+
+
+class TestCacheGC(BaseTest):
+    def setUp(self):
+        BaseTest.setUp(self)
+        self.cache_dir = tempfile.mkdtemp(suffix="_inst_cache")
+        self.saved_cache = os.environ.get('AUTOBUILD_INSTALLABLE_CACHE')
+        os.environ['AUTOBUILD_INSTALLABLE_CACHE'] = self.cache_dir
+
+    def tearDown(self):
+        if self.saved_cache is None:
+            del os.environ['AUTOBUILD_INSTALLABLE_CACHE']
+        else:
+            os.environ['AUTOBUILD_INSTALLABLE_CACHE'] = self.saved_cache
+        clean_dir(self.cache_dir)
+        BaseTest.tearDown(self)
+
+    def add_archive(self, cache_index, name, size, last_used):
+        path = cache_index.download_path("http://example.com/%s" % name, "md5", name * 8)
+        with open(path, 'wb') as f:
+            f.write('x' * size)
+        cache_index.store(path, "http://example.com/%s" % name, "md5", name * 8)
+        cache_index.used[cache_index._key(path)]['last_used'] = last_used
+        return path
+
+    def test_evicts_least_recently_used(self):
+        cache_index = install_cache.CacheIndex(self.cache_dir)
+        now = time.time()
+        oldest = self.add_archive(cache_index, "aaaa", 100, now - 300)
+        older = self.add_archive(cache_index, "bbbb", 100, now - 200)
+        newest = self.add_archive(cache_index, "cccc", 100, now - 100)
+        cache_index.save()
+        with CaptureStdout():
+            evicted = cache.collect_garbage(150)
+        self.assertEqual([path for path, size in evicted], [oldest, older])
+        self.assertFalse(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(os.path.dirname(oldest)))
+        self.assertFalse(os.path.exists(older))
+        self.assertTrue(os.path.exists(newest))
+        # the index was updated: nothing more to do
+        cache_index = install_cache.CacheIndex(self.cache_dir)
+        self.assertEqual(cache_index.total_size(), 100)
+        self.assertIsNone(cache_index.lookup("http://example.com/aaaa", None, None))
+        with CaptureStdout():
+            self.assertEqual(cache.collect_garbage(150), [])
+
+    def test_store_rename_error(self):
+        cache_index = install_cache.CacheIndex(self.cache_dir)
+        url = "http://example.com/aaaa"
+        # (as downloaded without a known hash)
+        download = cache_index.download_path(url, "md5", None)
+        with open(download, 'wb') as f:
+            f.write('x')
+
+        def cross_device(source, dest):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        # the rename's own error, not one from removing the missing target
+        with patch(os, "rename", cross_device):
+            try:
+                cache_index.store(download, url, "md5", "a" * 32)
+            except OSError as err:
+                self.assertEqual(err.errno, errno.EXDEV)
+            else:
+                self.fail("expected the rename to fail")
+
+    def test_mirror_links_counted_once(self):
+        cache_index = install_cache.CacheIndex(self.cache_dir)
+        now = time.time()
+        archive = self.add_archive(cache_index, "aaaa", 100, now - 200)
+        # the same archive, as downloaded from another mirror
+        mirror = os.path.join(os.path.dirname(archive), "mirror-aaaa")
+        try:
+            os.link(archive, mirror)
+        except (AttributeError, OSError):
+            raise SkipTest("no hard links here")
+        cache_index.touch(mirror)
+        self.assertEqual(cache_index.total_size(), 100)
+        self.assertEqual(cache_index.evict(100), [])
+        # only removing the last name frees the space
+        self.assertEqual(cache_index.evict(0), [(archive, 0), (mirror, 100)])
+        self.assertEqual(cache_index.total_size(), 0)
+
+    def test_dry_run(self):
+        cache_index = install_cache.CacheIndex(self.cache_dir)
+        archive = self.add_archive(cache_index, "aaaa", 100, time.time())
+        cache_index.save()
+        with CaptureStdout() as stream:
+            evicted = cache.collect_garbage(0, dry_run=True)
+        self.assertEqual(evicted, [(archive, 100)])
+        self.assertTrue(os.path.exists(archive))
+        self.assertIn("would remove", stream.getvalue())
+
+    def test_rescan(self):
+        # archives the index doesn't know about are only found by --rescan
+        legacy = os.path.join(self.cache_dir, "legacy-1.0-common-1.tar.bz2")
+        with open(legacy, 'wb') as f:
+            f.write('x' * 100)
+        with CaptureStdout():
+            self.assertEqual(cache.collect_garbage(0), [])
+            self.assertTrue(os.path.exists(legacy))
+            self.assertEqual(cache.collect_garbage(0, rescan=True), [(legacy, 100)])
+        self.assertFalse(os.path.exists(legacy))
+
+    def test_no_limit(self):
+        with ExpectError("no cache size limit", "expected error without a size limit"):
+            cache.collect_garbage(None)
+
+
+class TestCacheSharing(BaseTest):
+    def setUp(self):
+        BaseTest.setUp(self)
+        self.cache_dir = tempfile.mkdtemp(suffix="_inst_cache")
+
+    def tearDown(self):
+        clean_dir(self.cache_dir)
+        BaseTest.tearDown(self)
+
+    def test_lock_excludes(self):
+        path = os.path.join(self.cache_dir, "entry.lock")
+        holder = install_cache.FileLock(path)
+        self.assertTrue(holder.acquire())
+        other = install_cache.FileLock(path)
+        self.assertFalse(other.acquire(blocking=False))
+        holder.release()
+        self.assertTrue(other.acquire(blocking=False))
+        other.release()
+
+    def test_lock_waits(self):
+        path = os.path.join(self.cache_dir, "entry.lock")
+        holder = install_cache.FileLock(path)
+        holder.acquire()
+        events = []
+
+        def wait_for_lock():
+            with install_cache.FileLock(path) as lock:
+                events.append(("acquired", lock.waited))
+        waiter = threading.Thread(target=wait_for_lock)
+        waiter.start()
+        time.sleep(0.2)
+        events.append("released")
+        # removing the lock file on release must not let two holders in
+        holder.release(remove=True)
+        waiter.join()
+        self.assertEqual(events, ["released", ("acquired", True)])
+
+    def test_clone_without_reflinks(self):
+        # where reflinks fail, files are copied (not hard linked), and only
+        # those devices give up on reflinks
+        if not sys.platform.startswith('linux'):
+            raise SkipTest("reflinks are only tried on Linux")
+        source = os.path.join(self.cache_dir, "source")
+        with open(source, "w") as f:
+            f.write("cached")
+        attempts = []
+
+        class NoReflinks(object):
+            def ioctl(self, fd, request, arg):
+                attempts.append(fd)
+                raise IOError(errno.EOPNOTSUPP, "Operation not supported")
+        with patch(install_cache, "fcntl", NoReflinks()), \
+                patch(install_cache, "_reflinks", {("other", "device"): True}):
+            for name in "first", "second":
+                dest = os.path.join(self.cache_dir, name)
+                install_cache.clone_file(source, dest)
+                self.assertEqual(open(dest).read(), "cached")
+                self.assertNotEqual(os.stat(dest).st_ino, os.stat(source).st_ino)
+            self.assertEqual(len(attempts), 1)
+            self.assertEqual(install_cache._reflinks[("other", "device")], True)
+
+    def test_save_merges(self):
+        # two processes' changes to the index are both kept
+        first = install_cache.CacheIndex(self.cache_dir)
+        second = install_cache.CacheIndex(self.cache_dir)
+        first.record_url("http://example.com/one.tar.bz2", "md5", "1" * 32)
+        second.record_url("http://example.com/two.tar.bz2", "md5", "2" * 32)
+        first.save()
+        second.save()
+        self.assertEqual(sorted(install_cache.CacheIndex(self.cache_dir).urls),
+                         ["http://example.com/one.tar.bz2", "http://example.com/two.tar.bz2"])
+        # a removal is merged too
+        first.refresh()
+        first._drop('urls', "http://example.com/two.tar.bz2")
+        first.save()
+        self.assertEqual(sorted(install_cache.CacheIndex(self.cache_dir).urls),
+                         ["http://example.com/one.tar.bz2"])
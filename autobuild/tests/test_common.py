@@ -24,12 +24,15 @@
 from __future__ import absolute_import
 import os
 import shutil
+import hashlib
 import tarfile
 import tempfile
 import unittest
 from zipfile import ZipFile
 from autobuild import common
+from autobuild import hash_algorithms
 from .basetest import *
+from .patch import patch
 
 
 class TestCommon(BaseTest):
@@ -44,6 +47,24 @@ class TestCommon(BaseTest):
         exe_path = common.find_executable(shell)
         assert exe_path != None
 
+    def test_compute_hash(self):
+        # content spanning several (patched, small) hash blocks
+        content = ''.join(chr(i % 251) for i in xrange(10000))
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, content)
+            os.close(fd)
+            with patch(common, "HASH_BLOCK_SIZE", 1024):
+                self.assertEquals(common.compute_md5(path),
+                                  hashlib.md5(content).hexdigest())
+                for algorithm in hash_algorithms.REGISTERED_HASHERS:
+                    self.assertEquals(hash_algorithms.compute_hash(algorithm, path),
+                                      hashlib.new(algorithm, content).hexdigest())
+                    self.assertTrue(hash_algorithms.verify_hash(
+                        algorithm, path, hashlib.new(algorithm, content).hexdigest()))
+        finally:
+            os.remove(path)
+
     def tearDown(self):
         BaseTest.tearDown(self)
 
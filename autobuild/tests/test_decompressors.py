@@ -0,0 +1,163 @@
+#!/usr/bin/env python2
+# $LicenseInfo:firstyear=2010&license=mit$
+# Copyright (c) 2010, Linden Research, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# $/LicenseInfo$
+#
+# Unit testing of reading tarballs through external decompressors.
+#
+
+from __future__ import absolute_import
+import os
+import bz2
+import sys
+import stat
+import tarfile
+import tempfile
+import subprocess
+from nose.plugins.skip import SkipTest
+
+from autobuild import common, decompressors
+from .basetest import BaseTest, ExpectError, clean_dir
+
+ARCHIVE = os.path.join(os.path.dirname(__file__), "data", "bogus-0.1-common-111.tar.bz2")
+MEMBERS = ["LICENSES", "LICENSES/bogus.txt", "include", "include/bogus.h",
+           "lib", "lib/bogus.lib", "autobuild-package.xml"]
+
+
+class TestDecompressors(BaseTest):
+    def setUp(self):
+        BaseTest.setUp(self)
+        if sys.platform.startswith("win"):
+            raise SkipTest("fake decompressors are shell scripts")
+        self.bin_dir = tempfile.mkdtemp(suffix="_bin")
+        self.saved_path = os.environ['PATH']
+        os.environ['PATH'] = os.pathsep.join((self.bin_dir, self.saved_path))
+        decompressors._found.clear()
+
+    def tearDown(self):
+        os.environ['PATH'] = self.saved_path
+        os.environ.pop('AUTOBUILD_DECOMPRESS', None)
+        decompressors._found.clear()
+        clean_dir(self.bin_dir)
+        BaseTest.tearDown(self)
+
+    def fake_decompressor(self, name, script):
+        path = os.path.join(self.bin_dir, name)
+        with open(path, 'w') as f:
+            f.write("#!/bin/sh\n" + script)
+        os.chmod(path, stat.S_IRWXU)
+        return path
+
+    def fake_lbzip2(self):
+        if common.find_executable("bzip2") is None:
+            raise SkipTest("no bzip2 to fake lbzip2 with")
+        # record the arguments, then decompress single-threaded after all
+        self.fake_decompressor("lbzip2", 'echo "$@" > "%s"\nexec bzip2 "$@"\n'
+                               % os.path.join(self.bin_dir, "args"))
+
+    def names(self):
+        with decompressors.open_tarball(ARCHIVE) as tar:
+            return [member.name for member in tar]
+
+    def test_builtin(self):
+        self.fake_lbzip2()
+        os.environ['AUTOBUILD_DECOMPRESS'] = 'builtin'
+        self.assertEqual(self.names(), MEMBERS)
+        assert not os.path.exists(os.path.join(self.bin_dir, "args"))
+
+    def test_builtin_multi_stream(self):
+        os.environ['AUTOBUILD_DECOMPRESS'] = 'builtin'
+        work_dir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(work_dir, "bogus.tar")
+            with tarfile.open(archive, 'w') as tar:
+                tar.add(__file__, arcname="test.py")
+            with open(archive, 'rb') as f:
+                data = f.read()
+            # compress it as pbzip2 would, in independent chunks
+            with open(archive + ".bz2", 'wb') as f:
+                for start in xrange(0, len(data), 1000):
+                    f.write(bz2.compress(data[start:start + 1000]))
+            with decompressors.open_tarball(archive + ".bz2") as tar:
+                member = tar.next()
+                self.assertEqual(member.name, "test.py")
+                with open(__file__, 'rb') as source:
+                    self.assertEqual(tar.extractfile(member).read(), source.read())
+                self.assertEqual(tar.next(), None)
+        finally:
+            clean_dir(work_dir)
+
+    def test_no_decompressor_found(self):
+        os.environ['PATH'] = self.bin_dir
+        self.assertEqual(self.names(), MEMBERS)
+
+    def test_external(self):
+        self.fake_lbzip2()
+        self.assertEqual(self.names(), MEMBERS)
+        with open(os.path.join(self.bin_dir, "args")) as f:
+            self.assertEqual(f.read().split(), ["-d", "-c", ARCHIVE])
+
+    def test_external_stops_early(self):
+        self.fake_lbzip2()
+        with decompressors.open_tarball(ARCHIVE) as tar:
+            for member in tar:
+                break
+        self.assertEqual(member.name, "LICENSES")
+
+    def test_external_failure(self):
+        self.fake_decompressor("lbzip2", 'echo "lbzip2: corrupt input" >&2\nexit 2\n')
+        with ExpectError("corrupt input", "Expected the decompressor's failure to be reported"):
+            self.names()
+
+    def test_external_chatty(self):
+        if common.find_executable("bzip2") is None:
+            raise SkipTest("no bzip2 to fake lbzip2 with")
+        # more than a pipe holds: must not block the decompressor's output
+        self.fake_decompressor("lbzip2", 'head -c 200000 /dev/zero | tr "\\0" x >&2\n'
+                               'exec bzip2 "$@"\n')
+        self.assertEqual(self.names(), MEMBERS)
+
+    def external_only_format(self, program, suffix, format):
+        executable = common.find_executable(program)
+        if executable is None:
+            raise SkipTest("no %s" % program)
+        work_dir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(work_dir, "bogus.tar")
+            with tarfile.open(archive, 'w') as tar:
+                tar.add(__file__, arcname="test.py")
+            subprocess.check_call([executable, '-q', archive])
+            archive += suffix
+            self.assertEqual(decompressors.compression_format(archive), format)
+            assert decompressors.is_tarball(archive)
+            with decompressors.open_tarball(archive) as tar:
+                self.assertEqual([member.name for member in tar], ["test.py"])
+            # tarfile can't read it without the program
+            os.environ['AUTOBUILD_DECOMPRESS'] = 'builtin'
+            assert not decompressors.is_tarball(archive)
+        finally:
+            clean_dir(work_dir)
+
+    def test_external_only_format(self):
+        self.external_only_format("xz", ".xz", "xz")
+
+    def test_zstd(self):
+        self.external_only_format("zstd", ".zst", "zst")
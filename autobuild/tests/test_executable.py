@@ -22,11 +22,13 @@
 # $/LicenseInfo$
 
 from __future__ import absolute_import
+import os
 import sys
+import tempfile
 import unittest
 from nose.plugins.skip import SkipTest
 from autobuild.executable import Executable
-from .basetest import BaseTest
+from .basetest import BaseTest, clean_dir
 
 
 class TestExecutable(BaseTest):
@@ -38,6 +40,17 @@ class TestExecutable(BaseTest):
         result = sleepExecutable()
         assert result == 0
 
+    def test_executable_cwd(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            open(os.path.join(temp_dir, "marker"), 'w').close()
+            markerExecutable = Executable(command=sys.executable, arguments=[
+                '-c', '"import os, sys; sys.exit(not os.path.exists(\'marker\'))"'])
+            assert markerExecutable(cwd=temp_dir) == 0
+            assert markerExecutable() != 0
+        finally:
+            clean_dir(temp_dir)
+
     def test_compound_executable(self):
         parentExecutable = Executable(command='grep', arguments=[
                                       'foobarbaz', '.', '>/dev/null'], options=['-l', '-r'])
@@ -35,18 +35,26 @@ import socket
 import logging
 import tarfile
 import tempfile
+import threading
+import time
+import traceback
 import unittest
 import urllib
 import urlparse
+import zipfile
 import posixpath
 import subprocess
 from .basetest import *
+from .patch import patch
 from nose.tools import *                # assert_equals etc.
+from nose.plugins.skip import SkipTest
 from string import Template
+from StringIO import StringIO
 from threading import Thread
 from BaseHTTPServer import HTTPServer
 from SimpleHTTPServer import SimpleHTTPRequestHandler
 from autobuild import autobuild_tool_install, autobuild_tool_uninstall, configfile, common
+from autobuild import hash_algorithms, install_cache
 
 # ****************************************************************************
 #   TODO
@@ -208,6 +216,11 @@ def setup():
                      local_archives=[],
                      addrsize=32,
                      package=[],
+                     jobs=autobuild_tool_install.DEFAULT_DOWNLOAD_JOBS,
+                     extract_jobs=2,
+                     paranoid=False,
+                     unpacked_cache=False,
+                     hardlink_unpacked=False,
                      ):
             # Take all constructor params and assign as object attributes.
             params = locals().copy()
@@ -257,7 +270,39 @@ class DownloadServer(SimpleHTTPRequestHandler):
     """
     Want a file server almost like SimpleHTTPRequestHandler, but without
     depending on OS current directory.
+
+    Unlike SimpleHTTPRequestHandler, it honors simple 'Range: bytes=N-'
+    requests. A test may also set truncate[path] = N to cut off the next
+    response for that url path after N bytes of content, and may examine
+    requests, a list of (path, Range header) pairs.
     """
+    truncate = {}
+    requests = []
+
+    def do_GET(self):
+        byte_range = self.headers.getheader("Range")
+        DownloadServer.requests.append((self.path, byte_range))
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return SimpleHTTPRequestHandler.do_GET(self)
+        with open(path, 'rb') as f:
+            content = f.read()
+        start = 0
+        if byte_range:
+            start = int(byte_range[len("bytes="):].rstrip("-"))
+            if start >= len(content):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" %
+                             (start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        limit = DownloadServer.truncate.pop(self.path, None)
+        self.wfile.write(content[start:] if limit is None else content[start:start + limit])
 
     def translate_path(self, path):
         """
@@ -318,6 +363,11 @@ class BaseTest(object):
             mydir, "data", "argparse-1.1-common-111.tar.bz2"), SERVER_DIR)
         logger.setLevel(self.options.logging_level)
 
+    def cached_path(self, archive):
+        # where the named test archive lands in the content addressed cache
+        return install_cache.CacheIndex(self.cache_dir).content_path(
+            archive, "md5", common.compute_md5(os.path.join(mydir, "data", archive)))
+
     def copyto(self, source, destdir):
         return self.copy(source, in_dir(destdir, source))
 
@@ -392,6 +442,269 @@ class TestInstallArchive(BaseTest):
             autobuild_tool_install.AutobuildTool().run(self.options)
         assert_equals(stream.getvalue(), 'Dirty Packages: \n')
 
+    def test_download_not_rehashed(self):
+        # a fresh download is verified as it is written, without reading the
+        # cache file back; after that, the cache index vouches for it until
+        # --paranoid asks for it to be verified again
+        reads = []
+
+        def verify_md5(pathname, hash):
+            reads.append(pathname)
+            return common.compute_md5(pathname) == hash
+        with patch(hash_algorithms, "REGISTERED_ALGORITHMS", dict(md5=verify_md5)):
+            autobuild_tool_install.AutobuildTool().run(self.options)
+            assert_equals(reads, [])
+            clean_dir(INSTALL_DIR)
+            autobuild_tool_install.AutobuildTool().run(self.options)
+            assert_equals(reads, [])
+            clean_dir(INSTALL_DIR)
+            self.options.paranoid = True
+            autobuild_tool_install.AutobuildTool().run(self.options)
+            assert_equals(len(reads), 1)
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+
+    def test_changed_cache_file_rehashed(self):
+        # a cached file that changed since it was verified is verified again
+        # (and, being corrupt, replaced)
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        clean_dir(INSTALL_DIR)
+        cached = self.cached_path("bogus-0.1-common-111.tar.bz2")
+        with open(cached, "r+b") as f:
+            f.write("garbage")
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+
+    def test_resume_download(self):
+        # an interrupted download is resumed where it stopped
+        DownloadServer.truncate["/bogus-0.1-common-111.tar.bz2"] = 100
+        del DownloadServer.requests[:]
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+        assert_equals(DownloadServer.requests,
+                      [("/bogus-0.1-common-111.tar.bz2", None),
+                       ("/bogus-0.1-common-111.tar.bz2", "bytes=100-")])
+        cached = self.cached_path("bogus-0.1-common-111.tar.bz2")
+        assert os.path.exists(cached)
+        assert not os.path.exists(cached + install_cache.PARTIAL_SUFFIX)
+
+    def test_corrupt_partial_download(self):
+        # a partial download that turns out not to match the expected hash
+        # is discarded and downloaded again from scratch
+        cached = self.cached_path("bogus-0.1-common-111.tar.bz2")
+        os.makedirs(os.path.dirname(cached))
+        with open(cached + install_cache.PARTIAL_SUFFIX, 'wb') as f:
+            f.write("garbage")
+        del DownloadServer.requests[:]
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+        assert_equals([byte_range for path, byte_range in DownloadServer.requests],
+                      ["bytes=7-", None])
+
+    def test_cache_size_limit(self):
+        # with a limit on the cache size, the least recently used archives
+        # are evicted after an install
+        self.options.package = ["bogus", "argparse"]
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        bogus = self.cached_path("bogus-0.1-common-111.tar.bz2")
+        argparse = self.cached_path("argparse-1.1-common-111.tar.bz2")
+        assert os.path.exists(bogus)
+        assert os.path.exists(argparse)
+        clean_dir(INSTALL_DIR)
+        self.options.package = ["bogus"]
+        os.environ['AUTOBUILD_CACHE_MAX_BYTES'] = str(os.path.getsize(bogus))
+        try:
+            autobuild_tool_install.AutobuildTool().run(self.options)
+        finally:
+            del os.environ['AUTOBUILD_CACHE_MAX_BYTES']
+        assert os.path.exists(bogus)
+        assert not os.path.exists(argparse)
+
+    def test_wait_for_other_download(self):
+        # while another process holds the cache entry, wait for it and reuse
+        # what it fetched rather than downloading it again
+        clean_file(os.path.join(SERVER_DIR, "bogus-0.1-common-111.tar.bz2"))
+        other = install_cache.CacheIndex(self.cache_dir)
+        url = "http://127.0.0.1:%s/bogus-0.1-common-111.tar.bz2" % PORT
+        md5 = common.compute_md5(os.path.join(mydir, "data", "bogus-0.1-common-111.tar.bz2"))
+        lock = other.entry_lock(url, "md5", md5)
+        lock.acquire()
+        try:
+            installer = threading.Thread(
+                target=autobuild_tool_install.AutobuildTool().run, args=(self.options,))
+            installer.start()
+            time.sleep(0.2)
+            shutil.copy2(os.path.join(mydir, "data", "bogus-0.1-common-111.tar.bz2"),
+                         other.download_path(url, "md5", md5) + install_cache.PARTIAL_SUFFIX)
+            other.store(other.download_path(url, "md5", md5) + install_cache.PARTIAL_SUFFIX,
+                        url, "md5", md5)
+            other.save()
+        finally:
+            lock.release()
+        installer.join()
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+
+    def test_no_eviction_until_installed(self):
+        # another process collecting garbage while this one installs leaves
+        # the archives it fetched alone until it has extracted them
+        self.options.package = ["bogus", "argparse"]
+        self.options.jobs = 2
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        clean_dir(INSTALL_DIR)
+        evicted = []
+        real_install_common = autobuild_tool_install._install_common
+
+        def collect_garbage():
+            cache_index = install_cache.CacheIndex(self.cache_dir)
+            evicted.extend(cache_index.evict(0))
+            cache_index.save()
+
+        def install_common(*args, **kwds):
+            collector = threading.Thread(target=collect_garbage)
+            collector.start()
+            collector.join()
+            return real_install_common(*args, **kwds)
+        with patch(autobuild_tool_install, "_install_common", install_common):
+            autobuild_tool_install.AutobuildTool().run(self.options)
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+        bogus = self.cached_path("bogus-0.1-common-111.tar.bz2")
+        argparse = self.cached_path("argparse-1.1-common-111.tar.bz2")
+        # by the time argparse was extracted, bogus was fair game
+        assert_equals([path for path, size in evicted], [bogus])
+        assert os.path.exists(argparse)
+        install_cache.CacheIndex(self.cache_dir).evict(0)
+        assert not os.path.exists(argparse)
+
+    def test_shared_archive_kept_until_all_installed(self):
+        # an archive configured for two packages is kept from eviction until
+        # both have been installed, not just the first
+        config = configfile.ConfigurationDescription(self.options.install_filename)
+        twin = config.installables["bogus"].copy()
+        twin.name = "twin"
+        config.installables["twin"] = twin
+        config.save()
+        self.options.package = ["bogus"]
+        self.options.jobs = 2
+        # (so that the cache index records the archive)
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        clean_dir(INSTALL_DIR)
+        self.options.package = ["bogus", "twin"]
+        evicted = []
+        real_install_common = autobuild_tool_install._install_common
+
+        def collect_garbage():
+            cache_index = install_cache.CacheIndex(self.cache_dir)
+            evicted.extend(cache_index.evict(0))
+            cache_index.save()
+
+        def install_common(configured_name, *args, **kwds):
+            if configured_name == "bogus":
+                return real_install_common(configured_name, *args, **kwds)
+            # (the twin's files would conflict with bogus's: it's enough
+            # that its archive is still there)
+            collector = threading.Thread(target=collect_garbage)
+            collector.start()
+            collector.join()
+            return None, None
+        with patch(autobuild_tool_install, "_install_common", install_common):
+            autobuild_tool_install.AutobuildTool().run(self.options)
+        assert_equals(evicted, [])
+        bogus = self.cached_path("bogus-0.1-common-111.tar.bz2")
+        assert os.path.exists(bogus)
+        install_cache.CacheIndex(self.cache_dir).evict(0)
+        assert not os.path.exists(bogus)
+
+    def test_install_while_fetching(self):
+        # each package is installed as soon as its archive arrives, while
+        # later archives are still being fetched
+        self.options.package = ["bogus", "argparse"]
+        self.options.jobs = 2
+        self.options.extract_jobs = 1
+        bogus_installed = threading.Event()
+        waited = []
+        real_get_package_file = autobuild_tool_install.get_package_file
+        real_install_common = autobuild_tool_install._install_common
+
+        def get_package_file(package_name, *args, **kwds):
+            if package_name == "argparse":
+                waited.append(bogus_installed.wait(5))
+            return real_get_package_file(package_name, *args, **kwds)
+
+        def install_common(configured_name, *args, **kwds):
+            result = real_install_common(configured_name, *args, **kwds)
+            if configured_name == "bogus":
+                bogus_installed.set()
+            return result
+        with patch(autobuild_tool_install, "get_package_file", get_package_file), \
+                patch(autobuild_tool_install, "_install_common", install_common):
+            autobuild_tool_install.AutobuildTool().run(self.options)
+        assert_equals(waited, [True])
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+
+    def test_serial_install(self):
+        # with one job of each kind, packages are fetched and installed in
+        # turn, as they always were
+        self.options.package = ["bogus", "argparse"]
+        self.options.jobs = 1
+        self.options.extract_jobs = 1
+
+        def no_pipeline(*args, **kwds):
+            raise AssertionError("serial install used a PackagePipeline")
+        with patch(autobuild_tool_install, "PackagePipeline", no_pipeline):
+            autobuild_tool_install.AutobuildTool().run(self.options)
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+
+    def test_installed_file_index(self):
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        installed = configfile.Dependencies(os.path.join(INSTALL_DIR, "installed-packages.xml"))
+        file_index = autobuild_tool_install.InstalledFileIndex(installed)
+        assert_equals(file_index.owner("include/bogus.h"), "bogus")
+        assert_equals(file_index.owner("include/"), "bogus")
+        assert_equals(file_index.owner("include/other.h"), None)
+        # a file no package installed is still found, listing its directory
+        # just once however many members are checked there
+        with open(os.path.join(INSTALL_DIR, "include", "stray.h"), "w") as f:
+            f.write("stray")
+        listed = []
+        real_listdir = os.listdir
+
+        def listdir(path):
+            listed.append(path)
+            return real_listdir(path)
+        with patch(os, "listdir", listdir):
+            assert_equals(file_index.conflicts(INSTALL_DIR,
+                                               ["include/", "include/bogus.h", "include/new.h",
+                                                "include/stray.h", "lib/new.lib"]),
+                          ["include/bogus.h", "include/stray.h"])
+        assert_equals(sorted(listed), [os.path.join(INSTALL_DIR, "include"),
+                                       os.path.join(INSTALL_DIR, "lib")])
+        # uninstalling is noticed
+        autobuild_tool_install.uninstall("bogus", installed)
+        assert_equals(file_index.owner("include/bogus.h"), None)
+        assert_equals(file_index.conflicts(INSTALL_DIR, ["include/bogus.h", "include/stray.h"]),
+                      ["include/stray.h"])
+
+    def test_single_pass_extraction(self):
+        # a fresh install reads the tarball just once, as a stream
+        modes = []
+        real_open = tarfile.open
+
+        def recording_open(name=None, mode='r', fileobj=None, *args, **kwds):
+            if (name or fileobj.name).endswith("bogus-0.1-common-111.tar.bz2"):
+                modes.append(mode)
+            return real_open(name, mode, fileobj, *args, **kwds)
+        # (not through an external decompressor, which tarfile only sees as a pipe)
+        os.environ['AUTOBUILD_DECOMPRESS'] = 'builtin'
+        try:
+            with patch(tarfile, "open", recording_open):
+                autobuild_tool_install.AutobuildTool().run(self.options)
+        finally:
+            del os.environ['AUTOBUILD_DECOMPRESS']
+        assert os.path.exists(os.path.join(INSTALL_DIR, "lib", "bogus.lib"))
+        # (is_tarfile() only reads the first header)
+        assert_equals([mode for mode in modes if mode != 'r'], ['r|'])
+        assert_equals(len(modes), 2)
+        assert_in(self.pkg, query_manifest(self.options))
+
     def test_dry_run(self):
         dry_opts = self.options.copy()
         dry_opts.dry_run = True
@@ -410,17 +723,122 @@ class TestInstallArchive(BaseTest):
         # Absence of that exception means AutobuildTool().run() didn't even try
         # to fetch the tarball -- which should mean it realized this package
         # is already up-to-date.
-        # An earlier version of this test had both cleaned the cache and removed the
-        # tarball from the server, expecting that the mere presence of the installed
-        # archive would be sufficient to keep it from being installed again; we
-        # now require that the file be validated against at least a cached
-        # file.
+        # An installed archive whose url and hash match the configured ones
+        # is up-to-date without looking at the archive at all.
         logger.debug("attempt reinstall with cached file")
         autobuild_tool_install.AutobuildTool().run(self.options)
         clean_dir(self.cache_dir)
         logger.debug("attempt reinstall without cached file")
         autobuild_tool_install.AutobuildTool().run(self.options)
 
+    def test_reinstall_touches_no_archive(self):
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        clean_dir(self.cache_dir)
+        for archive in os.listdir(SERVER_DIR):
+            clean_file(os.path.join(SERVER_DIR, archive))
+
+        def untouchable(*args, **kwds):
+            raise AssertionError("archive touched by up-to-date install")
+        with patch(autobuild_tool_install, "get_package_file", untouchable), \
+             patch(common, "compute_hash", untouchable), \
+             patch(tarfile, "open", untouchable):
+            autobuild_tool_install.AutobuildTool().run(self.options)
+        assert_in(self.pkg, query_manifest(self.options))
+
+    def test_unpacked_cache(self):
+        self.options.unpacked_cache = True
+        self.options.package = None  # install all, staging in a pool
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        tree = install_cache.CacheIndex(self.cache_dir).unpacked_path(
+            "md5", common.compute_md5(os.path.join(mydir, "data", "bogus-0.1-common-111.tar.bz2")))
+        cached = os.path.join(tree, "files", "lib", "bogus.lib")
+        installed = os.path.join(INSTALL_DIR, "lib", "bogus.lib")
+        assert os.path.exists(cached)
+        assert_equals(os.stat(cached).st_mode & 0o222, 0)
+        assert_equals(open(installed).read(), open(cached).read())
+        # a copy (or reflink), not a hard link that would share any change
+        assert os.stat(installed).st_ino != os.stat(cached).st_ino
+        assert os.stat(installed).st_mode & 0o200
+        # the metadata is read from the tree, but not installed
+        assert_equals(query_manifest(self.options)["bogus"]["build_id"], "111")
+        assert not os.path.exists(os.path.join(INSTALL_DIR, configfile.PACKAGE_METADATA_FILE))
+
+        # a new install dir is filled from the tree, without extracting
+        clean_dir(INSTALL_DIR)
+
+        def untouchable(*args, **kwds):
+            raise AssertionError("archive extracted again")
+        with patch(tarfile.TarFile, "extract", untouchable):
+            self.options.package = ["bogus"]
+            autobuild_tool_install.AutobuildTool().run(self.options)
+        assert_equals(open(installed).read(), open(cached).read())
+        assert os.path.exists(os.path.join(INSTALL_DIR, "include", "bogus.h"))
+        autobuild_tool_uninstall.AutobuildTool().run(self.options)
+        assert not os.path.exists(installed)
+        assert os.path.exists(cached)
+
+        # evicting the archive removes its tree
+        install_cache.CacheIndex(self.cache_dir).evict(0)
+        assert not os.path.exists(tree)
+
+    def test_unpacked_cache_hardlinks(self):
+        # hard links to the tree only when asked for
+        self.options.unpacked_cache = True
+        self.options.hardlink_unpacked = True
+        self.options.package = ["bogus"]
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        tree = install_cache.CacheIndex(self.cache_dir).unpacked_path(
+            "md5", common.compute_md5(os.path.join(mydir, "data", "bogus-0.1-common-111.tar.bz2")))
+        cached = os.path.join(tree, "files", "lib", "bogus.lib")
+        installed = os.path.join(INSTALL_DIR, "lib", "bogus.lib")
+        if os.stat(installed).st_ino != os.stat(cached).st_ino:
+            raise SkipTest("no hard links (or reflinks instead) here")
+        assert_equals(os.stat(installed).st_mode & 0o222, 0)
+
+    def test_all_configurations(self):
+        self.options = FakeOptions(
+            install_filename=self.localizedConfig("packages-install-configurations.xml"),
+            select_dir=None, package=["bogus"], installed_filename="installed-packages.xml")
+        build_dir = os.path.join(mydir, "data", "build-configurations")
+        self.tempdirs.append(build_dir)
+        extracted = []
+        real_extract = tarfile.TarFile.extract
+
+        def extract(tar, member, *args, **kwds):
+            extracted.append(member.name)
+            return real_extract(tar, member, *args, **kwds)
+        with patch(tarfile.TarFile, "extract", extract):
+            autobuild_tool_install.AutobuildTool().run(self.options)
+        # each install dir got the package, from a single extraction
+        for configuration in "Debug", "Release":
+            installed = os.path.join(build_dir, configuration, "packages", "lib", "bogus.lib")
+            assert os.path.exists(installed)
+            assert os.stat(installed).st_mode & 0o200
+        assert_equals(extracted.count("lib/bogus.lib"), 1)
+        # and the shared tree is gone
+        assert_equals([name for name in os.listdir(build_dir) if name.startswith(".")], [])
+
+    def test_install_fingerprint(self):
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        assert os.path.exists(os.path.join(INSTALL_DIR, "installed-packages-fingerprint"))
+
+        # nothing changed: installed-packages.xml isn't even loaded
+        def untouchable(*args, **kwds):
+            raise AssertionError("installed packages loaded by no-op install")
+        with patch(configfile, "Dependencies", untouchable):
+            autobuild_tool_install.AutobuildTool().run(self.options)
+
+        # but installing other packages, or after an uninstall, does the work
+        self.options.package = None
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        assert_equals(set(query_manifest(self.options)), set(("argparse", "bogus")))
+        uninstall_opts = self.options.copy()
+        uninstall_opts.package = ["bogus"]
+        autobuild_tool_uninstall.AutobuildTool().run(uninstall_opts)
+        assert_equals(set(query_manifest(self.options)), set(("argparse",)))
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        assert_equals(set(query_manifest(self.options)), set(("argparse", "bogus")))
+
     def test_update(self):
         # test_success() establishes that this first one should work
         autobuild_tool_install.AutobuildTool().run(self.options)
@@ -439,6 +857,108 @@ class TestInstallArchive(BaseTest):
         assert_in("0.2", open(os.path.join(
             INSTALL_DIR, "include", "bogus.h")).read())
 
+    def test_update_in_place(self):
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        unchanged = os.path.join(INSTALL_DIR, "lib", "bogus.lib")
+        inode = os.stat(unchanged).st_ino
+        self.server_tarball = self.copyto(os.path.join(
+            mydir, "data", "bogus-0.2-common-222.tar.bz2"), SERVER_DIR)
+        self.options = FakeOptions(
+            install_filename=self.localizedConfig("package-update-install.xml"))
+        self.options.package = ["bogus"]
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        # the file that is the same in both versions was left alone...
+        assert_equals(os.stat(unchanged).st_ino, inode)
+        assert_in("0.2", open(os.path.join(INSTALL_DIR, "include", "bogus.h")).read())
+        # ...but the record is that of a full install
+        installed = query_manifest(self.options)["bogus"]
+        assert_equals(installed["package_description"]["version"], "0.2")
+        assert_equals(installed["manifest"],
+                      ["LICENSES", "LICENSES/bogus.txt", "include", "include/bogus.h",
+                       "lib", "lib/bogus.lib"])
+        assert_equals(autobuild_tool_install.InstalledFileIndex.of(configfile.Dependencies(
+            os.path.join(INSTALL_DIR, "installed-packages.xml"))).owner("lib/bogus.lib"), "bogus")
+
+    def test_update_rewrites_modified_file(self):
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        modified = os.path.join(INSTALL_DIR, "lib", "bogus.lib")
+        original = open(modified, 'rb').read()
+        info = os.stat(modified)
+        os.chmod(modified, 0o644)
+        with open(modified, 'wb') as f:
+            f.write('x' * len(original))
+        # same size, and the same mtime but for a fraction of a second
+        os.utime(modified, (info.st_atime, info.st_mtime + 0.5))
+        if os.stat(modified).st_mtime == info.st_mtime + 0.5:
+            self.server_tarball = self.copyto(os.path.join(
+                mydir, "data", "bogus-0.2-common-222.tar.bz2"), SERVER_DIR)
+            self.options = FakeOptions(
+                install_filename=self.localizedConfig("package-update-install.xml"))
+            self.options.package = ["bogus"]
+            autobuild_tool_install.AutobuildTool().run(self.options)
+            assert_equals(open(modified, 'rb').read(), original)
+        else:
+            raise SkipTest("filesystem does not keep sub-second mtimes")
+
+    def test_update_hard_link_in_place(self):
+        work_dir = tempfile.mkdtemp()
+        self.tempdirs.append(work_dir)
+        source = os.path.join(work_dir, "a")
+        with open(source, 'w') as f:
+            f.write("linked")
+        archive = os.path.join(work_dir, "linked.tar.bz2")
+        with tarfile.open(archive, 'w:bz2') as tar:
+            tar.add(source, arcname="a")
+            info = tar.gettarinfo(source, arcname="b")
+            info.type = tarfile.LNKTYPE
+            info.linkname = "a"
+            info.size = 0
+            tar.addfile(info)
+        autobuild_tool_install._install_package(archive, INSTALL_DIR)
+        current = {}
+        for name in "a", "b":
+            info = os.stat(os.path.join(INSTALL_DIR, name))
+            current[name] = (info.st_size, info.st_mtime)
+        # the link's target is left in place, so the link can't be made to
+        # the staged target
+        staged = autobuild_tool_install._StagedTarball(archive, INSTALL_DIR, current=current)
+        try:
+            assert_equals(staged.unchanged, set(["a"]))
+            os.remove(os.path.join(INSTALL_DIR, "b"))
+            assert_equals(staged.install(), ["a", "b"])
+        finally:
+            staged.discard()
+        assert_equals(open(os.path.join(INSTALL_DIR, "b")).read(), "linked")
+
+    def test_update_zip_in_place(self):
+        work_dir = tempfile.mkdtemp()
+        self.tempdirs.append(work_dir)
+        archives = []
+        for version, content in ("0.1", "old!"), ("0.2", "new!"):
+            archive = os.path.join(work_dir, "zipped-%s.zip" % version)
+            with zipfile.ZipFile(archive, 'w') as zip:
+                zip.writestr("same.txt", "same in both")
+                zip.writestr("changed.txt", content)
+            archives.append(archive)
+        autobuild_tool_install._install_package(archives[0], INSTALL_DIR)
+        same = os.path.join(INSTALL_DIR, "same.txt")
+        inode = os.stat(same).st_ino
+        current = {}
+        for name in "same.txt", "changed.txt":
+            info = os.stat(os.path.join(INSTALL_DIR, name))
+            current[name] = (info.st_size, info.st_mtime)
+        staged = autobuild_tool_install._StagedZip(archives[1], INSTALL_DIR)
+        try:
+            # the sizes match, but the CRC-32 tells the changed file apart
+            staged.match_installed(current)
+            assert_equals(staged.unchanged, set(["same.txt"]))
+            os.remove(os.path.join(INSTALL_DIR, "changed.txt"))
+            assert_equals(sorted(staged.install()), ["changed.txt", "same.txt"])
+        finally:
+            staged.discard()
+        assert_equals(os.stat(same).st_ino, inode)
+        assert_equals(open(os.path.join(INSTALL_DIR, "changed.txt")).read(), "new!")
+
     def test_update_move(self):
         # test_success() establishes that this first one should work - installs
         # bogus 0.1
@@ -544,6 +1064,10 @@ class TestInstallArchive(BaseTest):
         self.options.local_archives = []
         with ExpectError("attempts to install files already installed", "Expected InstallError for conflicting files"):
             autobuild_tool_install.AutobuildTool().run(self.options)
+        # nothing of the conflicting package is left behind
+        assert_equals([name for name in os.listdir(INSTALL_DIR)
+                       if name.startswith(".autobuild-staging-")], [])
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "lib", "conflict.lib"))
 
     def test_conflicting_direct_depends(self):
         # fail because the package is a different version than an existing dependency
@@ -626,6 +1150,102 @@ class TestInstallArchive(BaseTest):
             autobuild_tool_install.AutobuildTool().run(self.options)
         assert_equals(stream.getvalue(), "bogus: 1\n")
 
+    def test_what_installed(self):
+        self.options.package = None  # install all
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        installed_path = os.path.join(INSTALL_DIR, "installed-packages.xml")
+        index_path = os.path.join(INSTALL_DIR, "installed-packages-files.json")
+        assert os.path.exists(index_path)
+
+        # a fresh saved index answers without consulting any manifest
+        installed = configfile.Dependencies(installed_path)
+        for package in installed.dependencies.itervalues():
+            del package['manifest']
+        file_index = autobuild_tool_install.InstalledFileIndex(installed)
+        assert_equals(file_index.owner("include/bogus.h"), "bogus")
+
+        self.options.query_installed_file = "include/bogus.h"
+        with CaptureStdout() as stream:
+            autobuild_tool_install.AutobuildTool().run(self.options)
+        assert_equals(stream.getvalue(),
+                      "file 'include/bogus.h' installed by package 'bogus'\n")
+
+        # '-' looks up each file named on stdin
+        self.options.query_installed_file = "-"
+        with patch(sys, "stdin", StringIO("include/bogus.h\n\nnothing.h\n")):
+            with CaptureStdout() as stream:
+                autobuild_tool_install.AutobuildTool().run(self.options)
+        assert_equals(stream.getvalue(),
+                      "file 'include/bogus.h' installed by package 'bogus'\n"
+                      "file 'nothing.h' not found in installed files\n")
+
+        # uninstalling updates the saved index
+        autobuild_tool_install.uninstall("bogus", configfile.Dependencies(installed_path))
+        installed = configfile.Dependencies(installed_path)
+        file_index = autobuild_tool_install.InstalledFileIndex(installed)
+        assert_equals(file_index.owner("include/bogus.h"), None)
+        with open(index_path) as f:
+            assert_not_in("include/bogus.h", f.read())
+
+    def test_stale_file_index(self):
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        index_path = os.path.join(INSTALL_DIR, "installed-packages-files.json")
+        with open(index_path, "w") as f:
+            f.write("{}")
+        # an index that doesn't match installed-packages.xml is rebuilt
+        installed = configfile.Dependencies(os.path.join(INSTALL_DIR, "installed-packages.xml"))
+        file_index = autobuild_tool_install.InstalledFileIndex(installed)
+        assert_equals(file_index.owner("include/bogus.h"), "bogus")
+        file_index.save()
+        file_index = autobuild_tool_install.InstalledFileIndex(installed)
+        assert_equals(file_index.indexed["bogus"][1], None)
+        assert_equals(file_index.owner("include/bogus.h"), "bogus")
+
+    def test_existing_files_ignoring_case(self):
+        os.makedirs(os.path.join(INSTALL_DIR, "include"))
+        with open(os.path.join(INSTALL_DIR, "include", "Bogus.h"), "w") as f:
+            f.write("")
+        members = ["include/bogus.h", "include/other.h"]
+        assert_equals(autobuild_tool_install._existing_files(INSTALL_DIR, members),
+                      [name for name in members
+                       if os.path.exists(os.path.join(INSTALL_DIR, name))])
+        # as on a case-insensitive filesystem, whatever this one is
+        def is_file(install_dir, filename):
+            parent, basename = os.path.split(filename)
+            return basename.lower() in [entry.lower() for entry in
+                                        os.listdir(os.path.join(install_dir, parent))]
+        with patch(autobuild_tool_install, "_is_file", is_file):
+            assert_equals(autobuild_tool_install._existing_files(INSTALL_DIR, members),
+                          ["include/bogus.h"])
+
+    def test_file_index_follows_content(self):
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        installed_path = os.path.join(INSTALL_DIR, "installed-packages.xml")
+        info = os.stat(installed_path)
+        with open(installed_path) as f:
+            content = f.read()
+        # a change that leaves the size and mtime as they were
+        with open(installed_path, "w") as f:
+            f.write(content.replace("include/bogus.h", "include/bogus.x"))
+        os.utime(installed_path, (info.st_atime, info.st_mtime))
+        installed = configfile.Dependencies(installed_path)
+        file_index = autobuild_tool_install.InstalledFileIndex(installed)
+        assert_equals(file_index.owner("include/bogus.h"), None)
+        assert_equals(file_index.owner("include/bogus.x"), "bogus")
+
+    def test_file_index_of(self):
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        installed_path = os.path.join(INSTALL_DIR, "installed-packages.xml")
+        installed = configfile.Dependencies(installed_path)
+        file_index = autobuild_tool_install.InstalledFileIndex.of(installed)
+        assert file_index is autobuild_tool_install.InstalledFileIndex.of(installed)
+        assert file_index is not autobuild_tool_install.InstalledFileIndex.of(
+            configfile.Dependencies(installed_path))
+        # the index goes with the Dependencies, but isn't saved with them
+        installed.save()
+        with open(installed_path) as f:
+            assert_not_in("file_index", f.read())
+
 # -------------------------------------  -------------------------------------
 
 
@@ -653,6 +1273,31 @@ class TestInstallCachedArchive(BaseTest):
             self.options.list_dirty = True
             autobuild_tool_install.AutobuildTool().run(self.options)
         assert_equals(stream.getvalue(), 'Dirty Packages: \n')
+        # the archive was moved into the content addressed layout
+        assert not os.path.exists(self.cache_name)
+        assert os.path.exists(self.cached_path("bogus-0.1-common-111.tar.bz2"))
+
+    def test_other_archive_same_name(self):
+        # a different archive of the same name in the old flat layout is not
+        # mistaken for the one we want
+        with open(self.cache_name, 'wb') as f:
+            f.write("some other archive")
+        self.options.package = [self.pkg]
+        with ExpectError("Failed to download", "expected for archive not in cache or server"):
+            autobuild_tool_install.AutobuildTool().run(self.options)
+        assert os.path.exists(self.cache_name)
+
+    def test_mirror_shares_entry(self):
+        # the same archive from a different url is found in the cache without
+        # being downloaded again
+        self.options.package = [self.pkg]
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        cache_index = install_cache.CacheIndex(self.cache_dir)
+        md5 = common.compute_md5(self.cached_path("bogus-0.1-common-111.tar.bz2"))
+        mirrored = cache_index.lookup("http://mirror.example.com/bogus-mirrored.tar.bz2",
+                                      "md5", md5)
+        assert_equals(os.path.basename(mirrored), "bogus-mirrored.tar.bz2")
+        assert_equals(common.compute_md5(mirrored), md5)
 
 # -------------------------------------  -------------------------------------
 
@@ -801,6 +1446,70 @@ class TestInstall(BaseTest):
             autobuild_tool_install.AutobuildTool().run(self.options)
         assert_equals(set_from_stream(stream), set(("argparse", "bogus")))
 
+    def test_install_all_serial(self):
+        # a serial install must produce the same result as a parallel one
+        self.options.package = None
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        parallel = query_manifest(self.options)
+        clean_dir(INSTALL_DIR)
+        clean_dir(self.cache_dir)
+        self.options.jobs = 1
+        self.options.extract_jobs = 1
+        autobuild_tool_install.AutobuildTool().run(self.options)
+        serial = query_manifest(self.options)
+        assert_equals(sorted(parallel.keys()), ["argparse", "bogus"])
+        for name in parallel:
+            assert_equals(parallel[name]["manifest"], serial[name]["manifest"])
+        assert_equals([name for name in os.listdir(INSTALL_DIR)
+                       if name.startswith(".autobuild-staging-")], [])
+
+    def test_parallel_extract_conflict(self):
+        # packages extracted together that conflict fail just as they would
+        # one at a time: the first is installed, the second reported
+        for archive in "bogus-0.2-common-222.tar.bz2", "conflict-0.1-common-111.tar.bz2":
+            self.copyto(os.path.join(mydir, "data", archive), SERVER_DIR)
+        self.options = FakeOptions(install_filename=self.localizedConfig(
+            "package-update-install.xml"), package=["bogus", "conflict"])
+        with ExpectError("attempts to install files already installed",
+                         "Expected InstallError for conflicting files"):
+            autobuild_tool_install.AutobuildTool().run(self.options)
+        assert os.path.exists(os.path.join(INSTALL_DIR, "include", "bogus.h"))
+        assert not os.path.exists(os.path.join(INSTALL_DIR, "lib", "conflict.lib"))
+        assert_equals([name for name in os.listdir(INSTALL_DIR)
+                       if name.startswith(".autobuild-staging-")], [])
+
+    def test_parallel_download_fail(self):
+        # a failed download among concurrent ones is reported for its package
+        self.options = FakeOptions(install_filename=self.localizedConfig(
+            "packages-failures.xml"), package=["notthere", "badhash"])
+        with ExpectError("Failed to download package 'notthere'",
+                         "expected InstallError for download failure"):
+            autobuild_tool_install.AutobuildTool().run(self.options)
+
+    def test_parallel_fetch_error_traceback(self):
+        # an error while fetching concurrently is raised with its traceback
+        def fail_to_fetch(*args, **kwds):
+            raise ValueError("fetch failed")
+        self.options.jobs = 2
+        with patch(autobuild_tool_install, "get_package_file", fail_to_fetch):
+            try:
+                autobuild_tool_install.AutobuildTool().run(self.options)
+            except ValueError:
+                frames = traceback.extract_tb(sys.exc_info()[2])
+            else:
+                assert False, "expected the fetch error"
+        assert_equals(frames[-1][2], "fail_to_fetch")
+
+    def test_bad_jobs_environment(self):
+        self.options.jobs = None
+        os.environ['AUTOBUILD_DOWNLOAD_JOBS'] = "lots"
+        try:
+            with ExpectError(r"\$AUTOBUILD_DOWNLOAD_JOBS must be a positive number of jobs, not 'lots'",
+                             "expected AutobuildError for a bad $AUTOBUILD_DOWNLOAD_JOBS"):
+                autobuild_tool_install.AutobuildTool().run(self.options)
+        finally:
+            del os.environ['AUTOBUILD_DOWNLOAD_JOBS']
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -26,20 +26,28 @@
 
 from __future__ import absolute_import
 import os
+import bz2
 import sys
 import logging
 import re
 import shutil
 import tarfile
 import tempfile
+import time
 import unittest
-from zipfile import ZipFile
+from StringIO import StringIO
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 from string import Template
 
 import autobuild.autobuild_tool_package as package
 from autobuild import configfile
 from autobuild import common
+from autobuild import compressors
+from autobuild import decompressors
+from autobuild import hash_algorithms
 from .basetest import BaseTest, ExpectError, CaptureStdout, clean_dir, clean_file
+from nose.plugins.skip import SkipTest
+from .patch import patch
 
 
 # ****************************************************************************
@@ -66,6 +74,10 @@ class PackageOptions(object):
         self.archive_filename = None
         self.archive_format = None
         self.select_dir = None
+        self.compression_level = None
+        self.compression_jobs = 1
+        self.digests = []
+        self.jobs = 1
         self.autobuild_filename = os.path.join(
             data_dir, "autobuild-package-config.xml")
 
@@ -129,6 +141,56 @@ class TestPackaging(BaseTest):
             self.tar_name), "%s does not exist" % self.tar_name
         self.tar_has_expected(self.tar_name)
 
+    def test_package_parallel_compression(self):
+        # small enough chunks that the files are split across blocks
+        with patch(compressors, "bz2_chunk_size", lambda level: 1024):
+            package.package(self.config, self.config.get_build_directory(
+                None, 'common'), 'common', archive_format='tbz2', compression_jobs=2)
+        # one bz2 stream, which tarfile (and so any autobuild) reads whole
+        with open(self.tar_name, 'rb') as tarball:
+            decompressor = bz2.BZ2Decompressor()
+            decompressor.decompress(tarball.read())
+        self.assertEquals(decompressor.unused_data, "")
+        self.tar_has_expected(self.tar_name)
+
+    def test_parallel_bz2_single_stream(self):
+        # whole blocks at the lowest level, runs that bzip2 lengthens, and
+        # data that doesn't compress at all
+        data = ''.join(chr(n % 256) * 4 for n in range(100000)) + os.urandom(200000) + 'tail'
+        output = StringIO()
+        with compressors.ParallelBZ2File(output, 2, level=1) as compressor:
+            for start in range(0, len(data), 65536):
+                compressor.write(data[start:start + 65536])
+        self.assertEquals(bz2.decompress(output.getvalue()), data)
+        output = StringIO()
+        compressors.ParallelBZ2File(output, 2).close()
+        self.assertEquals(bz2.decompress(output.getvalue()), "")
+
+    def package_format(self, archive_format, program=None, **kwds):
+        if program is not None and common.find_executable(program) is None:
+            raise SkipTest("no %s" % program)
+        package.package(self.config, self.config.get_build_directory(
+            None, 'common'), 'common', archive_format=archive_format, **kwds)
+        tar_name = self.tar_basename + package.TARBALL_FORMATS[archive_format][0]
+        with decompressors.open_tarball(tar_name) as tarball:
+            packaged_files = sorted(member.name for member in tarball)
+        self.assertEquals(packaged_files, self.expected_files)
+
+    def test_package_tgz(self):
+        self.package_format('tgz', compression_level=1)
+
+    def test_package_txz(self):
+        self.package_format('txz', 'xz', compression_jobs=2)
+
+    def test_package_tzst(self):
+        self.package_format('tzst', 'zstd', compression_level=19)
+
+    def test_bad_compression_level(self):
+        with ExpectError("zst compression level must be from 1 to 19",
+                         "out of range compression level accepted"):
+            package.package(self.config, self.config.get_build_directory(
+                None, 'common'), 'common', archive_format='tzst', compression_level=22)
+
     def test_results(self):
         logger.setLevel(logging.DEBUG)
         results_output = tempfile.mktemp()
@@ -145,6 +207,228 @@ class TestPackaging(BaseTest):
                 expected_results_regex, actual_results)
         clean_file(results_output)
 
+    def results_digests(self, archive_format, archive_name):
+        results_output = tempfile.mktemp()
+        try:
+            package.package(self.config, self.config.get_build_directory(None, 'common'),
+                            'common', archive_format=archive_format, results_file=results_output,
+                            digests=['sha256'])
+            with open(results_output) as results:
+                actual_results = results.read()
+        finally:
+            clean_file(results_output)
+        # the digests computed while writing are those of the archive written
+        for algorithm in 'md5', 'sha256':
+            self.assertIn('autobuild_package_%s="%s"\n' %
+                          (algorithm, hash_algorithms.compute_hash(algorithm, archive_name)),
+                          actual_results)
+
+    def test_results_digests(self):
+        self.results_digests('tbz2', self.tar_name)
+        self.tar_has_expected(self.tar_name)
+
+    def test_zip_results_digests(self):
+        self.results_digests('zip', self.zip_name)
+        self.zip_has_expected(self.zip_name)
+        zip_file = ZipFile(self.zip_name, 'r')
+        self.assertEquals(zip_file.testzip(), None)
+        zip_file.close()
+
+    def test_zip_compression_types(self):
+        build_directory = self.config.get_build_directory(None, 'common')
+        with open(os.path.join(build_directory, "include", "image.png"), 'wb') as image:
+            image.write('PNG' * 1000)
+        with open(os.path.join(build_directory, "include", "noise"), 'wb') as noise:
+            noise.write(os.urandom(100000))
+        with open(os.path.join(build_directory, "include", "text"), 'wb') as text:
+            text.write('some text\n' * 10000)
+        self.expected_files = sorted(self.expected_files +
+                                     ['include/image.png', 'include/noise', 'include/text'])
+        package.package(self.config, build_directory, 'common', archive_format='zip')
+        self.zip_has_expected(self.zip_name)
+        zip_file = ZipFile(self.zip_name, 'r')
+        try:
+            self.assertEquals(zip_file.testzip(), None)
+            # already compressed, by name or by nature, so not deflated again
+            self.assertEquals(zip_file.getinfo('include/image.png').compress_type, ZIP_STORED)
+            self.assertEquals(zip_file.getinfo('include/noise').compress_type, ZIP_STORED)
+            self.assertEquals(zip_file.getinfo('include/text').compress_type, ZIP_DEFLATED)
+        finally:
+            zip_file.close()
+
+    def test_zip_parallel_compression(self):
+        build_directory = self.config.get_build_directory(None, 'common')
+        for n in range(20):
+            with open(os.path.join(build_directory, "include", "file%02d" % n), 'wb') as member:
+                member.write('member %d\n' % n * 1000)
+        package.package(self.config, build_directory, 'common', archive_format='zip')
+        with open(self.zip_name, 'rb') as archive:
+            serial = archive.read()
+        os.remove(self.zip_name)
+        package._remove_package_fingerprint(self.zip_name)
+        package.package(self.config, build_directory, 'common', archive_format='zip',
+                        compression_jobs=4)
+        # the members are written in the same order whoever compresses them
+        with open(self.zip_name, 'rb') as archive:
+            self.assertEquals(archive.read(), serial)
+
+    def test_zip_stored_member_changed(self):
+        path = os.path.join(self.temp_dir, "image.png")
+        with open(path, 'wb') as image:
+            image.write('PNG' * 1000)
+        prepared = package._prepare_zip_member(path, "image.png")
+        self.assertEquals(prepared.zinfo.compress_type, ZIP_STORED)
+        # the same size, but not the same data, by the time it's written
+        with open(path, 'wb') as image:
+            image.write('GIF' * 1000)
+        zip_file = package._PreparedZipFile(StringIO(), 'w')
+        with ExpectError("changed while it was being packaged",
+                         "expected a PackageError for the changed file"):
+            zip_file.write_prepared(prepared)
+
+    def package_results(self, **kwds):
+        results_output = tempfile.mktemp()
+        try:
+            with CaptureStdout() as stdout:
+                package.package(self.config, self.config.get_build_directory(None, 'common'),
+                                'common', results_file=results_output, **kwds)
+            with open(results_output) as results:
+                return results.read(), stdout.getvalue()
+        finally:
+            clean_file(results_output)
+
+    def test_reuse_unchanged(self):
+        first = self.package_results(archive_format='tbz2')
+        # the same files packaged the same way: the archive is just reported again
+        def unexpected(*args, **kwds):
+            raise AssertionError("unchanged package archived again")
+        with patch(package, "_create_tarfile", unexpected):
+            self.assertEquals(self.package_results(archive_format='tbz2'), first)
+            # (with any new digests computed from the archive)
+            results, stdout = self.package_results(archive_format='tbz2', digests=['sha256'])
+        self.assertIn('autobuild_package_sha256="%s"\n' %
+                      hash_algorithms.compute_hash('sha256', self.tar_name), results)
+        self.tar_has_expected(self.tar_name)
+
+    def test_repackage_changed(self):
+        self.package_results(archive_format='tbz2')
+        with open(os.path.join(self.config.get_build_directory(None, 'common'),
+                               'include', 'file1'), 'a') as changed:
+            changed.write("changed\n")
+        first_md5 = hash_algorithms.compute_hash('md5', self.tar_name)
+        results, stdout = self.package_results(archive_format='tbz2')
+        self.assertNotEquals(hash_algorithms.compute_hash('md5', self.tar_name), first_md5)
+        self.assertIn('autobuild_package_md5="%s"\n' %
+                      hash_algorithms.compute_hash('md5', self.tar_name), results)
+        # nor is a changed format taken for the same archive
+        self.package_results(archive_format='tbz2', compression_level=1)
+        self.assertNotEquals(hash_algorithms.compute_hash('md5', self.tar_name), first_md5)
+
+    def test_deterministic(self):
+        archives = [('tbz2', self.tar_name), ('tgz', self.tar_basename + '.tar.gz'),
+                    ('zip', self.zip_name)]
+        first = [self.package_results(archive_format=archive_format)
+                 for archive_format, archive_name in archives]
+        # forget the archives were ever written, and (a second later, so that
+        # any time recorded would differ) write them again
+        for archive_format, archive_name in archives:
+            os.remove(archive_name + package.PACKAGE_FINGERPRINT_SUFFIX)
+        time.sleep(1)
+        self.assertEquals([self.package_results(archive_format=archive_format)
+                           for archive_format, archive_name in archives], first)
+
+    def test_package_windows_permissions(self):
+        # CACLS grants access to each packaged file on Windows
+        commands = []
+
+        class FakeCACLS(object):
+            def __init__(self, command, cwd=None, **kwds):
+                commands.append((command, cwd))
+
+            def communicate(self, input):
+                return "processed file", None
+
+            def wait(self):
+                return 0
+
+        build_directory = self.config.get_build_directory(None, 'common')
+        with patch(common, "get_current_platform", lambda: common.PLATFORM_WINDOWS), \
+             patch(package.subprocess, "Popen", FakeCACLS), \
+             CaptureStdout():
+            package.package(self.config, build_directory, 'common', archive_format='tbz2')
+        self.tar_has_expected(self.tar_name)
+        self.assertEquals([(command[:2], cwd) for command, cwd in commands],
+                          [(["CACLS", file], build_directory) for file in self.expected_files])
+
+    def test_package_from_other_directory(self):
+        # packaging doesn't depend on, or change, the current directory
+        os.chdir(self.temp_dir)
+        package.package(self.config, self.config.get_build_directory(
+            None, 'common'), 'common', archive_format='tbz2')
+        self.tar_has_expected(self.tar_name)
+        package.package(self.config, self.config.get_build_directory(
+            None, 'common'), 'common', archive_format='zip')
+        self.zip_has_expected(self.zip_name)
+        self.assertEquals(os.getcwd(), os.path.realpath(self.temp_dir))
+
+    def test_package_jobs(self):
+        build_directory = self.config.get_build_directory(None, 'common')
+        build_dirs = [build_directory]
+        for suffix in "ab":
+            shutil.copytree(build_directory, build_directory + suffix)
+            build_dirs.append(build_directory + suffix)
+        options = PackageOptions(self.data_dir)
+        options.platform = 'common'
+        options.archive_format = 'tbz2'
+        options.results_file = os.path.join(self.temp_dir, "results")
+        options.jobs = 2
+        packaged = []
+
+        def record_package(config, build_dir, platform_name, **kwds):
+            packaged.append((build_dir, kwds['results_file']))
+            return package_package(config, build_dir, platform_name, **kwds)
+        package_package = package.package
+        with patch(common, "select_directories", lambda *args: build_dirs), \
+             patch(package, "package", record_package):
+            package.AutobuildTool().run(options)
+        self.assertEquals(sorted(packaged),
+                          sorted([(build_dirs[0], None), (build_dirs[1], None),
+                                  (build_dirs[2], options.results_file)]))
+        # every configuration here writes the same archive, but one at a time
+        self.tar_has_expected(self.tar_name)
+        with open(options.results_file) as results:
+            self.assertIn('autobuild_package_filename="%s"\n' % self.tar_name, results.read())
+
+    def test_bad_package_jobs(self):
+        options = PackageOptions(self.data_dir)
+        options.jobs = 0
+        with ExpectError("--jobs must be a positive number of jobs, not '0'",
+                         "expected AutobuildError for --jobs 0"):
+            package.AutobuildTool().run(options)
+        options.jobs = None
+        os.environ['AUTOBUILD_PACKAGE_JOBS'] = "x"
+        try:
+            with ExpectError(r"\$AUTOBUILD_PACKAGE_JOBS must be a positive number of jobs, not 'x'",
+                             "expected AutobuildError for a bad $AUTOBUILD_PACKAGE_JOBS"):
+                package.AutobuildTool().run(options)
+        finally:
+            del os.environ['AUTOBUILD_PACKAGE_JOBS']
+
+    def test_bad_compression_jobs(self):
+        options = PackageOptions(self.data_dir)
+        options.compression_jobs = -1
+        with ExpectError("--compression-jobs must be a positive number of jobs, not '-1'",
+                         "expected AutobuildError for --compression-jobs -1"):
+            package.AutobuildTool().run(options)
+        options.compression_jobs = None
+        os.environ['AUTOBUILD_COMPRESSION_JOBS'] = "0"
+        try:
+            with ExpectError(r"\$AUTOBUILD_COMPRESSION_JOBS must be a positive number of jobs, not '0'",
+                             "expected AutobuildError for a bad $AUTOBUILD_COMPRESSION_JOBS"):
+                package.AutobuildTool().run(options)
+        finally:
+            del os.environ['AUTOBUILD_COMPRESSION_JOBS']
+
     def test_package_other_version(self):
         # read the existing metadata file and update stored package version
         build_directory = self.config.get_build_directory(None, 'common')